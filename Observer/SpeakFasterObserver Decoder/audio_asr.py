@@ -4,8 +4,12 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
+import functools
 import glob
+import hashlib
 import io
+import json
 import os
 import pathlib
 import struct
@@ -15,13 +19,14 @@ from absl import logging
 import numpy as np
 import pydub
 from google.cloud import speech_v1p1beta1 as speech
-from google.cloud import storage
 from scipy.io import wavfile
 
 import file_naming
 import gcloud_utils
+import resample
 import transcript_lib
 import tsv_data
+import vad
 
 GCLOUD_SPEECH_STREAMING_LENGTH_LIMIT_SEC = 240
 AUDIO_UPLOAD_BUCKET_NAME_PREFIX = "speakfaster_audio_uploads"
@@ -34,6 +39,32 @@ DEFAULT_TIMESTAMP_ERROR_TOLERANCE_SEC = 0.5
 # then we cut the head of the audio file by (ending timestamp of previous
 # audio file - beginning timestamp of current audio file).
 DEFAULT_MAX_AUDIO_HEAD_ADJUSTMENT_SEC = 2.0
+# Length of the frames used to compute the short-time energy when searching
+# for silence-aligned split points.
+SILENCE_SEARCH_FRAME_SEC = 0.05
+# Split points are searched for within this window before the chunk length
+# limit is reached.
+DEFAULT_SILENCE_SEARCH_WINDOW_SEC = 30.0
+# Maximum number of ASR requests that are in flight at the same time in the
+# concurrent chunked mode.
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+# Length of audio carried by each request in a streaming request sequence.
+STREAMING_REQUEST_LENGTH_SEC = 60.0
+# Default directory for cached ASR results. Set to empty to disable caching.
+DEFAULT_ASR_CACHE_DIR = os.path.join(
+    pathlib.Path.home(), "SpeakFasterObs", "asr_cache")
+# Size of the blocks in which audio files are read for computing cache keys.
+ASR_CACHE_HASH_BLOCK_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=None)
+def get_speech_client():
+  """Returns a Speech-to-Text client shared by all calls in this process.
+
+  Creating a client sets up credentials and a gRPC channel, which is slow
+  enough to matter when many sessions are processed by the same process.
+  """
+  return speech.SpeechClient()
 
 
 def concatenate_audio_files(
@@ -83,10 +114,14 @@ def concatenate_audio_files(
     gaps_sec = start_delays - durations_sec
 
   pure_path = pathlib.PurePath(input_paths[0])
-  audio_seg = pydub.AudioSegment.from_file(pure_path, pure_path.suffix[1:])
+  first_audio_seg = pydub.AudioSegment.from_file(
+      pure_path, pure_path.suffix[1:])
   sample_rate_hz = get_sample_rate(pure_path)
-  num_channels = audio_seg.channels
-  sample_width = audio_seg.sample_width
+  num_channels = first_audio_seg.channels
+  sample_width = first_audio_seg.sample_width
+  # The raw data of the segments are collected and joined only once at the
+  # end, to avoid copying the growing concatenation result for every file.
+  raw_data_chunks = [first_audio_seg.raw_data]
   for i, input_path in enumerate(input_paths[1:]):
     if fill_gaps:
       if gaps_sec[i] < -max_audio_head_adjustment_sec:
@@ -98,16 +133,12 @@ def concatenate_audio_files(
             (input_path, input_paths[i], i, gaps_sec, gaps_sec[i],
             max_audio_head_adjustment_sec))
       elif gaps_sec[i] > 0:
-        temp_wav_path = tempfile.mktemp(suffix=".wav")
-        create_all_zeros_wav_file(
-            temp_wav_path,
+        raw_data_chunks.append(make_silent_audio_segment(
             sample_rate_hz,
             gaps_sec[i],
-            sample_width=audio_seg.sample_width,
-            num_channels=audio_seg.channels)
-        audio_seg += pydub.AudioSegment.from_file(temp_wav_path, "wav")
+            sample_width=sample_width,
+            num_channels=num_channels).raw_data)
         print("Filled a gap between audio files of length %.3f s" % gaps_sec[i])
-        os.remove(temp_wav_path)
     pure_path = pathlib.PurePath(input_path)
     new_audio_seg = pydub.AudioSegment.from_file(pure_path,
                                                  pure_path.suffix[1:])
@@ -118,7 +149,12 @@ def concatenate_audio_files(
             (input_path, gap_millis))
     assert new_audio_seg.channels == num_channels, "Channel count mismatch"
     assert new_audio_seg.sample_width == sample_width, "Sample width mismatch"
-    audio_seg += new_audio_seg
+    raw_data_chunks.append(new_audio_seg.raw_data)
+  audio_seg = pydub.AudioSegment(
+      data=b"".join(raw_data_chunks),
+      sample_width=sample_width,
+      frame_rate=first_audio_seg.frame_rate,
+      channels=num_channels)
   pure_path = pathlib.PurePath(output_path)
   output_format = pure_path.suffix[1:].lower()
   audio_seg.export(pure_path, output_format)
@@ -138,18 +174,96 @@ def get_audio_file_duration_sec(file_path):
   return audio_seg.duration_seconds
 
 
+def make_silent_audio_segment(sample_rate_hz,
+                              duration_sec,
+                              sample_width=2,
+                              num_channels=1):
+  """Creates an in-memory pydub.AudioSegment of all-zero samples.
+
+  Args:
+    sample_rate_hz: Sample rate of the segment.
+    duration_sec: Duration of the segment in seconds.
+    sample_width: Sample width in bytes.
+    num_channels: Number of channels.
+
+  Returns:
+    A pydub.AudioSegment with int(sample_rate_hz * duration_sec) frames.
+  """
+  num_frames = int(sample_rate_hz * duration_sec)
+  return pydub.AudioSegment(
+      data=bytes(num_frames * sample_width * num_channels),
+      sample_width=sample_width,
+      frame_rate=sample_rate_hz,
+      channels=num_channels)
+
+
 def create_all_zeros_wav_file(file_path,
                               sample_rate_hz,
                               duration_sec,
                               sample_width=2,
                               num_channels=1):
-  assert sample_width == 2
-  assert num_channels == 1
-  wavfile.write(
-      file_path, sample_rate_hz,
-      np.zeros([int(sample_rate_hz * duration_sec)], dtype=np.int16))
+  make_silent_audio_segment(
+      sample_rate_hz,
+      duration_sec,
+      sample_width=sample_width,
+      num_channels=num_channels).export(file_path, "wav")
+
+
+def find_silence_split_points(
+    xs,
+    sample_rate_hz,
+    max_chunk_sec=GCLOUD_SPEECH_STREAMING_LENGTH_LIMIT_SEC,
+    search_window_sec=DEFAULT_SILENCE_SEARCH_WINDOW_SEC,
+    frame_sec=SILENCE_SEARCH_FRAME_SEC):
+  """Find points to split a waveform into chunks at silences.
+
+  Each chunk is no longer than `max_chunk_sec`. Each split point is placed at
+  the center of the lowest-energy frame within the last `search_window_sec`
+  before the chunk would exceed `max_chunk_sec`, so that words are unlikely to
+  be cut across chunks.
 
+  Args:
+    xs: Mono waveform as a 1D numpy array.
+    sample_rate_hz: Sample rate of the waveform.
+    max_chunk_sec: Maximum length of each chunk, in seconds.
+    search_window_sec: Length of the window in which silence is searched for,
+      in seconds. Must not exceed `max_chunk_sec`.
+    frame_sec: Length of the frames used to compute short-time energy.
 
+  Returns:
+    Sample indices of the chunk boundaries as a list of ints, beginning with 0
+      and ending with len(xs).
+  """
+  if len(xs.shape) != 1:
+    raise ValueError("Only mono audio is supported")
+  if search_window_sec > max_chunk_sec:
+    raise ValueError(
+        "Silence search window (%.3f s) exceeds max chunk length (%.3f s)" %
+        (search_window_sec, max_chunk_sec))
+  frame_length = max(int(sample_rate_hz * frame_sec), 1)
+  max_chunk_length = int(sample_rate_hz * max_chunk_sec)
+  search_frames = max(int(search_window_sec / frame_sec), 1)
+  num_frames = len(xs) // frame_length
+  frames = xs[:num_frames * frame_length].astype(np.float32).reshape(
+      [num_frames, frame_length])
+  energies = np.mean(np.square(frames), axis=1)
+
+  split_points = [0]
+  while len(xs) - split_points[-1] > max_chunk_length:
+    # Last frame that ends no later than the chunk length limit.
+    last_frame = (split_points[-1] + max_chunk_length) // frame_length - 1
+    first_frame = max(
+        last_frame - search_frames + 1,
+        -(-split_points[-1] // frame_length))
+    if last_frame < first_frame:
+      split_point = split_points[-1] + max_chunk_length
+    else:
+      quietest_frame = first_frame + int(
+          np.argmin(energies[first_frame:last_frame + 1]))
+      split_point = quietest_frame * frame_length + frame_length // 2
+    split_points.append(split_point)
+  split_points.append(len(xs))
+  return split_points
 
 
 def get_consecutive_audio_file_paths(
@@ -238,18 +352,23 @@ def load_audio_data(file_path, config):
   """
   pure_path = pathlib.PurePath(file_path)
   audio_seg = pydub.AudioSegment.from_file(pure_path, pure_path.suffix[1:])
-  if audio_seg.frame_rate != config.sample_rate_hertz:
-    raise ValueError("Mismatch in sample rate: expected: %d; got: %d" % (
+  if audio_seg.frame_rate < config.sample_rate_hertz:
+    raise ValueError(
+        "Mismatch in sample rate: expected: %d; got: %d. "
+        "Upsampling is not supported" % (
         config.sample_rate_hertz, audio_seg.frame_rate))
   if audio_seg.channels != config.audio_channel_count:
     raise ValueError(
         "Mismatch in audio channel count: expected: %d; got: %d" % (
         config.audio_channel_count, audio_seg.channels))
-  samples = list(audio_seg.get_array_of_samples())
   # NOTE(cais): We currently use LINEAR16 in the stream requests regardless of
   # the original audio file format. Is it possible to avoid converting FLAC to
   # LINEAR16 during these cloud requests?
-  return struct.pack('<%dh' % len(samples), *samples)
+  samples = np.array(audio_seg.get_array_of_samples(), dtype=np.int16)
+  # Audio at a higher sample rate (e.g., 44.1 or 48 kHz) is downsampled.
+  samples = resample.resample(
+      samples, audio_seg.frame_rate, config.sample_rate_hertz)
+  return samples.astype("<i2").tobytes()
 
 
 def audio_data_generator(input_audio_paths, config):
@@ -314,6 +433,28 @@ def parse_args():
       action="store_true",
       help="Use all audio files in the same input dir and after first_audio_path, "
       "and fill in the gaps (if any) between the files.")
+  parser.add_argument(
+      "--concurrent_chunks",
+      action="store_true",
+      help="Split the audio at silences into chunks and transcribe the chunks "
+      "concurrently with the streaming Speech-to-Text API.")
+  parser.add_argument(
+      "--max_concurrent_requests",
+      type=int,
+      default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+      help="Maximum number of concurrent ASR requests under "
+      "--concurrent_chunks.")
+  parser.add_argument(
+      "--asr_cache_dir",
+      type=str,
+      default=DEFAULT_ASR_CACHE_DIR,
+      help="Directory for caching ASR results, keyed by the audio content and "
+      "the recognition config. Set to empty to disable caching.")
+  parser.add_argument(
+      "--skip_silence",
+      action="store_true",
+      help="Under --concurrent_chunks, send only the speech regions found by "
+      "voice activity detection to the ASR backend.")
   return parser.parse_args()
 
 
@@ -334,70 +475,95 @@ def regroup_utterances(utterances, words):
       Each element of the list has the format
       (regrouped_utterance, speaker_index, start_time, end_time).
   """
-  all_words = []
-  original_bounds = []
+  return list(iter_regrouped_utterances(utterances, words))
+
+
+def _iter_transcript_words(utterances):
+  """Yields (word, is_first_word_of_utterance) for the words in utterances."""
   for utterance in utterances:
-    utterance_words = [w.strip() for w in utterance.split(" ") if w]
-    all_words.extend(utterance_words)
-    original_bounds.append(
-        (len(utterance_words) + original_bounds[-1]) if original_bounds
-        else len(utterance_words))
-  regrouped_utterances = []
+    is_first_word = True
+    for word in utterance.split(" "):
+      if not word:
+        continue
+      yield word.strip(), is_first_word
+      is_first_word = False
+
+
+def iter_regrouped_utterances(utterances, words):
+  """Generator version of regroup_utterances().
+
+  The utterances and the words are consumed in a single pass, so this runs in
+  time linear in the number of words and holds only the current regrouped
+  utterance in memory.
+
+  Args:
+    utterances: An iterable of utterances as strings.
+    words: An iterable of words, each of which has the format
+      (word, speaker_index, start_time, end_time).
+
+  Yields:
+    Regrouped utterances, each of which corresponds to the same speaker and has
+      the format (regrouped_utterance, speaker_index, start_time, end_time).
+
+  Raises:
+    ValueError: If the words do not match the words in the utterances. As
+      this is a generator, the error may be raised after some regrouped
+      utterances have been yielded. Use regroup_utterances() to validate all
+      the words before writing any output.
+  """
+  transcript_words = _iter_transcript_words(utterances)
   current_utterance = []
   current_utterance_start = None
   current_utterance_end = None
   current_speaker_index = -1  # -1 is a sentinel for the beginning.
-  word_index = 0
-  for i, (word,
-          word_speaker_index,
-          word_start_time,
-          word_end_time) in enumerate(words):
-    start_new_utterance = False
+  for (word,
+       word_speaker_index,
+       word_start_time,
+       word_end_time) in words:
+    transcript_word, at_original_bound = next(transcript_words, (None, False))
+    if transcript_word != word:
+      raise ValueError("Mismatch in words: %s != %s" % (word, transcript_word))
     if current_speaker_index == -1:
-      start_new_utterance = True
+      current_speaker_index = word_speaker_index
+      current_utterance_start = word_start_time
     elif current_speaker_index != word_speaker_index or (
-        i in original_bounds and word_start_time > current_utterance_end):
+        at_original_bound and word_start_time > current_utterance_end):
       # There is a change in speaker, or a pause in the same speaker across an
       # transcript boundary.
-      regrouped_utterances.append((
-          " ".join(current_utterance),
-          current_speaker_index,
-          current_utterance_start,
-          current_utterance_end))
-      start_new_utterance = True
-    if start_new_utterance:
+      yield (" ".join(current_utterance),
+             current_speaker_index,
+             current_utterance_start,
+             current_utterance_end)
       current_utterance = []
       current_speaker_index = word_speaker_index
       current_utterance_start = word_start_time
-    if all_words[word_index] != word:
-      raise ValueError(
-          "Mismatch in words: %s != %s" % (word, all_words[word_index]))
-      current_utterance.append(word)
     current_utterance_end = word_end_time
-    current_utterance.append(all_words[word_index])
-    word_index += 1
+    current_utterance.append(transcript_word)
 
   if current_utterance:
-    regrouped_utterances.append((
-        " ".join(current_utterance),
-        current_speaker_index,
-        current_utterance_start,
-        current_utterance_end))
+    yield (" ".join(current_utterance),
+           current_speaker_index,
+           current_utterance_start,
+           current_utterance_end)
 
-  if word_index != len(all_words):
+  if next(transcript_words, None) is not None:
     raise ValueError(
         "Some words in the transcripts are missing from word-level diarization")
 
-  return regrouped_utterances
-
 
 def transcribe_audio_to_tsv(input_audio_paths,
                             output_tsv_path,
                             sample_rate,
                             language_code,
-                            begin_sec=0.0):
-  """Transcribe speech in input audio files and write results to .tsv file."""
-  client = speech.SpeechClient()
+                            begin_sec=0.0,
+                            cache_dir=DEFAULT_ASR_CACHE_DIR):
+  """Transcribe speech in input audio files and write results to .tsv file.
+
+  The recognizer returns phrases without word-level timestamps. They are
+  cached as (phrase, 0, start_time, end_time) entries, i.e., in the format of
+  words, under a key that includes the config, so that they never mix with
+  word-level results.
+  """
   config = speech.RecognitionConfig(
       encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
       sample_rate_hertz=sample_rate,
@@ -405,14 +571,15 @@ def transcribe_audio_to_tsv(input_audio_paths,
       language_code=language_code)
   streaming_config = speech.StreamingRecognitionConfig(
       config=config, interim_results=False)
-  requests = audio_data_generator(input_audio_paths, config)
-  responses = client.streaming_recognize(streaming_config, requests)
-
-  with open(output_tsv_path, "w" if not begin_sec else "a") as f:
-    if not begin_sec:
-      # Write the TSV header.
-      f.write(tsv_data.HEADER + "\n")
-
+  cache_key = get_asr_cache_key_for_files(input_audio_paths, streaming_config)
+  cached = load_cached_asr_result(cache_dir, cache_key)
+  if cached is not None:
+    _, phrases = cached
+  else:
+    client = get_speech_client()
+    requests = audio_data_generator(input_audio_paths, config)
+    responses = client.streaming_recognize(streaming_config, requests)
+    phrases = []
     for response in responses:
       if not response.results:
         continue
@@ -435,11 +602,20 @@ def transcribe_audio_to_tsv(input_audio_paths,
       # TODO(cais): Should we use absolute timestamps such as epoch time, instead of
       # time relative to the beginning of the first file?
       start_time_sec = end_time_sec - 1
+      phrases.append((best_transcript, 0, start_time_sec, end_time_sec))
+    save_asr_result_to_cache(
+        cache_dir, cache_key, [phrase[0] for phrase in phrases], phrases)
+
+  with open(output_tsv_path, "w" if not begin_sec else "a") as f:
+    if not begin_sec:
+      # Write the TSV header.
+      f.write(tsv_data.HEADER + "\n")
+    for transcript, _, start_time_sec, end_time_sec in phrases:
       line = "%.3f\t%.3f\t%s\t%s" % (
           start_time_sec + begin_sec,
           end_time_sec + begin_sec,
           tsv_data.SPEECH_TRANSCRIPT_TIER,
-          best_transcript)
+          transcript)
       print(line)
       f.write(line + "\n")
 
@@ -449,13 +625,13 @@ def transcribe_audio_to_tsv_with_diarization(input_audio_paths,
                                              sample_rate,
                                              language_code,
                                              speaker_count,
-                                             begin_sec=0.0):
+                                             begin_sec=0.0,
+                                             cache_dir=DEFAULT_ASR_CACHE_DIR):
   """Transcribe speech in input audio files and write results to .tsv file.
 
   This method differs from transcribe_audio_to_tsv() in that it performs speaker
   diarization and uses the word-level speaker indices to regroup the transcripts.
   """
-  client = speech.SpeechClient()
   enable_speaker_diarization = speaker_count > 0
   config = speech.RecognitionConfig(
       encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
@@ -467,49 +643,385 @@ def transcribe_audio_to_tsv_with_diarization(input_audio_paths,
       diarization_speaker_count=speaker_count)
   streaming_config = speech.StreamingRecognitionConfig(
       config=config, interim_results=False)
+  cache_key = get_asr_cache_key_for_files(input_audio_paths, streaming_config)
+  cached = load_cached_asr_result(cache_dir, cache_key)
+  if cached is not None:
+    utterances, diarized_words = cached
+    write_utterances_to_tsv(
+        output_tsv_path, utterances, diarized_words, begin_sec=begin_sec)
+    return
+  client = get_speech_client()
   requests = audio_data_generator(input_audio_paths, config)
   responses = client.streaming_recognize(streaming_config, requests)
 
+  utterances = []
+  diarized_words = []
+  for response in responses:
+    if not response.results:
+      continue
+    results = [result for result in response.results if result.is_final]
+    max_confidence = -1
+    best_transcript = None
+    result_end_time = None
+    for result in results:
+      for alt in result.alternatives:
+        if alt.confidence > max_confidence:
+          max_confidence = alt.confidence
+          best_transcript = alt.transcript.strip()
+          diarized_words = [(
+              word.word, word.speaker_tag, word.start_time.total_seconds(),
+              word.end_time.total_seconds()) for word in alt.words]
+          result_end_time = result.result_end_time
+    if not best_transcript:
+      continue
+    end_time_sec = result_end_time.total_seconds()
+    utterances.append(best_transcript)
+
+  save_asr_result_to_cache(cache_dir, cache_key, utterances, diarized_words)
+  write_utterances_to_tsv(
+      output_tsv_path, utterances, diarized_words, begin_sec=begin_sec)
+
+
+def get_asr_cache_key(pcm_bytes, config):
+  """Computes the cache key of an ASR result.
+
+  Args:
+    pcm_bytes: The audio samples sent for recognition, as bytes.
+    config: An instance of speech.RecognitionConfig or
+      speech.StreamingRecognitionConfig used for the recognition.
+
+  Returns:
+    The hex digest of the SHA-256 hash of the audio and the config, as a str.
+  """
+  hasher = hashlib.sha256()
+  hasher.update(pcm_bytes)
+  hasher.update(type(config).serialize(config))
+  return hasher.hexdigest()
+
+
+def get_asr_cache_key_for_files(file_paths, config):
+  """Computes the cache key of an ASR result for audio files.
+
+  The files are hashed in blocks, so that long audio is never loaded into
+  memory for computing the key.
+
+  Args:
+    file_paths: Paths to the audio files sent for recognition, in order.
+    config: An instance of speech.RecognitionConfig or
+      speech.StreamingRecognitionConfig used for the recognition.
+
+  Returns:
+    The hex digest of the SHA-256 hash of the files and the config, as a str.
+  """
+  hasher = hashlib.sha256()
+  for file_path in file_paths:
+    # The size delimits the files, so that moving bytes across a file
+    # boundary changes the key.
+    hasher.update(b"%d\n" % os.path.getsize(file_path))
+    with open(file_path, "rb") as f:
+      for block in iter(lambda: f.read(ASR_CACHE_HASH_BLOCK_SIZE), b""):
+        hasher.update(block)
+  hasher.update(type(config).serialize(config))
+  return hasher.hexdigest()
+
+
+def _get_asr_cache_path(cache_dir, cache_key):
+  return os.path.join(cache_dir, cache_key + ".json")
+
+
+def load_cached_asr_result(cache_dir, cache_key):
+  """Loads a cached ASR result.
+
+  Args:
+    cache_dir: Path to the cache directory. If empty or None, caching is
+      disabled.
+    cache_key: The cache key, as returned by get_asr_cache_key().
+
+  Returns:
+    If the result is cached, a tuple of (utterances, words), where words are
+      (word, speaker_index, start_time, end_time) tuples. Else, None.
+  """
+  if not cache_dir:
+    return None
+  cache_path = _get_asr_cache_path(cache_dir, cache_key)
+  if not os.path.isfile(cache_path):
+    return None
+  with open(cache_path, "r") as f:
+    cached = json.load(f)
+  print("Loaded cached ASR result from %s" % cache_path)
+  return cached["utterances"], [tuple(word) for word in cached["words"]]
+
+
+def save_asr_result_to_cache(cache_dir, cache_key, utterances, words):
+  """Saves an ASR result to the cache.
+
+  Args:
+    cache_dir: Path to the cache directory. If empty or None, caching is
+      disabled.
+    cache_key: The cache key, as returned by get_asr_cache_key().
+    utterances: The utterances as a list of strings.
+    words: The words as (word, speaker_index, start_time, end_time) tuples.
+  """
+  if not cache_dir:
+    return
+  os.makedirs(cache_dir, exist_ok=True)
+  cache_path = _get_asr_cache_path(cache_dir, cache_key)
+  # Write to a unique temporary file first so that concurrent writers (e.g.,
+  # threads recognizing chunks with identical audio) and readers never see a
+  # partially-written cache file.
+  fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+  try:
+    with os.fdopen(fd, "w") as f:
+      json.dump({"utterances": utterances, "words": words}, f)
+    os.replace(tmp_path, cache_path)
+  finally:
+    if os.path.isfile(tmp_path):
+      os.remove(tmp_path)
+
+
+def write_utterances_to_tsv(output_tsv_path, utterances, words, begin_sec=0.0):
+  """Regroups utterances by speaker and writes them to a TSV file.
+
+  All the utterances are regrouped before the file is opened, so that a
+  mismatch between the utterances and the words raises ValueError without
+  leaving a partially-written file behind.
+
+  Args:
+    output_tsv_path: Path to the output TSV file. If begin_sec is 0, the file
+      is overwritten and starts with the TSV header. Else, the rows are
+      appended to it.
+    utterances: A list of utterances as strings.
+    words: A list of words, each of which has the format
+      (word, speaker_index, start_time, end_time).
+    begin_sec: Offset of the timestamps in the output rows, in seconds.
+  """
+  regrouped_utterances = regroup_utterances(utterances, words)
   with open(output_tsv_path, "w" if not begin_sec else "a") as f:
     if not begin_sec:
       # Write the TSV header.
       f.write(tsv_data.HEADER + "\n")
-    utterances = []
-    for response in responses:
-      if not response.results:
+    if not utterances:
+      print("ASR produced no recognized speech utterances. "
+            "Generated empty asr.tsv file.")
+      return
+    write_regrouped_utterances(f, regrouped_utterances, begin_sec=begin_sec)
+
+
+def write_regrouped_utterances(f, regrouped_utterances, begin_sec=0.0):
+  """Write regrouped utterances to an opened TSV file.
+
+  Args:
+    f: The opened file object to write to.
+    regrouped_utterances: An iterable of regrouped utterances as yielded by
+      iter_regrouped_utterances(). It is consumed lazily.
+    begin_sec: Offset of the timestamps in the output rows, in seconds.
+  """
+  utterance_counter = 0
+  for (regrouped_utterance,
+       speaker_index, start_time_sec, end_time_sec) in regrouped_utterances:
+    utterance_counter += 1
+    line = "%.3f\t%.3f\t%s\t%s %s [Speaker #%d]" % (
+        start_time_sec + begin_sec,
+        end_time_sec + begin_sec,
+        tsv_data.SPEECH_TRANSCRIPT_TIER,
+        regrouped_utterance,
+        transcript_lib.get_utterance_id(utterance_counter),
+        speaker_index)
+    print(line)
+    f.write(line + "\n")
+
+
+def _pcm_request_generator(pcm_bytes, sample_rate):
+  """Splits LINEAR16 mono PCM into a sequence of streaming requests."""
+  request_length = int(STREAMING_REQUEST_LENGTH_SEC * sample_rate) * 2
+  for i in range(0, len(pcm_bytes), request_length):
+    yield speech.StreamingRecognizeRequest(
+        audio_content=pcm_bytes[i:i + request_length])
+
+
+def recognize_chunk(client, streaming_config, pcm_bytes, cache_dir=None):
+  """Transcribes a chunk of audio with word-level timestamps.
+
+  Args:
+    client: An instance of speech.SpeechClient.
+    streaming_config: An instance of speech.StreamingRecognitionConfig. The
+      nested RecognitionConfig must have word time offsets enabled.
+    pcm_bytes: The LINEAR16 mono audio samples of the chunk as bytes.
+    cache_dir: Directory of the ASR result cache. If empty or None, caching is
+      disabled.
+
+  Returns:
+    utterances: A list of transcripts as strings.
+    words: A list of (word, speaker_index, start_time, end_time) tuples, with
+      times relative to the beginning of the chunk.
+  """
+  cache_key = get_asr_cache_key(pcm_bytes, streaming_config)
+  cached = load_cached_asr_result(cache_dir, cache_key)
+  if cached is not None:
+    return cached
+  responses = client.streaming_recognize(
+      streaming_config,
+      _pcm_request_generator(
+          pcm_bytes, streaming_config.config.sample_rate_hertz))
+  diarization = streaming_config.config.enable_speaker_diarization
+  utterances = []
+  words = []
+  for response in responses:
+    for result in response.results:
+      if not result.is_final or not result.alternatives:
         continue
-      results = [result for result in response.results if result.is_final]
-      max_confidence = -1
-      best_transcript = None
-      result_end_time = None
-      for result in results:
-        for alt in result.alternatives:
-          if alt.confidence > max_confidence:
-            max_confidence = alt.confidence
-            best_transcript = alt.transcript.strip()
-            diarized_words = [(
-                word.word, word.speaker_tag, word.start_time.total_seconds(),
-                word.end_time.total_seconds()) for word in alt.words]
-            result_end_time = result.result_end_time
-      if not best_transcript:
+      alt = result.alternatives[0]
+      if not alt.transcript.strip():
         continue
-      end_time_sec = result_end_time.total_seconds()
-      utterances.append(best_transcript)
-
-    regrouped_utterances = regroup_utterances(utterances, diarized_words)
-    utterance_counter = 0
-    for (regrouped_utterance,
-         speaker_index, start_time_sec, end_time_sec) in regrouped_utterances:
-      utterance_counter += 1
-      line = "%.3f\t%.3f\t%s\t%s %s [Speaker #%d]" % (
-          start_time_sec + begin_sec,
-          end_time_sec + begin_sec,
-          tsv_data.SPEECH_TRANSCRIPT_TIER,
-          regrouped_utterance,
-          transcript_lib.get_utterance_id(utterance_counter),
-          speaker_index)
-      print(line)
-      f.write(line + "\n")
+      utterances.append(alt.transcript.strip())
+      result_words = [(
+          word.word, word.speaker_tag, word.start_time.total_seconds(),
+          word.end_time.total_seconds()) for word in alt.words]
+      if diarization:
+        # With diarization, the words of the latest result cover all the
+        # results so far.
+        words = result_words
+      else:
+        words.extend(result_words)
+  save_asr_result_to_cache(cache_dir, cache_key, utterances, words)
+  return utterances, words
+
+
+def merge_chunk_results(chunk_results, chunk_begin_secs):
+  """Merges per-chunk recognition results into session-level ones.
+
+  Args:
+    chunk_results: A list of (utterances, words) tuples as returned by
+      recognize_chunk(), in chronological order.
+    chunk_begin_secs: Beginning time of each chunk relative to the beginning
+      of the session, in seconds.
+
+  Returns:
+    utterances: All utterances as a list of strings.
+    words: All words as (word, speaker_index, start_time, end_time) tuples,
+      with times relative to the beginning of the session.
+  """
+  if len(chunk_results) != len(chunk_begin_secs):
+    raise ValueError(
+        "Mismatch in the number of chunk results (%d) and begin times (%d)" %
+        (len(chunk_results), len(chunk_begin_secs)))
+  all_utterances = []
+  all_words = []
+  for (utterances, words), chunk_begin_sec in zip(
+      chunk_results, chunk_begin_secs):
+    all_utterances.extend(utterances)
+    all_words.extend([
+        (word, speaker_index,
+         start_time + chunk_begin_sec, end_time + chunk_begin_sec)
+        for word, speaker_index, start_time, end_time in words])
+  return all_utterances, all_words
+
+
+def concurrent_chunked_transcribe(
+    audio_file_paths,
+    output_tsv_path,
+    sample_rate,
+    language_code,
+    speaker_count=0,
+    fill_gaps=False,
+    max_chunk_sec=GCLOUD_SPEECH_STREAMING_LENGTH_LIMIT_SEC,
+    max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+    cache_dir=DEFAULT_ASR_CACHE_DIR,
+    skip_silence=False):
+  """Transcribe audio files in silence-aligned chunks concurrently.
+
+  The audio files are concatenated, split at silences into chunks that are
+  each shorter than `max_chunk_sec` and the chunks are sent to the streaming
+  Speech-to-Text API with at most `max_concurrent_requests` requests in
+  flight. The word timestamps are shifted back to the session time before the
+  utterances are regrouped.
+
+  If `skip_silence` is True, voice activity detection is applied first and
+  only the detected speech regions are sent to the backend. The word
+  timestamps are mapped back to the session time.
+
+  NOTE: With speaker diarization, the speaker indices are assigned by the
+  backend independently for each chunk.
+
+  Args:
+    audio_file_paths: Paths to the audio files as a list of strings in the
+      correct order.
+    output_tsv_path: Path to the output TSV file.
+    sample_rate: Audio sample rate.
+    language_code: Language code for recognition.
+    speaker_count: Number of speakers. If 0, speaker diarization will be
+      disabled.
+    fill_gaps: Whether the gaps between the audio files are filled with
+      all-zero samples.
+    max_chunk_sec: Maximum length of each chunk, in seconds.
+    max_concurrent_requests: Maximum number of concurrent ASR requests.
+    cache_dir: Directory of the ASR result cache. If empty or None, caching is
+      disabled.
+    skip_silence: Whether to skip the non-speech regions of the audio.
+  """
+  tmp_wav_path = tempfile.mktemp(suffix=".wav")
+  concatenate_audio_files(audio_file_paths, tmp_wav_path, fill_gaps=fill_gaps)
+  fs, xs = wavfile.read(tmp_wav_path)
+  os.remove(tmp_wav_path)
+  if fs < sample_rate:
+    raise ValueError(
+        "Mismatch in sample rate: expected: %d; got: %d. "
+        "Upsampling is not supported" % (sample_rate, fs))
+  if len(xs.shape) != 1:
+    raise ValueError("Only mono audio is supported")
+  xs = resample.resample(xs.astype(np.int16), fs, sample_rate)
+  fs = sample_rate
+  session_duration_sec = len(xs) / fs
+  time_map = None
+  if skip_silence:
+    regions = vad.detect_speech_regions(xs, fs)
+    time_map = vad.TimeMap(regions, fs)
+    xs = vad.compact_to_speech_regions(xs, regions)
+    print("Voice activity detection kept %d regions (%.3f of %.3f s)" %
+          (len(regions), len(xs) / fs, session_duration_sec))
+  if len(xs):
+    split_points = find_silence_split_points(
+        xs, fs,
+        max_chunk_sec=max_chunk_sec,
+        search_window_sec=min(
+            DEFAULT_SILENCE_SEARCH_WINDOW_SEC, max_chunk_sec))
+  else:
+    split_points = [0]
+  chunk_begin_secs = [begin / fs for begin in split_points[:-1]]
+  print("Transcribing %d chunks (%.3f s) with up to %d concurrent requests" %
+        (len(chunk_begin_secs), len(xs) / fs, max_concurrent_requests))
+
+  client = get_speech_client()
+  enable_speaker_diarization = speaker_count > 0
+  config = speech.RecognitionConfig(
+      encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+      sample_rate_hertz=sample_rate,
+      audio_channel_count=1,
+      language_code=language_code,
+      enable_word_time_offsets=True,
+      enable_speaker_diarization=enable_speaker_diarization,
+      diarization_speaker_count=speaker_count)
+  streaming_config = speech.StreamingRecognitionConfig(
+      config=config, interim_results=False)
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_concurrent_requests) as executor:
+    futures = [
+        executor.submit(
+            recognize_chunk, client, streaming_config,
+            xs[begin:end].astype("<i2").tobytes(), cache_dir=cache_dir)
+        for begin, end in zip(split_points[:-1], split_points[1:])]
+    chunk_results = [future.result() for future in futures]
+
+  utterances, words = merge_chunk_results(chunk_results, chunk_begin_secs)
+  if time_map is not None and words:
+    start_times = time_map.to_original_time(
+        np.array([word[2] for word in words]))
+    end_times = time_map.to_original_time(
+        np.array([word[3] for word in words]), is_end=True)
+    words = [(word[0], word[1], float(start_time), float(end_time))
+             for word, start_time, end_time in zip(
+                 words, start_times, end_times)]
+  write_utterances_to_tsv(output_tsv_path, utterances, words)
 
 
 def async_transcribe(audio_file_paths,
@@ -519,7 +1031,8 @@ def async_transcribe(audio_file_paths,
                      language_code,
                      speaker_count=0,
                      begin_sec=0.0,
-                     fill_gaps=False):
+                     fill_gaps=False,
+                     cache_dir=DEFAULT_ASR_CACHE_DIR):
   """Transcribe a given audio file using the async GCloud Speech-to-Text API.
 
   The async API has the advantage of being able to handler longer audio without
@@ -537,19 +1050,56 @@ def async_transcribe(audio_file_paths,
     speaker_count: Number of speakers. If 0, speaker diarization will be
       disabled.
     begin_sec: Transcript begin timestamp in seconds.
+    cache_dir: Directory of the ASR result cache. If empty or None, caching is
+      disabled. On a cache hit, the audio is not uploaded.
   """
   tmp_audio_file = tempfile.mktemp(suffix=".flac")
   print("Temporary audio file: %s" % tmp_audio_file)
   audio_duration_s = concatenate_audio_files(
       audio_file_paths, tmp_audio_file, fill_gaps=fill_gaps)
+  # concatenate_audio_files() writes a .wav copy alongside the .flac file.
+  tmp_wav_file = str(pathlib.PurePath(tmp_audio_file).with_suffix(".wav"))
+
+  enable_speaker_diarization = speaker_count > 0
+  config = speech.RecognitionConfig(
+      encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+      sample_rate_hertz=sample_rate,
+      language_code=language_code,
+      enable_speaker_diarization=enable_speaker_diarization,
+      diarization_speaker_count=speaker_count)
+  # The key is computed from the deterministic .wav copy rather than from the
+  # .flac file, whose bytes may depend on the encoder version.
+  cache_key = get_asr_cache_key_for_files([tmp_wav_file], config)
+  os.remove(tmp_wav_file)
+  cached = load_cached_asr_result(cache_dir, cache_key)
+  if cached is not None:
+    os.remove(tmp_audio_file)
+    utterances, diarized_words = cached
+  else:
+    utterances, diarized_words = _async_recognize(
+        tmp_audio_file, audio_duration_s, bucket_name, config)
+    save_asr_result_to_cache(cache_dir, cache_key, utterances, diarized_words)
+
+  write_utterances_to_tsv(
+      output_tsv_path, utterances, diarized_words, begin_sec=begin_sec)
+
+
+def _async_recognize(tmp_audio_file, audio_duration_s, bucket_name, config):
+  """Uploads an audio file to GCS and runs async recognition on it.
+
+  The audio file and the GCS object are deleted afterwards.
 
+  Returns:
+    utterances: A list of transcripts as strings.
+    words: A list of (word, speaker_index, start_time, end_time) tuples.
+  """
   to_delete_bucket = False
   if not bucket_name:
     bucket_name = gcloud_utils.create_temp_gcs_bucket(
         AUDIO_UPLOAD_BUCKET_NAME_PREFIX)
     to_delete_bucket = True
 
-  storage_client = storage.Client()
+  storage_client = gcloud_utils.get_storage_client()
   bucket = storage_client.bucket(bucket_name)
   destination_blob_name = os.path.basename(tmp_audio_file)
   blob = bucket.blob(destination_blob_name)
@@ -558,16 +1108,8 @@ def async_transcribe(audio_file_paths,
   gcs_uri = "gs://%s/%s" % (bucket_name, destination_blob_name)
   print("Uploaded to GCS URI: %s" % gcs_uri)
 
-  client = speech.SpeechClient()
+  client = get_speech_client()
   audio = speech.RecognitionAudio(uri=gcs_uri)
-  enable_speaker_diarization = speaker_count > 0
-  config = speech.RecognitionConfig(
-      encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
-      sample_rate_hertz=sample_rate,
-      language_code=language_code,
-      enable_speaker_diarization=enable_speaker_diarization,
-      diarization_speaker_count=speaker_count)
-
   operation = client.long_running_recognize(config=config, audio=audio)
   timeout_s = int(audio_duration_s * 0.25)
   print(
@@ -581,6 +1123,7 @@ def async_transcribe(audio_file_paths,
     gcloud_utils.delete_gcs_bucket(bucket_name)
 
   utterances = []
+  diarized_words = []
   for result in response.results:
     # The first alternative is the most likely one for this portion.
     alt = result.alternatives[0]
@@ -589,42 +1132,43 @@ def async_transcribe(audio_file_paths,
     diarized_words = [(
         word.word, word.speaker_tag, word.start_time.total_seconds(),
         word.end_time.total_seconds()) for word in alt.words]
-
-  with open(output_tsv_path, "w" if not begin_sec else "a") as f:
-    if not begin_sec:
-      # Write the TSV header.
-      f.write(tsv_data.HEADER + "\n")
-    if not utterances:
-      print("ASR produced no recognized speech utterances. "
-            "Generated empty asr.tsv file.")
-      return
-    regrouped_utterances = regroup_utterances(utterances, diarized_words)
-    utterance_counter = 0
-    for (regrouped_utterance,
-        speaker_index, start_time_sec, end_time_sec) in regrouped_utterances:
-      utterance_counter += 1
-      line = "%.3f\t%.3f\t%s\t%s %s [Speaker #%d]" % (
-          start_time_sec + begin_sec,
-          end_time_sec + begin_sec,
-          tsv_data.SPEECH_TRANSCRIPT_TIER,
-          regrouped_utterance,
-          transcript_lib.get_utterance_id(utterance_counter),
-          speaker_index)
-      print(line)
-      f.write(line + "\n")
-
-
-if __name__ == "__main__":
-  args = parse_args()
-  if args.fill_gaps:
-    if not args.use_async:
-      raise ValueError("--fill_gaps is supported only under --use_async")
+  return utterances, diarized_words
+
+
+def transcribe_to_tsv(first_audio_path,
+                      output_tsv_path,
+                      sample_rate=16000,
+                      language_code="en-US",
+                      speaker_count=0,
+                      use_async=False,
+                      bucket_name="sf_test_audio_uploads",
+                      fill_gaps=False,
+                      concurrent_chunks=False,
+                      max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                      cache_dir=DEFAULT_ASR_CACHE_DIR,
+                      skip_silence=False):
+  """Transcribes a series of consecutive audio files into a .tsv file.
+
+  This is the library equivalent of running this module as a binary. See
+  parse_args() for the meaning of the arguments.
+  """
+  if use_async and concurrent_chunks:
+    raise ValueError(
+        "--use_async and --concurrent_chunks are mutually exclusive")
+  if skip_silence and not concurrent_chunks:
+    raise ValueError(
+        "--skip_silence is supported only under --concurrent_chunks")
+  if fill_gaps:
+    if not (use_async or concurrent_chunks):
+      raise ValueError(
+          "--fill_gaps is supported only under --use_async or "
+          "--concurrent_chunks")
     # Gaps will be filled. Just use a large enough tolerance.
     tolerance_seconds = 24.0 * 3600
   else:
     tolerance_seconds = 1.0
   path_groups, group_durations_sec = get_consecutive_audio_file_paths(
-      args.first_audio_path, tolerance_seconds=tolerance_seconds)
+      first_audio_path, tolerance_seconds=tolerance_seconds)
   num_audio_files = sum(len(group) for group in path_groups)
   total_duration_sec = sum(group_durations_sec)
   print("Transcribing %d consecutive audio files (%f seconds):\n\t%s" % (
@@ -632,35 +1176,69 @@ if __name__ == "__main__":
       total_duration_sec,
       "\n\t".join([",".join(group) for group in path_groups])))
   cum_duration_sec = 0.0
-  if args.use_async:
+  if concurrent_chunks:
+    audio_file_paths = []
+    for path_group in path_groups:
+      audio_file_paths.extend(path_group)
+    concurrent_chunked_transcribe(
+        audio_file_paths,
+        output_tsv_path,
+        sample_rate,
+        language_code,
+        speaker_count=speaker_count,
+        fill_gaps=fill_gaps,
+        max_concurrent_requests=max_concurrent_requests,
+        cache_dir=cache_dir,
+        skip_silence=skip_silence)
+  elif use_async:
     audio_file_paths = []
     for path_group in path_groups:
       audio_file_paths.extend(path_group)
     async_transcribe(
         audio_file_paths,
-        args.bucket_name,
-        args.output_tsv_path,
-        args.sample_rate,
-        args.language_code,
-        speaker_count=args.speaker_count,
+        bucket_name,
+        output_tsv_path,
+        sample_rate,
+        language_code,
+        speaker_count=speaker_count,
         begin_sec=cum_duration_sec,
-        fill_gaps=args.fill_gaps)
+        fill_gaps=fill_gaps,
+        cache_dir=cache_dir)
   else:
     for audio_file_paths, group_duration_sec in zip(
           path_groups, group_durations_sec):
-      if args.speaker_count > 0:
+      if speaker_count > 0:
         transcribe_audio_to_tsv_with_diarization(
             audio_file_paths,
-            args.output_tsv_path,
-            args.sample_rate,
-            args.language_code,
-            args.speaker_count,
-            begin_sec=cum_duration_sec)
+            output_tsv_path,
+            sample_rate,
+            language_code,
+            speaker_count,
+            begin_sec=cum_duration_sec,
+            cache_dir=cache_dir)
       else:
         transcribe_audio_to_tsv(
           audio_file_paths,
-          args.output_tsv_path,
-          args.sample_rate,
-          args.language_code,
-          begin_sec=cum_duration_sec)
+          output_tsv_path,
+          sample_rate,
+          language_code,
+          begin_sec=cum_duration_sec,
+          cache_dir=cache_dir)
       cum_duration_sec += group_duration_sec
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  transcribe_to_tsv(
+      args.first_audio_path,
+      args.output_tsv_path,
+      sample_rate=args.sample_rate,
+      language_code=args.language_code,
+      speaker_count=args.speaker_count,
+      use_async=args.use_async,
+      bucket_name=args.bucket_name,
+      fill_gaps=args.fill_gaps,
+      concurrent_chunks=args.concurrent_chunks,
+      max_concurrent_requests=args.max_concurrent_requests,
+      cache_dir=args.asr_cache_dir,
+      skip_silence=args.skip_silence)
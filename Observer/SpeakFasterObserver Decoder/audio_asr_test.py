@@ -3,7 +3,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import concurrent.futures
 import os
+from unittest import mock
 
 from google.cloud import speech_v1p1beta1 as speech
 import numpy as np
@@ -11,6 +13,7 @@ from scipy.io import wavfile
 import tensorflow as tf
 
 import audio_asr
+import tsv_data
 
 
 class GetAudioFileDurationSecTest(tf.test.TestCase):
@@ -21,6 +24,33 @@ class GetAudioFileDurationSecTest(tf.test.TestCase):
     self.assertAllClose(audio_asr.get_audio_file_duration_sec(wav_path), 1.5)
 
 
+class MakeSilentAudioSegmentTest(tf.test.TestCase):
+
+  def testMonoSixteenBit(self):
+    audio_seg = audio_asr.make_silent_audio_segment(16000, 0.5)
+    self.assertEqual(audio_seg.frame_count(), 8000)
+    self.assertEqual(audio_seg.channels, 1)
+    self.assertEqual(audio_seg.sample_width, 2)
+    self.assertEqual(audio_seg.frame_rate, 16000)
+    self.assertEqual(audio_seg.max, 0)
+
+  def testStereoThirtyTwoBit(self):
+    audio_seg = audio_asr.make_silent_audio_segment(
+        44100, 2.0, sample_width=4, num_channels=2)
+    self.assertEqual(audio_seg.frame_count(), 88200)
+    self.assertEqual(audio_seg.channels, 2)
+    self.assertEqual(audio_seg.sample_width, 4)
+    self.assertLen(audio_seg.raw_data, 88200 * 2 * 4)
+
+  def testCreateAllZerosWavFile_stereo(self):
+    wav_path = os.path.join(self.get_temp_dir(), "zeros.wav")
+    audio_asr.create_all_zeros_wav_file(
+        wav_path, 16000, 1.5, sample_width=2, num_channels=2)
+    fs, xs = wavfile.read(wav_path)
+    self.assertEqual(fs, 16000)
+    self.assertAllEqual(xs, np.zeros([24000, 2], dtype=np.int16))
+
+
 class ConcatenateAudioFilesTest(tf.test.TestCase):
 
   def testEmptyPathsRaisesValueError(self):
@@ -222,6 +252,16 @@ class LoadAudioDataTest(tf.test.TestCase):
         language_code="en-US"))
     self.assertLen(buffer, 16000 * 2)
 
+  def testLoadAudioData_higherSampleRate_downsamples(self):
+    audio_path = os.path.join(self.get_temp_dir(), "a1.wav")
+    wavfile.write(audio_path, 48000, np.zeros(48000 * 1, dtype=np.int16))
+    buffer = audio_asr.load_audio_data(audio_path, speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=16000,
+        audio_channel_count=1,
+        language_code="en-US"))
+    self.assertLen(buffer, 16000 * 2)
+
   def testLoadAudioData_incorrecSampleRate_raiseValueError(self):
     audio_path = os.path.join(self.get_temp_dir(), "a1.wav")
     wavfile.write(audio_path, 16000, np.zeros(16000 * 1, dtype=np.int16))
@@ -250,6 +290,169 @@ class AudioDataGeneratorTest(tf.test.TestCase):
     self.assertLen(list(generator), 2)
 
 
+class FindSilenceSplitPointsTest(tf.test.TestCase):
+
+  def testShortAudioIsNotSplit(self):
+    xs = np.ones(16000 * 10, dtype=np.int16)
+    split_points = audio_asr.find_silence_split_points(
+        xs, 16000, max_chunk_sec=20, search_window_sec=5)
+    self.assertEqual(split_points, [0, 16000 * 10])
+
+  def testSplitsAtSilence(self):
+    xs = 1000 * np.ones(16000 * 30, dtype=np.int16)
+    # Silence between 7.0 and 7.5 s, and between 15.0 and 15.5 s.
+    xs[16000 * 7:int(16000 * 7.5)] = 0
+    xs[16000 * 15:int(16000 * 15.5)] = 0
+    split_points = audio_asr.find_silence_split_points(
+        xs, 16000, max_chunk_sec=10, search_window_sec=5)
+    self.assertLen(split_points, 5)
+    self.assertEqual(split_points[0], 0)
+    self.assertBetween(split_points[1], 16000 * 7, 16000 * 7.5)
+    self.assertBetween(split_points[2], 16000 * 15, 16000 * 15.5)
+    self.assertEqual(split_points[-1], len(xs))
+    self.assertAllLessEqual(np.diff(split_points), 16000 * 10)
+
+  def testNoSilenceStillRespectsMaxChunkLength(self):
+    xs = np.random.randint(-1000, 1000, size=[16000 * 25]).astype(np.int16)
+    split_points = audio_asr.find_silence_split_points(
+        xs, 16000, max_chunk_sec=10, search_window_sec=2)
+    self.assertEqual(split_points[0], 0)
+    self.assertEqual(split_points[-1], len(xs))
+    self.assertAllGreater(np.diff(split_points), 0)
+    self.assertAllLessEqual(np.diff(split_points), 16000 * 10)
+
+  def testSearchWindowLongerThanMaxChunkRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"exceeds max chunk length"):
+      audio_asr.find_silence_split_points(
+          np.zeros(16000, dtype=np.int16), 16000,
+          max_chunk_sec=5, search_window_sec=10)
+
+
+class MergeChunkResultsTest(tf.test.TestCase):
+
+  def testShiftsWordTimestampsToSessionTime(self):
+    chunk_results = [
+        (["hello there"], [("hello", 1, 0.1, 0.2), ("there", 1, 0.3, 0.4)]),
+        (["how are you"], [
+            ("how", 2, 0.5, 0.6),
+            ("are", 2, 0.6, 0.7),
+            ("you", 2, 0.7, 0.8)]),
+    ]
+    utterances, words = audio_asr.merge_chunk_results(
+        chunk_results, [0.0, 10.0])
+    self.assertEqual(utterances, ["hello there", "how are you"])
+    self.assertEqual([word[:2] for word in words], [
+        ("hello", 1), ("there", 1), ("how", 2), ("are", 2), ("you", 2)])
+    self.assertAllClose([word[2] for word in words],
+                        [0.1, 0.3, 10.5, 10.6, 10.7])
+    self.assertAllClose([word[3] for word in words],
+                        [0.2, 0.4, 10.6, 10.7, 10.8])
+    self.assertEqual(
+        [item[0] for item in audio_asr.regroup_utterances(utterances, words)],
+        ["hello there", "how are you"])
+
+  def testMismatchInLengthsRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"Mismatch in the number"):
+      audio_asr.merge_chunk_results([([], [])], [0.0, 10.0])
+
+
+class AsrCacheTest(tf.test.TestCase):
+
+  def _makeConfig(self, speaker_count):
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=16000,
+        language_code="en-US",
+        enable_speaker_diarization=speaker_count > 0,
+        diarization_speaker_count=speaker_count)
+
+  def testCacheKeyDependsOnAudioAndConfig(self):
+    pcm_1 = np.zeros(1600, dtype=np.int16).tobytes()
+    pcm_2 = np.ones(1600, dtype=np.int16).tobytes()
+    key = audio_asr.get_asr_cache_key(pcm_1, self._makeConfig(2))
+    self.assertEqual(
+        audio_asr.get_asr_cache_key(pcm_1, self._makeConfig(2)), key)
+    self.assertNotEqual(
+        audio_asr.get_asr_cache_key(pcm_2, self._makeConfig(2)), key)
+    self.assertNotEqual(
+        audio_asr.get_asr_cache_key(pcm_1, self._makeConfig(3)), key)
+
+  def testSaveAndLoadCachedResult(self):
+    cache_dir = os.path.join(self.get_temp_dir(), "asr_cache")
+    key = audio_asr.get_asr_cache_key(b"\x00\x01", self._makeConfig(2))
+    self.assertIsNone(audio_asr.load_cached_asr_result(cache_dir, key))
+    audio_asr.save_asr_result_to_cache(
+        cache_dir, key, ["hello there"],
+        [("hello", 1, 0.1, 0.2), ("there", 2, 0.3, 0.4)])
+    utterances, words = audio_asr.load_cached_asr_result(cache_dir, key)
+    self.assertEqual(utterances, ["hello there"])
+    self.assertEqual(words, [("hello", 1, 0.1, 0.2), ("there", 2, 0.3, 0.4)])
+
+  def testCacheKeyForFilesDependsOnContentsBoundariesAndConfig(self):
+    paths = []
+    for i, contents in enumerate(
+        [b"\x00\x01", b"\x02", b"\x00", b"\x01\x02"]):
+      paths.append(os.path.join(self.get_temp_dir(), "audio_%d.wav" % i))
+      with open(paths[-1], "wb") as f:
+        f.write(contents)
+    key = audio_asr.get_asr_cache_key_for_files(
+        paths[:2], self._makeConfig(2))
+    self.assertEqual(
+        audio_asr.get_asr_cache_key_for_files(paths[:2], self._makeConfig(2)),
+        key)
+    self.assertNotEqual(
+        audio_asr.get_asr_cache_key_for_files(paths[2:], self._makeConfig(2)),
+        key)
+    self.assertNotEqual(
+        audio_asr.get_asr_cache_key_for_files(paths[:2], self._makeConfig(3)),
+        key)
+
+  def testStreamingTranscriptionUsesCachedResult(self):
+    cache_dir = os.path.join(self.get_temp_dir(), "streaming_asr_cache")
+    audio_path = os.path.join(self.get_temp_dir(), "streaming_audio.wav")
+    wavfile.write(audio_path, 16000, np.zeros(1600, dtype=np.int16))
+    tsv_path = os.path.join(self.get_temp_dir(), "streaming_asr.tsv")
+    streaming_config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=16000,
+            audio_channel_count=1,
+            language_code="en-US"),
+        interim_results=False)
+    key = audio_asr.get_asr_cache_key_for_files([audio_path], streaming_config)
+    audio_asr.save_asr_result_to_cache(
+        cache_dir, key, ["hello there"], [("hello there", 0, 1.5, 2.5)])
+    with mock.patch.object(
+        audio_asr, "get_speech_client", side_effect=AssertionError):
+      audio_asr.transcribe_audio_to_tsv(
+          [audio_path], tsv_path, 16000, "en-US", cache_dir=cache_dir)
+    with open(tsv_path, "r") as f:
+      lines = f.read().splitlines()
+    self.assertEqual(lines, [
+        tsv_data.HEADER,
+        "1.500\t2.500\t%s\thello there" % tsv_data.SPEECH_TRANSCRIPT_TIER])
+
+  def testConcurrentSavesOfSameKeyFromThreads(self):
+    cache_dir = os.path.join(self.get_temp_dir(), "concurrent_asr_cache")
+    key = audio_asr.get_asr_cache_key(b"\x00\x00", self._makeConfig(0))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      futures = [
+          executor.submit(
+              audio_asr.save_asr_result_to_cache, cache_dir, key, ["hi"],
+              [("hi", 1, 0.0, 0.5)])
+          for _ in range(64)]
+      for future in futures:
+        future.result()
+    self.assertEqual(os.listdir(cache_dir), [key + ".json"])
+    self.assertEqual(
+        audio_asr.load_cached_asr_result(cache_dir, key),
+        (["hi"], [("hi", 1, 0.0, 0.5)]))
+
+  def testEmptyCacheDirDisablesCaching(self):
+    audio_asr.save_asr_result_to_cache("", "abc", ["hi"], [("hi", 1, 0, 1)])
+    self.assertIsNone(audio_asr.load_cached_asr_result("", "abc"))
+
+
 class RegroupUtterancesTest(tf.test.TestCase):
 
   def testRegroupOneSpeakerTwoUtterances_notObeyingOriginalBoundary(self):
@@ -341,6 +544,41 @@ class RegroupUtterancesTest(tf.test.TestCase):
         ("no been sitting all day", 2, 0.8, 1.3),
         ("alright", 1, 1.5, 1.6)])
 
+  def testIterRegroupedUtterancesIsLazyAndMatchesList(self):
+    utterances = ["would you like to", "sit down"]
+    words = [
+        ("would", 1, 0.1, 0.2),
+        ("you", 1, 0.2, 0.3),
+        ("like", 1, 0.3, 0.4),
+        ("to", 1, 0.5, 0.6),
+        ("sit", 1, 1.6, 1.7),
+        ("down", 1, 1.7, 1.8)]
+    regrouped = audio_asr.iter_regrouped_utterances(
+        iter(utterances), iter(words))
+    self.assertEqual(next(regrouped), ("would you like to", 1, 0.1, 0.6))
+    self.assertEqual(list(regrouped), [("sit down", 1, 1.6, 1.8)])
+
+  def testEmptyUtteranceInBetweenIsSkipped(self):
+    utterances = ["would you", "", "sit down"]
+    words = [
+        ("would", 1, 0.1, 0.2),
+        ("you", 1, 0.2, 0.3),
+        ("sit", 1, 1.6, 1.7),
+        ("down", 1, 1.7, 1.8)]
+    regrouped = audio_asr.regroup_utterances(utterances, words)
+    self.assertEqual(regrouped, [
+        ("would you", 1, 0.1, 0.3),
+        ("sit down", 1, 1.6, 1.8)])
+
+  def testExtraWordsRaisesValueError(self):
+    utterances = ["would you"]
+    words = [
+        ("would", 1, 0.1, 0.2),
+        ("you", 1, 0.2, 0.3),
+        ("sit", 1, 0.3, 0.4)]
+    with self.assertRaisesRegex(ValueError, r"Mismatch in words"):
+      audio_asr.regroup_utterances(utterances, words)
+
   def testUnmatchedWordsRaisesValuError(self):
     utterances = ["would you like to", "sit down"]
     words = [
@@ -358,5 +596,55 @@ class RegroupUtterancesTest(tf.test.TestCase):
         audio_asr.regroup_utterances(utterances, words)
 
 
+
+class WriteUtterancesToTsvTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._tsv_path = os.path.join(self.get_temp_dir(), "asr.tsv")
+    if os.path.isfile(self._tsv_path):
+      os.remove(self._tsv_path)
+
+  def testWritesHeaderAndRegroupedUtterances(self):
+    audio_asr.write_utterances_to_tsv(
+        self._tsv_path, ["would you", "sit down"],
+        [("would", 1, 0.1, 0.2), ("you", 1, 0.2, 0.3),
+         ("sit", 2, 1.6, 1.7), ("down", 2, 1.7, 1.8)],
+        begin_sec=0.0)
+    with open(self._tsv_path, "r") as f:
+      lines = f.read().splitlines()
+    self.assertLen(lines, 3)
+    self.assertEqual(lines[0], tsv_data.HEADER)
+    self.assertTrue(lines[1].startswith("0.100\t0.300\t"))
+    self.assertTrue(lines[2].startswith("1.600\t1.800\t"))
+
+  def testMismatchInWordsRaisesValueErrorBeforeWriting(self):
+    with self.assertRaisesRegex(ValueError, r"Some words .* missing"):
+      audio_asr.write_utterances_to_tsv(
+          self._tsv_path, ["would you", "sit down"],
+          [("would", 1, 0.1, 0.2), ("you", 2, 0.2, 0.3)])
+    self.assertFalse(os.path.isfile(self._tsv_path))
+
+  def testMismatchInWordsDoesNotAppendToExistingFile(self):
+    with open(self._tsv_path, "w") as f:
+      f.write(tsv_data.HEADER + "\n")
+    with self.assertRaisesRegex(ValueError, r"Mismatch in words"):
+      audio_asr.write_utterances_to_tsv(
+          self._tsv_path, ["would you"],
+          [("would", 1, 0.1, 0.2), ("thou", 2, 0.2, 0.3)], begin_sec=10.0)
+    with open(self._tsv_path, "r") as f:
+      self.assertEqual(f.read(), tsv_data.HEADER + "\n")
+
+
+class TranscribeToTsvTest(tf.test.TestCase):
+
+  def testSkipSilenceWithoutConcurrentChunksRaisesValueError(self):
+    with self.assertRaisesRegex(
+        ValueError, r"--skip_silence is supported only under"):
+      audio_asr.transcribe_to_tsv(
+          "/tmp/audio.wav", "/tmp/asr.tsv", 16000, "en-US", 0,
+          skip_silence=True)
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -3,55 +3,38 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import concurrent.futures
 import csv
+import functools
+import multiprocessing
 import os
-import tempfile
-from urllib import request
 
 import numpy as np
 import tensorflow as tf
 
-YAMNET_URL = 'https://storage.googleapis.com/tfhub-lite-models/google/lite-model/yamnet/tflite/1.tflite'
-YAMNET_CLASS_MAP_URL = "https://raw.githubusercontent.com/tensorflow/models/master/research/audioset/yamnet/yamnet_class_map.csv"
-LOCAL_YAMNET_FILENAME = "lite-model_yamnet_tflite_1.tflite"
+import model_assets
+
+YAMNET_URL = model_assets.REGISTRY[model_assets.YAMNET_TFLITE].url
+YAMNET_CLASS_MAP_URL = model_assets.REGISTRY[model_assets.YAMNET_CLASS_MAP].url
+LOCAL_YAMNET_FILENAME = model_assets.REGISTRY[
+    model_assets.YAMNET_TFLITE].filename
 
 YAMNET_IGNORE_CLASS_NAMES = ("Silence",)
 
 
 def maybe_download_yamnet_tflite():
-  """Downloads YAMNet tflite file to temp dir if it's not there."""
-  yamnet_tflite_path = _get_local_yamnet_yamnet_path()
-  if os.path.isfile(yamnet_tflite_path):
-    return yamnet_tflite_path
-  print(
-      "Downloading TFLite file for audio event classification from %s..." %
-      YAMNET_URL)
-  tflite_bytes = request.urlopen(YAMNET_URL).read()
-  with open(yamnet_tflite_path, "wb") as f:
-    f.write(tflite_bytes)
-  return yamnet_tflite_path
-
-
-def _get_local_yamnet_yamnet_path():
-  return os.path.join(tempfile.gettempdir(), LOCAL_YAMNET_FILENAME)
+  """Downloads YAMNet tflite file to the model cache if it's not there."""
+  return model_assets.get_model_path(model_assets.YAMNET_TFLITE)
 
 
 def maybe_download_yamnet_class_map():
-  """Downloads YAMNet class map CSV file to temp dir if it's not there."""
-  yamnet_class_map_path = _get_local_yamnet_class_map_path()
-  if os.path.isfile(yamnet_class_map_path):
-    return yamnet_class_map_path
-  print("Downloading YAMNet class map from %s..." % YAMNET_CLASS_MAP_URL)
-  class_map_bytes = request.urlopen(YAMNET_CLASS_MAP_URL).read()
-  with open(yamnet_class_map_path, "w") as f:
-    f.write(class_map_bytes.decode("utf-8"))
-  return yamnet_class_map_path
-
-
-def _get_local_yamnet_class_map_path():
-  return os.path.join(tempfile.gettempdir(), os.path.basename(YAMNET_CLASS_MAP_URL))
+  """Downloads YAMNet class map CSV file to the model cache if it's not there.
+  """
+  return model_assets.get_model_path(model_assets.YAMNET_CLASS_MAP)
 
 
+@functools.lru_cache(maxsize=None)
 def get_yamnet_class_names():
   """Returns list of YAMnet class names as a tuple of strings."""
   local_csv_path = maybe_download_yamnet_class_map()
@@ -64,9 +47,104 @@ def get_yamnet_class_names():
 
 
 YAMNET_FS = 16000  # Required sampling rate by YAMNet.
+# Hop between consecutive YAMNet output frames, in samples (0.48 s).
+YAMNET_FRAME_HOP_LENGTH = 7680
+YAMNET_FRAME_HOP_SEC = YAMNET_FRAME_HOP_LENGTH / YAMNET_FS
+# Length of the window of each YAMNet output frame, in samples (0.96 s).
+YAMNET_FRAME_WINDOW_LENGTH = 2 * YAMNET_FRAME_HOP_LENGTH
+# Number of output frames computed per model invocation by
+# extract_frame_scores().
+DEFAULT_FRAMES_PER_CHUNK = 60
+# Number of waveform chunks sent to a worker process at a time in
+# extract_audio_events_parallel().
+DEFAULT_PARALLEL_BATCH_SIZE = 60
+
+
+def get_num_yamnet_frames(num_samples):
+  """Returns the number of YAMNet output frames for a waveform's length.
+
+  YAMNet pads the waveform to a whole number of hops after the first window,
+  so the last frame may extend past the end of the waveform by less than a
+  hop.
+  """
+  return 1 + -(-max(0, num_samples - YAMNET_FRAME_WINDOW_LENGTH) //
+               YAMNET_FRAME_HOP_LENGTH)
+
+
+class YamnetClassifier(object):
+  """YAMNet TFLite interpreter with tensors allocated for a fixed input size.
+
+  Inputs shorter than the fixed size are zero-padded, so that the interpreter
+  does not need to be resized and reallocated for every input. The input size
+  never changes, so that instances can be cached by it.
+  """
+
+  def __init__(self, input_length=YAMNET_FS, num_threads=None):
+    """Constructor of YamnetClassifier.
+
+    Args:
+      input_length: The fixed input length, in samples.
+      num_threads: Number of threads used by the TFLite interpreter. If None,
+        the TFLite default is used.
+    """
+    self._class_names = get_yamnet_class_names()
+    self._interpreter = tf.lite.Interpreter(
+        maybe_download_yamnet_tflite(), num_threads=num_threads)
+    self._waveform_input_index = (
+        self._interpreter.get_input_details()[0]["index"])
+    self._scores_output_index = (
+        self._interpreter.get_output_details()[0]["index"])
+    self._interpreter.resize_tensor_input(
+        self._waveform_input_index, [input_length], strict=True)
+    self._interpreter.allocate_tensors()
+    self._input_length = input_length
+
+  @property
+  def class_names(self):
+    return self._class_names
+
+  @property
+  def input_length(self):
+    return self._input_length
 
+  def get_frame_scores(self, xs, num_frames=None):
+    """Computes the per-frame class scores of a waveform.
 
-def extract_audio_events(generator, fs, threshold_score=0.25):
+    Args:
+      xs: Mono waveform as a float32 numpy array in the [-1, 1] range. Must
+        not be longer than the fixed input length.
+      num_frames: Number of frames to return. Defaults to the number of frames
+        for the waveform without the zero padding (see
+        get_num_yamnet_frames()), so that the padding does not add frames.
+
+    Returns:
+      A float32 numpy array of shape [num_frames, num_classes].
+    """
+    num_samples = len(xs)
+    if num_samples > self._input_length:
+      raise ValueError(
+          "Waveform of %d samples is longer than the input length %d" %
+          (num_samples, self._input_length))
+    if num_samples < self._input_length:
+      xs = np.pad(xs, [0, self._input_length - num_samples])
+    self._interpreter.set_tensor(self._waveform_input_index, xs)
+    self._interpreter.invoke()
+    scores = self._interpreter.get_tensor(self._scores_output_index)
+    if num_frames is None:
+      num_frames = get_num_yamnet_frames(num_samples)
+    return scores[:num_frames]
+
+
+@functools.lru_cache(maxsize=None)
+def get_yamnet_classifier(input_length=YAMNET_FS, num_threads=None):
+  """Returns a cached YamnetClassifier for the input length and threads."""
+  return YamnetClassifier(input_length=input_length, num_threads=num_threads)
+
+
+def extract_audio_events(generator,
+                         fs,
+                         threshold_score=0.25,
+                         num_threads=None):
   """Extracts audio event labels using YAMNet model.
 
   See https://tfhub.dev/google/lite-model/yamnet/tflite/1 for more details about
@@ -79,6 +157,7 @@ def extract_audio_events(generator, fs, threshold_score=0.25):
     threshold_score: Threshold for the model output score. The score
       for a deteted class must be >= this value to be included in the return
       value.
+    num_threads: Number of threads used by the TFLite interpreter.
 
   Returns:
     A list of lists. The length of the outer list is equal to the number
@@ -91,13 +170,7 @@ def extract_audio_events(generator, fs, threshold_score=0.25):
     raise ValueError(
         "Required audio sample rate is %d Hz, got %s" % (YAMNET_FS, fs))
 
-  class_names = get_yamnet_class_names()
-  interpreter = tf.lite.Interpreter(maybe_download_yamnet_tflite())
-  input_details = interpreter.get_input_details()
-  waveform_input_index = input_details[0]['index']
-  output_details = interpreter.get_output_details()
-  scores_output_index = output_details[0]['index']
-
+  classifier = None
   output = []
   for xs in generator():
     if not isinstance(xs, np.ndarray):
@@ -109,18 +182,191 @@ def extract_audio_events(generator, fs, threshold_score=0.25):
       xs = xs.astype(np.float32) / 32768
     else:
       raise ValueError("Got unsupported ndarray dtype")
-    interpreter.resize_tensor_input(waveform_input_index,
-                                    [len(xs)], strict=True)
-    interpreter.allocate_tensors()
-    interpreter.set_tensor(waveform_input_index, xs)
-    interpreter.invoke()
-    scores = interpreter.get_tensor(scores_output_index)
-    scores = np.mean(scores, axis=0)
+    if classifier is None or len(xs) > classifier.input_length:
+      # The length of the first chunk is used as the fixed input length, so
+      # that only a shorter last chunk needs to be padded. A longer chunk gets
+      # a classifier of its own length.
+      classifier = get_yamnet_classifier(
+          input_length=len(xs), num_threads=num_threads)
+    scores = np.mean(classifier.get_frame_scores(xs), axis=0)
     supra_thresh_indices = np.where(scores > threshold_score)[0]
     segment_output = []
     for i in supra_thresh_indices:
-      segment_output.append((class_names[i], scores[i]))
+      segment_output.append((classifier.class_names[i], scores[i]))
     output.append(segment_output)
   return output
 
 
+def _extract_audio_events_from_chunks(chunks, fs, threshold_score, num_threads):
+  """Runs extract_audio_events() on a list of chunks in a worker process.
+
+  The worker loads its YAMNet interpreter through get_yamnet_classifier(), so
+  that the interpreter is created once per worker process and never inherited
+  from the parent process.
+  """
+  return extract_audio_events(
+      lambda: iter(chunks), fs,
+      threshold_score=threshold_score, num_threads=num_threads)
+
+
+def _iter_batches(iterable, batch_size):
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def extract_audio_events_parallel(generator,
+                                  fs,
+                                  threshold_score=0.25,
+                                  num_workers=None,
+                                  batch_size=DEFAULT_PARALLEL_BATCH_SIZE,
+                                  num_threads=1):
+  """Parallel version of extract_audio_events() using worker processes.
+
+  The chunks yielded by the generator are sent in batches to worker
+  processes, each of which loads its own YAMNet interpreter. The workers are
+  spawned rather than forked, because forking a process that has already
+  imported TensorFlow (and may be running its threads) can deadlock. The
+  results are merged in the order of the chunks. At most 2 * num_workers
+  batches are in flight at any time, so that memory usage does not grow with
+  the length of the audio.
+
+  Args:
+    generator: A Python generator that yields mono audio in chunks. See
+      extract_audio_events().
+    fs: The sampling rate. Currently this must be 16000 Hz.
+    threshold_score: Threshold for the model output score.
+    num_workers: Number of worker processes. Defaults to the number of CPUs.
+    batch_size: Number of chunks sent to a worker process at a time.
+    num_threads: Number of threads used by the TFLite interpreter in each
+      worker process.
+
+  Returns:
+    Same as extract_audio_events().
+  """
+  if fs != YAMNET_FS:
+    raise ValueError(
+        "Required audio sample rate is %d Hz, got %s" % (YAMNET_FS, fs))
+  num_workers = num_workers or os.cpu_count()
+  output = []
+  pending = collections.deque()
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=num_workers,
+      mp_context=multiprocessing.get_context("spawn")) as executor:
+    for chunks in _iter_batches(generator(), batch_size):
+      pending.append(executor.submit(
+          _extract_audio_events_from_chunks,
+          chunks, fs, threshold_score, num_threads))
+      if len(pending) >= 2 * num_workers:
+        output.extend(pending.popleft().result())
+    while pending:
+      output.extend(pending.popleft().result())
+  return output
+
+
+def _iter_frame_aligned_chunks(blocks, frames_per_chunk):
+  """Re-chunks waveform blocks into overlapping, frame-aligned chunks.
+
+  Yields:
+    (chunk, num_frames) tuples. The first num_frames YAMNet frames of each
+      chunk are consecutive frames on the global frame grid; the windows of
+      all but the last of them lie entirely in the chunk.
+  """
+  hop_length = frames_per_chunk * YAMNET_FRAME_HOP_LENGTH
+  chunk_length = (
+      hop_length + YAMNET_FRAME_WINDOW_LENGTH - YAMNET_FRAME_HOP_LENGTH)
+  buffer = None
+  for block in blocks:
+    buffer = block if buffer is None else np.concatenate([buffer, block])
+    start = 0
+    while start + chunk_length <= len(buffer):
+      yield buffer[start:start + chunk_length], frames_per_chunk
+      start += hop_length
+    buffer = buffer[start:]
+  if buffer is not None and len(buffer):
+    yield buffer, -(-len(buffer) // YAMNET_FRAME_HOP_LENGTH)
+
+
+def extract_frame_scores(generator,
+                         fs,
+                         num_threads=None,
+                         frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK):
+  """Computes the YAMNet class scores of every output frame (0.48-s hop).
+
+  Unlike extract_audio_events(), the scores are not averaged per chunk, so
+  labels at any coarser resolution or threshold can be derived from them
+  later (see pool_frame_scores() and events.find_intervals()) without
+  running the model again.
+
+  Args:
+    generator: A Python generator that yields consecutive, non-overlapping
+      blocks of mono audio of any lengths (e.g.,
+      WaveformSource.iter_blocks). The blocks must be numpy ndarrays of dtype
+      float32 or int16.
+    fs: The sampling rate. Currently this must be 16000 Hz.
+    num_threads: Number of threads used by the TFLite interpreter.
+    frames_per_chunk: Number of output frames computed per model invocation.
+
+  Returns:
+    A float32 numpy array of shape [num_frames, num_classes], wherein frame i
+      begins at i * YAMNET_FRAME_HOP_SEC seconds.
+  """
+  if fs != YAMNET_FS:
+    raise ValueError(
+        "Required audio sample rate is %d Hz, got %s" % (YAMNET_FS, fs))
+  classifier = None
+  all_scores = []
+  for xs, num_frames in _iter_frame_aligned_chunks(
+      generator(), frames_per_chunk):
+    if xs.dtype == np.int16:
+      xs = xs.astype(np.float32) / 32768
+    elif xs.dtype != np.float32:
+      raise ValueError("Got unsupported ndarray dtype")
+    if classifier is None:
+      classifier = get_yamnet_classifier(
+          input_length=(
+              frames_per_chunk * YAMNET_FRAME_HOP_LENGTH +
+              YAMNET_FRAME_WINDOW_LENGTH - YAMNET_FRAME_HOP_LENGTH),
+          num_threads=num_threads)
+    all_scores.append(classifier.get_frame_scores(xs, num_frames=num_frames))
+  if not all_scores:
+    return np.zeros([0, len(get_yamnet_class_names())], dtype=np.float32)
+  return np.concatenate(all_scores).astype(np.float32)
+
+
+def pool_frame_scores(scores, pool_size):
+  """Averages the scores of every pool_size consecutive frames.
+
+  Args:
+    scores: A [num_frames, num_classes] numpy array, e.g., as returned by
+      extract_frame_scores().
+    pool_size: Number of frames per output step. A trailing partial group is
+      averaged over the frames it contains.
+
+  Returns:
+    A float32 numpy array of shape [ceil(num_frames / pool_size),
+      num_classes].
+  """
+  num_frames, num_classes = scores.shape
+  num_steps = -(-num_frames // pool_size)
+  padded = np.zeros([num_steps * pool_size, num_classes], dtype=np.float32)
+  padded[:num_frames] = scores
+  sums = np.sum(padded.reshape([num_steps, pool_size, num_classes]), axis=1)
+  counts = np.minimum(
+      pool_size, num_frames - np.arange(num_steps) * pool_size)
+  return sums / counts[:, None]
+
+
+def save_frame_scores(npy_path, scores, dtype=np.float16):
+  """Saves frame scores to a .npy file, by default compactly as float16."""
+  np.save(npy_path, scores.astype(dtype))
+
+
+def load_frame_scores(npy_path):
+  """Loads frame scores saved by save_frame_scores() as float32."""
+  return np.load(npy_path).astype(np.float32)
@@ -4,40 +4,43 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import tempfile
 import unittest
+from unittest import mock
 
 import numpy as np
 import tensorflow as tf
 
 import audio_events
+import model_assets
 
 
 class AudioEventsTest(tf.test.TestCase):
 
+  def _setModelCacheDir(self, cache_dir):
+    patcher = mock.patch.dict(
+        os.environ, {model_assets.MODEL_CACHE_DIR_ENV_VAR: cache_dir})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
   def testMaybeDownloadYamnetTfliteFile(self):
+    self._setModelCacheDir(self.get_temp_dir())
     local_tflite_path = os.path.join(
-        tempfile.gettempdir(), audio_events.LOCAL_YAMNET_FILENAME)
+        self.get_temp_dir(), audio_events.LOCAL_YAMNET_FILENAME)
     if os.path.isfile(local_tflite_path):
       os.remove(local_tflite_path)
     local_path = audio_events.maybe_download_yamnet_tflite()
-    self.assertEqual(
-        local_path,
-        os.path.join(tempfile.gettempdir(), audio_events.LOCAL_YAMNET_FILENAME))
+    self.assertEqual(local_path, local_tflite_path)
     self.assertTrue(os.path.isfile(local_path))
 
   def testMaybeDownloadYamnetClassMapCsvFile(self):
+    self._setModelCacheDir(self.get_temp_dir())
     local_class_map_path = os.path.join(
-        tempfile.gettempdir(),
+        self.get_temp_dir(),
         os.path.basename(audio_events.YAMNET_CLASS_MAP_URL))
     if os.path.isfile(local_class_map_path):
       os.remove(local_class_map_path)
     local_path = audio_events.maybe_download_yamnet_class_map()
-    self.assertEqual(
-        local_path,
-        os.path.join(
-            tempfile.gettempdir(),
-            os.path.basename(audio_events.YAMNET_CLASS_MAP_URL)))
+    self.assertEqual(local_path, local_class_map_path)
     self.assertTrue(os.path.isfile(local_path))
 
   def testGetYamnetClassMap(self):
@@ -67,6 +70,62 @@ class AudioEventsTest(tf.test.TestCase):
     # White noise gets recognized as Waterfall or Spray.
     self.assertTrue("Waterfall" in seg_1_class_names or "Spray" in seg_1_class_names)
 
+  def testYamnetClassifierIsCachedAndPadsShortInput(self):
+    classifier = audio_events.get_yamnet_classifier(
+        input_length=16000, num_threads=1)
+    self.assertIs(
+        audio_events.get_yamnet_classifier(input_length=16000, num_threads=1),
+        classifier)
+    self.assertLen(classifier.class_names, 521)
+    scores = classifier.get_frame_scores(
+        np.random.normal(0, 0.1, size=[8000]).astype(np.float32))
+    self.assertEqual(scores.shape[1], 521)
+    self.assertEqual(classifier.input_length, 16000)
+
+  def testYamnetClassifier_doesNotResizeCachedInstance(self):
+    classifier = audio_events.get_yamnet_classifier(
+        input_length=16000, num_threads=1)
+    with self.assertRaisesRegex(ValueError, "longer than the input length"):
+      classifier.get_frame_scores(np.zeros([24000], dtype=np.float32))
+    self.assertEqual(classifier.input_length, 16000)
+
+  def testYamnetClassifier_paddingDoesNotAddFrames(self):
+    xs = np.random.normal(0, 0.1, size=[16000]).astype(np.float32)
+    unpadded_scores = audio_events.get_yamnet_classifier(
+        input_length=16000, num_threads=1).get_frame_scores(xs)
+    padded_scores = audio_events.get_yamnet_classifier(
+        input_length=48000, num_threads=1).get_frame_scores(xs)
+    self.assertEqual(unpadded_scores.shape, (2, 521))
+    self.assertAllClose(padded_scores, unpadded_scores, atol=1e-5)
+
+  def testExtractAudioEvents_shortLastChunk(self):
+    def noise_waveform_generator():
+      yield np.random.normal(0, 0.1, size=[16000]).astype(np.float32)
+      yield np.random.normal(0, 0.1, size=[4000]).astype(np.float32)
+    output = audio_events.extract_audio_events(
+        noise_waveform_generator, fs=16000, threshold_score=0.25,
+        num_threads=2)
+    self.assertLen(output, 2)
+    for item in output[1]:
+      self.assertGreaterEqual(item[1], 0.25)
+
+  def testExtractAudioEventsParallel_matchesSerial(self):
+    chunks = [np.random.normal(0, 0.1, size=[16000]).astype(np.float32)
+              for _ in range(5)]
+    serial_output = audio_events.extract_audio_events(
+        lambda: iter(chunks), fs=16000, threshold_score=0.25)
+    parallel_output = audio_events.extract_audio_events_parallel(
+        lambda: iter(chunks), fs=16000, threshold_score=0.25,
+        num_workers=2, batch_size=2)
+    self.assertLen(parallel_output, 5)
+    for serial_items, parallel_items in zip(serial_output, parallel_output):
+      self.assertEqual([item[0] for item in serial_items],
+                       [item[0] for item in parallel_items])
+
+  def testExtractAudioEventsParallel_incorrectSampleRateLeadsToError(self):
+    with self.assertRaisesRegex(ValueError, r"sample rate.*18000"):
+      audio_events.extract_audio_events_parallel(lambda: iter([]), fs=18000)
+
   def testIncorrectSampleRateLeadsToError(self):
     def dummy_generator():
       return
@@ -74,5 +133,85 @@ class AudioEventsTest(tf.test.TestCase):
       output = audio_events.extract_audio_events(dummy_generator, fs=18000)
 
 
+class _FakeYamnetClassifier(object):
+  """Scores each frame by the mean of its 0.96-s window of samples."""
+
+  def __init__(self, input_length):
+    self.input_length = input_length
+
+  def get_frame_scores(self, xs, num_frames=None):
+    num_samples = len(xs)
+    xs = np.pad(xs, [0, self.input_length - num_samples])
+    hop = audio_events.YAMNET_FRAME_HOP_LENGTH
+    if num_frames is None:
+      num_frames = audio_events.get_num_yamnet_frames(num_samples)
+    return np.array(
+        [[np.mean(xs[i * hop:i * hop + 2 * hop])] for i in range(num_frames)],
+        dtype=np.float32)
+
+
+class ExtractFrameScoresTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(
+        audio_events, "get_yamnet_classifier",
+        lambda input_length, num_threads: _FakeYamnetClassifier(input_length))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testFramesAreOnGlobalGridAcrossChunks(self):
+    hop = audio_events.YAMNET_FRAME_HOP_LENGTH
+    xs = np.random.RandomState(0).uniform(
+        -1, 1, size=[hop * 11 + 123]).astype(np.float32)
+    blocks = [xs[:1000], xs[1000:50000], xs[50000:]]
+    scores = audio_events.extract_frame_scores(
+        lambda: iter(blocks), 16000, frames_per_chunk=3)
+    self.assertEqual(scores.dtype, np.float32)
+    self.assertEqual(scores.shape, (12, 1))
+    padded = np.pad(xs, [0, 2 * hop])
+    expected = [np.mean(padded[i * hop:i * hop + 2 * hop]) for i in range(12)]
+    self.assertAllClose(scores[:, 0], expected, atol=1e-6)
+
+  def testShortInputAndInt16(self):
+    scores = audio_events.extract_frame_scores(
+        lambda: iter([np.full([8000], 16384, dtype=np.int16)]), 16000)
+    self.assertEqual(scores.shape, (2, 1))
+    self.assertAllClose(scores[0], [0.5 * 8000 / 15360])
+
+  def testIncorrectSampleRateLeadsToError(self):
+    with self.assertRaisesRegex(ValueError, r"16000 Hz"):
+      audio_events.extract_frame_scores(lambda: iter([]), 44100)
+
+
+class GetNumYamnetFramesTest(tf.test.TestCase):
+
+  def testNumFrames(self):
+    hop = audio_events.YAMNET_FRAME_HOP_LENGTH
+    self.assertEqual(audio_events.get_num_yamnet_frames(0), 1)
+    self.assertEqual(audio_events.get_num_yamnet_frames(4000), 1)
+    self.assertEqual(audio_events.get_num_yamnet_frames(2 * hop), 1)
+    self.assertEqual(audio_events.get_num_yamnet_frames(2 * hop + 1), 2)
+    self.assertEqual(audio_events.get_num_yamnet_frames(16000), 2)
+    self.assertEqual(audio_events.get_num_yamnet_frames(5 * hop), 4)
+
+
+class FrameScoresUtilsTest(tf.test.TestCase):
+
+  def testPoolFrameScores(self):
+    scores = np.array([[0.0, 1.0], [1.0, 1.0], [0.5, 0.0]], dtype=np.float32)
+    pooled = audio_events.pool_frame_scores(scores, 2)
+    self.assertAllClose(pooled, [[0.5, 1.0], [0.5, 0.0]])
+
+  def testSaveAndLoadFrameScores(self):
+    npy_path = os.path.join(self.get_temp_dir(), "scores.npy")
+    scores = np.array([[0.125, 0.9]], dtype=np.float32)
+    audio_events.save_frame_scores(npy_path, scores)
+    self.assertEqual(np.load(npy_path).dtype, np.float16)
+    loaded = audio_events.load_frame_scores(npy_path)
+    self.assertEqual(loaded.dtype, np.float32)
+    self.assertAllClose(loaded, scores, atol=1e-3)
+
+
 if __name__ == "__main__":
   tf.test.main() # run all tests
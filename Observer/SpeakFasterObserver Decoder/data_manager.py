@@ -30,12 +30,14 @@ import boto3
 import numpy as np
 import PySimpleGUI as sg
 
+import elan_format_raw
 import elan_process_curated
 import file_naming
 import freeform_text
 import gcloud_utils
 import metadata_pb2
 import process_keypresses
+import stages
 import transcript_lib
 
 DEFAULT_PROFILE_NAME = "spo"
@@ -571,12 +573,18 @@ class DataManager(object):
 
   def preprocess_session(self, session_prefix):
     to_run_preproc = True
+    force_all_stages = False
     if self.get_local_session_folder_status(session_prefix) in (
         STATE_PREPROCESSED, STATE_CURATED, STATE_POSTPROCESSED):
       answer = sg.popup_yes_no(
           "Session %s has already been preprocessed locally. "
           "Do you want to run preprocessing again?" % session_prefix)
       to_run_preproc = answer == "Yes"
+      if to_run_preproc:
+        answer = sg.popup_yes_no(
+            "Redo all preprocessing stages from scratch? Choose No to "
+            "rerun only the stages whose inputs have changed.")
+        force_all_stages = answer == "Yes"
     if not to_run_preproc:
       return "Preprocessing was not run.", False
 
@@ -584,8 +592,16 @@ class DataManager(object):
     (_, readable_timezone_name,
      _, _, _, _, _, _) = self.get_session_details(session_prefix)
     timezone = _get_timezone(readable_timezone_name)
-    command_args = ["python", "elan_format_raw.py", local_dest_dir, timezone]
-    self._run_command_line(command_args)
+    # Preprocessing runs in this process, so that the models and clients
+    # loaded for one session are reused by the next. Stages that completed in
+    # an earlier (e.g., failed) run are skipped, unless they are forced.
+    print("Preprocessing session %s at %s" % (session_prefix, local_dest_dir))
+    elan_format_raw.format_raw_data(
+        local_dest_dir,
+        timezone,
+        elan_format_raw.DEFAULT_SPEAKER_COUNT,
+        "",
+        force_stages=[stages.FORCE_ALL_STAGES] if force_all_stages else None)
     message = "Preprocessing complete."
     print(message)
     return message, "session"
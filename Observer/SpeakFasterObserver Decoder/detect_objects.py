@@ -7,6 +7,9 @@ import argparse
 import csv
 import glob
 
+import numpy as np
+
+import model_assets
 import object_detection
 import events as events_lib
 import tsv_data
@@ -20,42 +23,76 @@ parser.add_argument(
     "--frame_rate",
     default=None,
     type=float,
-    help="Frame rate of the images from the glob pattern. "
-    "Required if --input_image_glob is specified.")
+    help="Frame rate of the images from the glob pattern. If not provided, "
+    "the timestamps of the images are parsed from their file names (e.g., "
+    "20210710T095258428-Screenshot.jpg).")
 parser.add_argument(
     "--input_video_path",
     help="Path to input video file (e.g., mp4). "
     "Mutually exclusive with --input_image_glob")
 parser.add_argument(
     "--output_tsv_path", help="Path to output tsv file")
+parser.add_argument(
+    "--model_cache_dir",
+    type=str,
+    default=None,
+    help="Directory in which downloaded models are cached. See "
+    "model_assets.py for pre-warming the cache for offline use.")
+parser.add_argument(
+    "--change_threshold",
+    type=float,
+    default=None,
+    help="If provided, frames that differ from the last detected frame by "
+    "less than this mean absolute difference (of downsampled grayscale "
+    "frames, in [0, 1]) reuse its detections instead of being run through "
+    "the detector, e.g., 0.01 for series of screenshots.")
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=1,
+    help="Number of frames run through the detector at a time. Values "
+    "greater than 1 require a detector that supports batched input.")
 
 
 def main():
   args = parser.parse_args()
+  if args.model_cache_dir:
+    model_assets.set_model_cache_dir(args.model_cache_dir)
   print("50")
   if args.input_image_glob:
     if args.input_video_path:
       raise ValueError(
           "--input_image_glob and --input_video_path are mutually exclusive")
-    if args.frame_rate is None:
-      raise ValueError(
-          "When --input_image_glob is provided, --frame_rate must be provided")
     frame_generator = object_detection.read_images(
         args.input_image_glob, frame_rate=args.frame_rate)
-    timestep_s = 1.0 / args.frame_rate
+    timestep_s = 1.0 / args.frame_rate if args.frame_rate else None
   else:
     if not args.input_video_path:
       raise ValueError(
           "One of --input_image_glob and --input_video_path must be provided")
     frame_generator = object_detection.read_video_file(args.input_video_path)
     timestep_s = 1.0 / object_detection.get_video_fps(args.input_video_path)
-      # TODO(cais): Support variable frame rate in video file.
-  events = object_detection.detect_objects(frame_generator)
+  # Record the true timestamps of the frames, which need not be evenly spaced
+  # (e.g., for the variable-frame-rate screenshot videos).
+  timestamps = []
+  def record_timestamps(frame_generator):
+    for image_tensor, timestamp in frame_generator:
+      timestamps.append(timestamp)
+      yield image_tensor, timestamp
+  events = object_detection.detect_objects(
+      record_timestamps(frame_generator),
+      change_threshold=args.change_threshold,
+      batch_size=args.batch_size)
+  if timestep_s is None:
+    # The last frame is assumed to last as long as a typical frame.
+    timestep_s = (
+        float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 1.0)
 
   tsv_rows = events_lib.convert_events_to_tsv_rows(
       events,
       tsv_data.VISUAL_OBJECTS_EVENTS_TIER,
-      timestep_s=timestep_s)
+      timestep_s=timestep_s,
+      timestamps=timestamps)
   with open(args.output_tsv_path, mode="w") as f:
     tsv_writer = csv.writer(f, delimiter="\t")
     tsv_writer.writerow(tsv_data.COLUMN_HEADS)
@@ -1,22 +1,29 @@
 """Format raw data for ELAN curation."""
 
 import argparse
+import concurrent.futures
 import glob
+import multiprocessing
 import os
 import pathlib
-import subprocess
 
 import ffmpeg
 import numpy as np
 import pytz
+from scipy.io import wavfile
 
 import audio_asr
+import audio_events
+import extract_audio_events as extract_audio_events_lib
 import file_naming
-import keypresses_pb2
 import process_keypresses
+import stages
 import tsv_data
 import video
 
+# Default number of speakers in the audio, for ASR and speaker diarization.
+DEFAULT_SPEAKER_COUNT = 2
+
 
 def format_raw_data(input_dir,
                     timezone,
@@ -24,9 +31,17 @@ def format_raw_data(input_dir,
                     gcs_bucket_name,
                     dummy_video_frame_image_path=None,
                     skip_screenshots=False,
-                    keypresses_only=False):
+                    keypresses_only=False,
+                    max_parallel_stages=None,
+                    force_stages=None):
   """Processes a raw Observer data session.
 
+  The processing is divided into stages (see get_raw_data_stages()), which
+  are run concurrently where their inputs allow. A stage is skipped if its
+  outputs are up to date with its inputs and parameters since it last
+  succeeded, so that rerunning after a failure (e.g., a transient ASR error)
+  only repeats the failed and the remaining stages.
+
   Args:
     input_dir: The path to the data directory of the session. At a minimum,
       it should contains: exactly one keypress protobuf file, a set of
@@ -41,11 +56,73 @@ def format_raw_data(input_dir,
       duration of the audio files. This must be provided if there are not
       screenshot image files in input_dir.
     skip_screenshots: Skip the processing of screenshots.
+    keypresses_only: Process only the keypresses.
+    max_parallel_stages: Maximum number of stages that run at the same time.
+      Defaults to no limit.
+    force_stages: Names of stages to run even if they are up to date, or
+      stages.FORCE_ALL_STAGES.
+  """
+  stages.run_stages(
+      get_raw_data_stages(
+          input_dir,
+          timezone,
+          speaker_count,
+          gcs_bucket_name,
+          dummy_video_frame_image_path=dummy_video_frame_image_path,
+          skip_screenshots=skip_screenshots,
+          keypresses_only=keypresses_only),
+      max_workers=max_parallel_stages,
+      manifest_dir=os.path.join(
+          input_dir, file_naming.STAGE_MANIFESTS_DIRNAME),
+      force_stages=force_stages)
+  merged_tsv_path = os.path.join(input_dir, file_naming.MERGED_TSV_FILENAME)
+  if keypresses_only:
+    print("Merged TSV file (keypresses-only) is at: %s" % merged_tsv_path)
+    return
+  print("Concatenated audio file is at: %s" % os.path.join(
+      input_dir, file_naming.CONCATENATED_AUDIO_FILENAME))
+  screenshots_video_path = os.path.join(
+      input_dir, file_naming.SCREENSHOTS_MP4_FILENAME)
+  if not skip_screenshots:
+    print("Screenshot video file is at: %s" % screenshots_video_path)
+  print("Merged TSV file is at: %s" % merged_tsv_path)
+
+
+def get_raw_data_stages(input_dir,
+                        timezone,
+                        speaker_count,
+                        gcs_bucket_name,
+                        dummy_video_frame_image_path=None,
+                        skip_screenshots=False,
+                        keypresses_only=False):
+  """Gets the stages for processing a raw Observer data session.
+
+  The stages communicate only through the files in input_dir. Their
+  dependencies are:
+    audio files -> concatenated audio -> audio events
+    audio files -> ASR
+    keypresses -> keypresses TSV -> text editor navigation TSV
+    screenshots -> screenshots video
+    all TSV files -> merged TSV
+  The dummy video (used when there are no screenshots) also depends on the
+  concatenated audio, for its duration.
+
+  Args:
+    See format_raw_data().
+
+  Returns:
+    A list of stages.Stage objects.
   """
   if not os.path.isdir(input_dir):
     raise ValueError("%s is not an existing directory" % input_dir)
 
   merged_tsv_path = os.path.join(input_dir, file_naming.MERGED_TSV_FILENAME)
+  keypresses_paths = sorted(
+      glob.glob(os.path.join(input_dir, "*-Keypresses.protobuf")))
+  if not keypresses_paths:
+    raise ValueError(
+        "Cannot find at least one Keypresses protobuf file in %s" % input_dir)
+  keypresses_tsv_path = os.path.join(input_dir, "keypresses.tsv")
 
   if keypresses_only:
     # Keypresses-only: The start timestamp will be from the first keypress.
@@ -59,93 +136,142 @@ def format_raw_data(input_dir,
     print("Determined start timestamp: %.3f" % start_time_epoch)
     keypresses_phrases_tsv_path = os.path.join(
         input_dir, "keypresses_phrases.tsv")
-    process_keypresses.visualize_keypresses(
-        keypresses_data, tsv_path=keypresses_phrases_tsv_path,
-        start_time_epoch=start_time_epoch)
-  else:
-    # Not keypresses-only: The start timestamp will be extracted from the first
-    # audio file.
-    (first_audio_path,
-     concatenated_audio_path,
-     start_time_epoch,
-     audio_duration_s) = read_and_concatenate_audio_files(input_dir, timezone)
-
-  keypresses_paths = glob.glob(os.path.join(input_dir, "*-Keypresses.protobuf"))
-  if not keypresses_paths:
-    raise ValueError(
-        "Cannot find at least one Keypresses protobuf file in %s" % input_dir)
-  keypresses_tsv_path = os.path.join(input_dir, "keypresses.tsv")
-  first_keypress_time_sec = format_keypresses(
-      keypresses_paths, start_time_epoch, keypresses_tsv_path)
+    return [
+        stages.Stage(
+            "keypresses",
+            lambda: format_keypresses(
+                keypresses_paths, start_time_epoch, keypresses_tsv_path),
+            keypresses_paths,
+            [keypresses_tsv_path],
+            {"start_time_epoch": start_time_epoch}),
+        stages.Stage(
+            "keypress_phrases",
+            lambda: process_keypresses.visualize_keypresses(
+                keypresses_data, tsv_path=keypresses_phrases_tsv_path,
+                start_time_epoch=start_time_epoch),
+            keypresses_paths,
+            [keypresses_phrases_tsv_path],
+            {"start_time_epoch": start_time_epoch}),
+        stages.Stage(
+            "merge",
+            lambda: tsv_data.merge_tsv_files(
+                [keypresses_tsv_path, keypresses_phrases_tsv_path],
+                merged_tsv_path),
+            [keypresses_tsv_path, keypresses_phrases_tsv_path],
+            [merged_tsv_path]),
+    ]
+
+  # Not keypresses-only: The start timestamp is that of the first audio file.
+  all_audio_paths = get_audio_file_paths(input_dir)
+  first_audio_path = all_audio_paths[0]
+  audio_start_time, start_time_epoch = get_epoch_time_from_file_path(
+      first_audio_path, timezone)
+  print("Audio data start time: %s (%s)" %
+        (audio_start_time, start_time_epoch))
+  concatenated_audio_path = os.path.join(
+      input_dir, file_naming.CONCATENATED_AUDIO_FILENAME)
 
-  if keypresses_only:
-    print("Merging TSV files (keypresses-only)...")
-    tsv_data.merge_tsv_files(
-        [keypresses_tsv_path, keypresses_phrases_tsv_path], merged_tsv_path)
-    print("Merged TSV file (keypresses-only) is at: %s" % merged_tsv_path)
-    return
+  text_editor_navigation_tsv_path = os.path.join(
+      input_dir, "text_editor_navigation.tsv")
+  audio_events_tsv_path = os.path.join(input_dir, "audio_events.tsv")
+  asr_tsv_path = os.path.join(input_dir, file_naming.ASR_TSV_FILENAME)
+  tsv_paths = [keypresses_tsv_path, text_editor_navigation_tsv_path,
+               audio_events_tsv_path, asr_tsv_path]
+  raw_data_stages = [
+      stages.Stage(
+          "concatenate_audio",
+          lambda: audio_asr.concatenate_audio_files(
+              all_audio_paths, concatenated_audio_path, fill_gaps=True),
+          all_audio_paths,
+          [concatenated_audio_path]),
+      stages.Stage(
+          "keypresses",
+          lambda: format_keypresses(
+              keypresses_paths, start_time_epoch, keypresses_tsv_path),
+          keypresses_paths,
+          [keypresses_tsv_path],
+          {"start_time_epoch": start_time_epoch}),
+      # Create a TSV file for TextEditorNavigation tier.
+      stages.Stage(
+          "text_editor_navigation",
+          lambda: create_text_editor_nagivation_tier(
+              text_editor_navigation_tsv_path,
+              read_first_keypress_time_sec(keypresses_tsv_path)),
+          [keypresses_tsv_path],
+          [text_editor_navigation_tsv_path]),
+      stages.Stage(
+          "audio_events",
+          lambda: extract_audio_events(
+              concatenated_audio_path, audio_events_tsv_path),
+          [concatenated_audio_path],
+          [audio_events_tsv_path]),
+      # The ASR reads the original audio files.
+      stages.Stage(
+          "asr",
+          lambda: run_asr(
+              first_audio_path, asr_tsv_path, speaker_count,
+              gcs_bucket_name),
+          all_audio_paths,
+          [asr_tsv_path],
+          {"speaker_count": speaker_count}),
+      stages.Stage(
+          "merge",
+          lambda: tsv_data.merge_tsv_files(tsv_paths, merged_tsv_path),
+          tsv_paths,
+          [merged_tsv_path]),
+  ]
 
   if not skip_screenshots:
     # If screenshot image files are available, stitch them into a single video
     # file.
     screenshot_paths = sorted(
         glob.glob(os.path.join(input_dir, "*-Screenshot.jpg")))
+    screenshots_video_path = os.path.join(
+        input_dir, file_naming.SCREENSHOTS_MP4_FILENAME)
     if screenshot_paths:
-      screenshots_video_path = os.path.join(
-          input_dir, file_naming.SCREENSHOTS_MP4_FILENAME)
-      print("Writing screenshots video...")
-      video.stitch_images_into_mp4(
+      raw_data_stages.append(stages.Stage(
+          "screenshots_video",
+          lambda: write_screenshots_video(
+              screenshot_paths, start_time_epoch, timezone,
+              screenshots_video_path),
           screenshot_paths,
-          start_time_epoch,
-          timezone,
-          screenshots_video_path)
-      print("Saved screenshots video to %s\n" % screenshots_video_path)
+          [screenshots_video_path],
+          {"start_time_epoch": start_time_epoch, "timezone": timezone}))
     elif dummy_video_frame_image_path:
-      dummy_video_path = os.path.join(
-          input_dir, file_naming.SCREENSHOTS_MP4_FILENAME)
-      print("Generating dummy video (duration: %.3f s) based on %s..." %
-          (audio_duration_s, dummy_video_frame_image_path))
-      video.make_dummy_video_file(
-          audio_duration_s, dummy_video_frame_image_path, dummy_video_path)
-      print("Dummy video is generated at: %s" % dummy_video_path)
+      # The path is passed to ffmpeg as a glob pattern, so the stage depends
+      # on the files it matches rather than on the pattern itself.
+      dummy_video_frame_paths = sorted(glob.glob(dummy_video_frame_image_path))
+      if not dummy_video_frame_paths:
+        raise ValueError(
+            "No image files match dummy_video_frame_image_path: %s" %
+            dummy_video_frame_image_path)
+      raw_data_stages.append(stages.Stage(
+          "dummy_video",
+          lambda: write_dummy_video(
+              concatenated_audio_path, dummy_video_frame_image_path,
+              screenshots_video_path),
+          [concatenated_audio_path] + dummy_video_frame_paths,
+          [screenshots_video_path]))
     else:
       raise ValueError(
           "No screenshot image files are found. "
           "You must provide dummy_video_frame_image_path")
+  return raw_data_stages
 
-  # Create a TSV file for TextEditorNavigation tier.
-  text_editor_navigation_tsv_path = os.path.join(
-      input_dir, "text_editor_navigation.tsv")
-  create_text_editor_nagivation_tier(
-      text_editor_navigation_tsv_path, first_keypress_time_sec)
 
-  # Extract audio events.
-  audio_events_tsv_path = os.path.join(input_dir, "audio_events.tsv")
-  extract_audio_events(concatenated_audio_path, audio_events_tsv_path)
-
-  # Perform ASR on audio.
-  asr_tsv_path = os.path.join(input_dir, file_naming.ASR_TSV_FILENAME)
-  run_asr(first_audio_path, asr_tsv_path, speaker_count, gcs_bucket_name)
-
-  # Merge the files.
-  print("Merging TSV files...")
-  tsv_data.merge_tsv_files(
-      [keypresses_tsv_path, text_editor_navigation_tsv_path,
-       audio_events_tsv_path, asr_tsv_path], merged_tsv_path)
-  print("Concatenated audio file is at: %s" % concatenated_audio_path)
-  if not skip_screenshots and screenshot_paths:
-    print("Screenshot video file is at: %s" % screenshots_video_path)
-  print("Merged TSV file is at: %s" % merged_tsv_path)
-
-
-def read_and_concatenate_audio_files(input_dir, timezone):
-  if not glob.glob(os.path.join(input_dir, "*-MicWaveIn.flac")):
+def get_audio_file_paths(input_dir):
+  all_audio_paths = sorted(
+      glob.glob(os.path.join(input_dir, "*-MicWaveIn.flac")))
+  if not all_audio_paths:
     raise ValueError(
         "Cannot find any *-MicWaveIn.flac audio files in directory %s. "
         "Make sure you are pointing to a valid data directory." % input_dir)
-  all_audio_paths = sorted(
-      glob.glob(os.path.join(input_dir, "*-MicWaveIn.flac")))
   print("Found %s audio file: %s" % (len(all_audio_paths), all_audio_paths))
+  return all_audio_paths
+
+
+def read_and_concatenate_audio_files(input_dir, timezone):
+  all_audio_paths = get_audio_file_paths(input_dir)
   first_audio_path = all_audio_paths[0]
   audio_start_time, audio_start_time_epoch = get_epoch_time_from_file_path(
       first_audio_path, timezone)
@@ -193,32 +319,43 @@ def format_keypresses(keypresses_paths,
     ValueError, if there are no keypresses.
   """
   first_keypress_time_sec = None
+  num_keypresses = 0
   with open(output_tsv_path, "w") as f:
     f.write(tsv_data.HEADER + "\n")
     for keypresses_path in keypresses_paths:
-      keypresses = keypresses_pb2.KeyPresses()
-      with open(keypresses_path, "rb") as file:
-        keypresses.ParseFromString(file.read())
-      num_keypresses = len(keypresses.keyPresses)
-      first_keypress_epoch_ms = (
-          keypresses.keyPresses[0].Timestamp.ToMilliseconds())
+      timestamps_ns, keys = process_keypresses.load_keypress_columns(
+          keypresses_path)
+      if not keys:
+        print("Found no keypresses in file %s" % keypresses_path)
+        continue
+      # Truncate to milliseconds, like Timestamp.ToMilliseconds().
+      epoch_times = timestamps_ns // 1000000 / 1e3
       print("First keypress epoch time in file %s: %.3f" %
-            (keypresses_path, first_keypress_epoch_ms / 1e3))
-      for keypress in keypresses.keyPresses:
-        relative_time = (keypress.Timestamp.ToMilliseconds() / 1e3
-                         - start_epoch_time)
-        if first_keypress_time_sec is None:
-          first_keypress_time_sec = relative_time
-        f.write("%.3f\t%.3f\t%s\t%s\n" % (
-            relative_time, relative_time + DUMMY_KEYPRESS_DURATION_SEC,
-            tsv_data.KEYPRESS_TIER, keypress.KeyPress))
-  print("Saved data for %d keypresses to %s" % (
-      len(keypresses.keyPresses), output_tsv_path))
-  if first_keypress_epoch_ms is None:
+            (keypresses_path, epoch_times[0]))
+      relative_times = epoch_times - start_epoch_time
+      if first_keypress_time_sec is None:
+        first_keypress_time_sec = float(relative_times[0])
+      tsv_data.write_rows(
+          f, relative_times, relative_times + DUMMY_KEYPRESS_DURATION_SEC,
+          tsv_data.KEYPRESS_TIER, keys)
+      num_keypresses += len(keys)
+  if first_keypress_time_sec is None:
     raise ValueError("Found no keypress data at paths: %s" % keypresses_paths)
+  print("Saved data for %d keypresses to %s" % (
+      num_keypresses, output_tsv_path))
   return first_keypress_time_sec
 
 
+def read_first_keypress_time_sec(keypresses_tsv_path):
+  """Reads the start time of the first keypress from a keypresses TSV file."""
+  with open(keypresses_tsv_path, "r") as f:
+    f.readline()
+    line = f.readline()
+  if not line:
+    raise ValueError("Found no keypresses in %s" % keypresses_tsv_path)
+  return float(line.split(tsv_data.DELIMITER, 1)[0])
+
+
 def create_text_editor_nagivation_tier(tsv_path, first_keypress_time_sec):
   """Create a TSV file with the TextEditorNavigation tier and only one event."""
   with open(tsv_path, "w") as f:
@@ -230,6 +367,32 @@ def create_text_editor_nagivation_tier(tsv_path, first_keypress_time_sec):
          "FirstKeyStroke")))
 
 
+def write_screenshots_video(screenshot_paths,
+                            start_time_epoch,
+                            timezone,
+                            screenshots_video_path):
+  print("Writing screenshots video...")
+  video.stitch_images_into_mp4(
+      screenshot_paths,
+      start_time_epoch,
+      timezone,
+      screenshots_video_path)
+  print("Saved screenshots video to %s\n" % screenshots_video_path)
+
+
+def write_dummy_video(concatenated_audio_path,
+                      dummy_video_frame_image_path,
+                      dummy_video_path):
+  sample_rate, xs = wavfile.read(concatenated_audio_path, mmap=True)
+  audio_duration_s = len(xs) / sample_rate
+  del xs
+  print("Generating dummy video (duration: %.3f s) based on %s..." %
+      (audio_duration_s, dummy_video_frame_image_path))
+  video.make_dummy_video_file(
+      audio_duration_s, dummy_video_frame_image_path, dummy_video_path)
+  print("Dummy video is generated at: %s" % dummy_video_path)
+
+
 def extract_audio_events(concatenated_audio_path, output_tsv_path):
   pure_path = pathlib.PurePath(concatenated_audio_path)
   wav_path = (
@@ -238,11 +401,8 @@ def extract_audio_events(concatenated_audio_path, output_tsv_path):
       else pure_path.with_suffix(".wav"))
   if not os.path.isfile(wav_path):
     raise ValueError("Cannot find concated .wav file")
-  subprocess.check_call([
-      "python",
-      os.path.join(os.path.dirname(__file__), "extract_audio_events.py"),
-      wav_path,
-      output_tsv_path])
+  extract_audio_events_lib.extract_audio_events_to_tsv(
+      str(wav_path), output_tsv_path)
   print("Saved audio events to file: %s" % output_tsv_path)
 
 
@@ -250,22 +410,82 @@ def run_asr(first_audio_path,
             output_tsv_path,
             speaker_count,
             gcs_bucket_name):
-  subprocess.check_call([
-      "python",
-      os.path.join(os.path.dirname(__file__), "audio_asr.py"),
-      # Async mode gives slightly higher accuracy compared to streaming mode.
-      "--use_async",
-      "--fill_gaps",
-      "--speaker_count=%d" % speaker_count,
-      "--bucket_name=%s" % gcs_bucket_name,
+  audio_asr.transcribe_to_tsv(
       first_audio_path,
-      output_tsv_path])
+      output_tsv_path,
+      speaker_count=speaker_count,
+      # Async mode gives slightly higher accuracy compared to streaming mode.
+      use_async=True,
+      bucket_name=gcs_bucket_name,
+      fill_gaps=True)
+
+
+def warm_up():
+  """Loads the models used by the stages into this process.
+
+  Later calls in the same process (e.g., for other sessions) reuse them, as
+  well as the cloud clients created on first use.
+  """
+  try:
+    audio_events.get_yamnet_class_names()
+    audio_events.get_yamnet_classifier()
+  except Exception as e:  # pylint: disable=broad-except
+    # The models are loaded again (and the error raised) on first use.
+    print("Failed to warm up the models: %s" % e)
+
+
+class SessionWorkerPool(object):
+  """A pool of long-lived worker processes that format raw data sessions.
+
+  Each worker loads the models once and keeps them, along with the cloud
+  clients, for all the sessions that it processes. This saves the start-up
+  time of TensorFlow and the clients for every session in batch runs.
+  """
+
+  def __init__(self, num_workers=1):
+    """Constructor of SessionWorkerPool.
+
+    Args:
+      num_workers: Number of worker processes, i.e., the number of sessions
+        that are processed at the same time.
+    """
+    # Fresh (spawned) processes avoid forking a process that has already
+    # initialized TensorFlow.
+    self._executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=warm_up)
+
+  def submit(self, input_dir, timezone, speaker_count, gcs_bucket_name,
+             **kwargs):
+    """Schedules format_raw_data() for a session.
+
+    Args:
+      See format_raw_data().
+
+    Returns:
+      A concurrent.futures.Future for the result.
+    """
+    return self._executor.submit(
+        format_raw_data, input_dir, timezone, speaker_count, gcs_bucket_name,
+        **kwargs)
+
+  def shutdown(self):
+    self._executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown()
 
 
 def parse_args():
   parser = argparse.ArgumentParser()
   parser.add_argument(
-      "input_dir", help="Input directory path")
+      "input_dir",
+      help="Input directory path. Separate the directories of multiple "
+      "sessions with commas.")
   parser.add_argument(
       "timezone",
       type=str,
@@ -274,7 +494,7 @@ def parse_args():
   parser.add_argument(
       "--speaker_count",
       type=int,
-      default=2,
+      default=DEFAULT_SPEAKER_COUNT,
       help="Number of speakers in the audio. Used for ASR and speaker "
       "diarization. A value of 0 disables the speaker diarization.")
   parser.add_argument(
@@ -298,19 +518,64 @@ def parse_args():
       type=str,
       default=None,
       help="Path to the frame of image used to make dummy videos.")
+  parser.add_argument(
+      "--max_parallel_stages",
+      type=int,
+      default=None,
+      help="Maximum number of processing stages (e.g., ASR, audio events and "
+      "screenshots video) that run at the same time. Defaults to no limit.")
+  parser.add_argument(
+      "--num_session_workers",
+      type=int,
+      default=1,
+      help="If multiple session directories are given, the number of worker "
+      "processes that process sessions at the same time. Each worker loads "
+      "the models once for all its sessions.")
+  parser.add_argument(
+      "--force_stage",
+      type=str,
+      action="append",
+      default=None,
+      help="Name of a processing stage to run even if its outputs are up to "
+      "date (e.g., asr, audio_events, screenshots_video), or \"%s\" for all "
+      "stages. Can be repeated." % stages.FORCE_ALL_STAGES)
   return parser.parse_args()
 
 
 def main():
   args = parse_args()
-  format_raw_data(
-      args.input_dir,
-      args.timezone,
-      args.speaker_count,
-      args.gcs_bucket_name,
+  kwargs = dict(
       dummy_video_frame_image_path=args.dummy_video_frame_image_path,
       skip_screenshots=args.skip_screenshots,
-      keypresses_only=args.keypresses_only)
+      keypresses_only=args.keypresses_only,
+      max_parallel_stages=args.max_parallel_stages,
+      force_stages=args.force_stage)
+  input_dirs = args.input_dir.split(",")
+  if len(input_dirs) == 1:
+    format_raw_data(
+        input_dirs[0],
+        args.timezone,
+        args.speaker_count,
+        args.gcs_bucket_name,
+        **kwargs)
+    return
+  with SessionWorkerPool(num_workers=args.num_session_workers) as pool:
+    futures = [
+        pool.submit(
+            input_dir, args.timezone, args.speaker_count,
+            args.gcs_bucket_name, **kwargs)
+        for input_dir in input_dirs]
+    failed_input_dirs = []
+    for input_dir, future in zip(input_dirs, futures):
+      try:
+        future.result()
+      except Exception as e:  # pylint: disable=broad-except
+        print("Failed to process session %s: %s" % (input_dir, e))
+        failed_input_dirs.append(input_dir)
+  if failed_input_dirs:
+    raise ValueError(
+        "Failed to process %d of %d sessions: %s" %
+        (len(failed_input_dirs), len(input_dirs), failed_input_dirs))
 
 
 if __name__ == "__main__":
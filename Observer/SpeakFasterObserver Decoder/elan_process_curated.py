@@ -152,39 +152,44 @@ def infer_columns(tsv_path):
           idx_column_tend, idx_column_tier, idx_column_content), False
 
 
-def load_rows(tsv_path, column_order, has_header=False):
+def load_rows(tsv_path, column_order, has_header=False, tiers=None):
   """Load the rows of the tsv file in ascending order of Begin.
 
-  Also checks tEnd >= tBegin for all rows.
+  Also checks tEnd >= tBegin for all rows, including the rows of tiers that
+  are not loaded. The parsed rows are cached in a sidecar file, so that
+  loading the same file again (e.g., merged.tsv for several checks) does not
+  parse it again.
 
   Args:
     tsv_path: Path to the input tsv file.
     column_order: Column indices for tBegin, tEnd, Tier, and Contents, as a
       tuple of integers.
     has_header: Whether the TSV file has a header row.
+    tiers: If not None, only the rows of these tiers are loaded.
 
   Returns:
     A list of rows, sorted in ascending order of tBegin. Each item of the list
       are a list of (tBegin, tEnd, tier, contents).
   """
-  col_tbegin, col_tend, col_tier, col_content = column_order
-  output_rows = []
-  with open(tsv_path, "r") as f:
-    reader = csv.reader(f, delimiter=tsv_data.DELIMITER)
-    if has_header:
-      next(reader)
-    for i, row in enumerate(reader):
-      items = [item for item in row if item]
-      tbegin = float(items[col_tbegin])
-      tend = float(items[col_tend])
-      tier = items[col_tier].strip()
-      content = items[col_content].strip()
-      if tend < tbegin:
-        raise ValueError(
-            "Line %d of %s has tBegin and tEnd out of order: %.3f < %.3f" %
-            (i + 1, tsv_path, tend, tbegin))
-      output_rows.append([tbegin, tend, tier, content])
-  return sorted(output_rows, key=lambda x: x[0])
+  table = tsv_data.read_tsv(
+      tsv_path, column_order=column_order, has_header=has_header,
+      ignore_empty_fields=True, use_cache=True)
+  out_of_order = np.flatnonzero(table.tends < table.tbegins)
+  if len(out_of_order):
+    i = out_of_order[0]
+    raise ValueError(
+        "Line %d of %s has tBegin and tEnd out of order: %.3f < %.3f" %
+        (table.row_numbers[i], tsv_path, table.tends[i], table.tbegins[i]))
+  if tiers is not None:
+    table = tsv_data.select_tiers(table, tiers)
+  tbegins = table.tbegins.tolist()
+  tends = table.tends.tolist()
+  tier_names = tsv_data.get_tiers(table)
+  contents = [content.strip() for content in table.contents]
+  if np.all(table.tbegins[1:] >= table.tbegins[:-1]):
+    return [list(row) for row in zip(tbegins, tends, tier_names, contents)]
+  return [[tbegins[i], tends[i], tier_names[i], contents[i]]
+          for i in np.argsort(table.tbegins, kind="stable").tolist()]
 
 
 def check_keypresses(merged_tsv_path, curated_rows):
@@ -207,7 +212,8 @@ def check_keypresses(merged_tsv_path, curated_rows):
   """
   column_order, has_header = infer_columns(merged_tsv_path)
   original_rows = load_rows(
-      merged_tsv_path, column_order, has_header=has_header)
+      merged_tsv_path, column_order, has_header=has_header,
+      tiers=(tsv_data.KEYPRESS_TIER,))
   original_keypress_rows = [(row[0], row[3]) for row in original_rows if
                             row[2] == tsv_data.KEYPRESS_TIER]
   curated_keypress_rows = [(row[0], row[3]) for row in curated_rows if
@@ -242,9 +248,8 @@ def calculate_speech_curation_stats(merged_tsv_path,
   """
   column_order, has_header = infer_columns(merged_tsv_path)
   original_rows = load_rows(
-      merged_tsv_path, column_order, has_header=has_header)
-  original_rows = [
-      row for row in original_rows if is_speech_content_tier(row[2])]
+      merged_tsv_path, column_order, has_header=has_header,
+      tiers=(tsv_data.KEYPRESS_PHRASE_TIER, tsv_data.SPEECH_TRANSCRIPT_TIER))
   curated_rows = [
       row for row in curated_rows if is_speech_content_tier(row[2])]
   stats = {
@@ -561,11 +566,10 @@ def get_misspelled_words(tsv_path):
   misspelled_words = set()
   column_order, has_header = infer_columns(tsv_path)
   rows = load_rows(
-      tsv_path, column_order, has_header=has_header)
+      tsv_path, column_order, has_header=has_header,
+      tiers=(tsv_data.SPEECH_TRANSCRIPT_TIER,))
   for row in rows:
     tbegin, tend, tier, content = row
-    if tier != tsv_data.SPEECH_TRANSCRIPT_TIER:
-      continue
     utterance = transcript_lib.extract_speech_content(content)
     words = nlp.tokenize(utterance)
     misspelled_words.update(spell_checker.unknown(words))
@@ -116,6 +116,25 @@ class LoadRowsTest(tf.test.TestCase):
       elan_process_curated.load_rows(
           tsv_path, column_order, has_header=has_header)
 
+  def testLoadRows_incorrectTBeginInOtherTierRaisesValueError(self):
+    tsv_path = os.path.join("testdata", "curated_with_wrong_tend.tsv")
+    column_order, has_header = elan_process_curated.infer_columns(tsv_path)
+    with self.assertRaisesRegex(
+        ValueError, r"Line 4.*tBegin.*tEnd.*order.*2\.900.*<.*3\.000"):
+      elan_process_curated.load_rows(
+          tsv_path, column_order, has_header=has_header,
+          tiers=("Keypress",))
+
+  def testLoadRows_selectsTiers(self):
+    tsv_path = os.path.join("testdata", "curated_1.tsv")
+    column_order, has_header = elan_process_curated.infer_columns(tsv_path)
+    rows = elan_process_curated.load_rows(
+        tsv_path, column_order, has_header=has_header,
+        tiers=("Keypress", "AudioEvents1"))
+    self.assertEqual(rows, [
+        [2.5, 2.6, 'Keypress', 'V'],
+        [3.0, 3.2, 'AudioEvents1', 'Doorbell']])
+
 
 class ApplySpeakerMapGetKeypressRedactionsTest(tf.test.TestCase):
 
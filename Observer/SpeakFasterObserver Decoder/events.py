@@ -3,48 +3,175 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
+
+
+def find_intervals(activity,
+                   threshold=None,
+                   off_threshold=None,
+                   min_duration_steps=1):
+  """Finds the intervals during which each class is active.
+
+  Args:
+    activity: A [num_steps, num_classes] numpy array. Either boolean (whether
+      each class is active at each step) or scores. It is not modified.
+    threshold: For scores, the score at or above which a class becomes
+      active. Required for scores and ignored for booleans.
+    off_threshold: For scores, the score below which an active class becomes
+      inactive (hysteresis). Must not exceed threshold. Defaults to threshold
+      (no hysteresis).
+    min_duration_steps: Intervals shorter than this number of steps are
+      dropped.
+
+  Returns:
+    class_indices: Class index of each interval, as a 1D int64 numpy array.
+    begin_steps: Begin step of each interval (inclusive), as a 1D int64 numpy
+      array.
+    end_steps: End step of each interval (exclusive), as a 1D int64 numpy
+      array.
+    The intervals are sorted by class index and then begin step.
+  """
+  if len(activity.shape) != 2:
+    raise ValueError(
+        "Expected activity to be 2D; got shape %s" % (activity.shape,))
+  if activity.dtype == np.bool_:
+    on = off = activity
+  else:
+    if threshold is None:
+      raise ValueError("threshold is required for score inputs")
+    if off_threshold is None:
+      off_threshold = threshold
+    if off_threshold > threshold:
+      raise ValueError(
+          "off_threshold (%s) must not exceed threshold (%s)" %
+          (off_threshold, threshold))
+    on = off = activity >= threshold
+    if off_threshold < threshold:
+      off = activity >= off_threshold
+  num_steps, _ = activity.shape
+  # Lay the classes out one after another, each followed by an inactive step,
+  # so that runs never span two classes.
+  stride = num_steps + 1
+  padded = np.zeros([activity.shape[1], stride], dtype=np.int8)
+  padded[:, :num_steps] = off.T
+  edges = np.diff(np.concatenate([[0], padded.ravel()]))
+  run_begins = np.flatnonzero(edges == 1)
+  run_ends = np.flatnonzero(edges == -1)
+  if on is not off:
+    # With hysteresis, an interval begins at the first step in a run of
+    # (off-threshold) activity that reaches the on threshold.
+    padded[:, :num_steps] = on.T
+    # The sentinel index is beyond all runs.
+    on_indices = np.append(np.flatnonzero(padded.ravel()), padded.size)
+    first_on_indices = on_indices[np.searchsorted(on_indices, run_begins)]
+    keep = first_on_indices < run_ends
+    run_begins = first_on_indices[keep]
+    run_ends = run_ends[keep]
+  keep = run_ends - run_begins >= min_duration_steps
+  run_begins = run_begins[keep]
+  run_ends = run_ends[keep]
+  class_indices = run_begins // stride
+  return (class_indices.astype(np.int64),
+          (run_begins - class_indices * stride).astype(np.int64),
+          (run_ends - class_indices * stride).astype(np.int64))
+
+
+def convert_intervals_to_tsv_rows(class_indices,
+                                  begin_steps,
+                                  end_steps,
+                                  class_names,
+                                  tier,
+                                  timestep_s=1.0,
+                                  ignore_class_names=None,
+                                  step_boundaries_s=None):
+  """Convert the return value of find_intervals() to tsv rows.
+
+  Args:
+    class_indices: Class indices of the intervals.
+    begin_steps: Begin steps of the intervals.
+    end_steps: End steps of the intervals.
+    class_names: Class names, indexed by class index.
+    tier: Name of the tier that the events belong to.
+    timestep_s: The timestep (in seconds) of each step. Ignored if
+      step_boundaries_s is provided.
+    ignore_class_names: A tuple, list or set of class names to ignore.
+    step_boundaries_s: Optional times (in seconds) of the boundaries of
+      non-uniform steps, as a 1D array of length num_steps + 1: step i spans
+      [step_boundaries_s[i], step_boundaries_s[i + 1]).
+
+  Returns:
+    TSV rows as a list of tuples: (tbegin, tend, tier, class_name), sorted by
+      tend, and for the same tend, by descending tbegin and class index.
+  """
+  if step_boundaries_s is None:
+    tbegins = begin_steps * timestep_s
+    tends = end_steps * timestep_s
+  else:
+    step_boundaries_s = np.asarray(step_boundaries_s, dtype=np.float64)
+    tbegins = step_boundaries_s[begin_steps]
+    tends = step_boundaries_s[end_steps]
+  order = np.lexsort((-class_indices, -begin_steps, end_steps))
+  rows = []
+  for i in order:
+    class_name = class_names[class_indices[i]]
+    if ignore_class_names and class_name in ignore_class_names:
+      continue
+    rows.append((float(tbegins[i]), float(tends[i]), tier, class_name))
+  return rows
+
 
 def convert_events_to_tsv_rows(events,
                                tier,
                                timestep_s=1.0,
-                               ignore_class_names=None):
+                               ignore_class_names=None,
+                               min_duration_steps=1,
+                               timestamps=None):
   """Convert the return value of extract_audio_events to tsv rows.
 
   Args:
     events: The audio event labels as a list of list of tuples. See the doc
-      string of extract_audio_events for details.
+      string of extract_audio_events for details. It is not modified.
     tier: Name of the tier that the events beyond to.
     timestep_s: The timestep (in seconds) that corresopnds to the labels list.
+      If timestamps is provided, this is used only as the duration of the
+      last step.
     ignore_class_names: A tuple, list or set of class names to ignore.
+    min_duration_steps: Events shorter than this number of timesteps are
+      dropped.
+    timestamps: Optional begin times (in seconds) of the steps, for steps of
+      non-uniform durations (e.g., frames of a variable-frame-rate video). Must
+      be of the same length as events and non-decreasing.
 
   Returns:
     TSV rows as a list of list of values: (tbegin, tend, tier, class_name),
       where tier is hardcoded to be AudioEvents.
   """
-  tbegin = 0
-  rows = []
-  active_classes_with_tbegins = []
-  # Add sentinel at the end.
-  events += [[]]
-  for step_events in events:
-    current_classes = [item[0] for item in step_events]
-    # Find deactivated labels and write them.
-    for i in range(len(active_classes_with_tbegins) - 1, -1, -1):
-      class_name, class_tbegin = active_classes_with_tbegins[i]
-      if ignore_class_names and class_name in ignore_class_names:
-        continue
-      if class_name not in current_classes:
-        rows.append((class_tbegin,
-                     tbegin,
-                     tier,
-                     class_name))
-        del active_classes_with_tbegins[i]
-    # Find newly active labels.
-    for single_label in step_events:
-      class_name, _  = single_label
-      if ignore_class_names and class_name in ignore_class_names:
-        continue
-      if not any(item[0] == class_name for item in active_classes_with_tbegins):
-        active_classes_with_tbegins.append((class_name, tbegin))
-    tbegin += timestep_s
-  return rows
+  step_boundaries_s = None
+  if timestamps is not None:
+    if len(timestamps) != len(events):
+      raise ValueError(
+          "Mismatch in lengths: %d timestamps for %d steps" %
+          (len(timestamps), len(events)))
+    step_boundaries_s = np.concatenate(
+        [np.asarray(timestamps, dtype=np.float64),
+         [timestamps[-1] + timestep_s if len(timestamps) else 0.0]])
+    if np.any(np.diff(step_boundaries_s) < 0):
+      raise ValueError("Timestamps are not in non-decreasing order")
+  class_name_to_index = dict()
+  step_indices = []
+  class_indices = []
+  for i, step_events in enumerate(events):
+    for class_name, _ in step_events:
+      if class_name not in class_name_to_index:
+        class_name_to_index[class_name] = len(class_name_to_index)
+      step_indices.append(i)
+      class_indices.append(class_name_to_index[class_name])
+  activity = np.zeros([len(events), len(class_name_to_index)], dtype=bool)
+  activity[step_indices, class_indices] = True
+  return convert_intervals_to_tsv_rows(
+      *find_intervals(activity, min_duration_steps=min_duration_steps),
+      list(class_name_to_index),
+      tier,
+      timestep_s=timestep_s,
+      ignore_class_names=ignore_class_names,
+      step_boundaries_s=step_boundaries_s)
@@ -3,8 +3,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
-
+import numpy as np
 import tensorflow as tf
 
 import events as events_lib
@@ -70,6 +69,127 @@ class ConvertEventsToTsvRowsTest(tf.test.TestCase):
           (2.5, 12.5, "AudioEvents1", "Music"),
       ])
 
+  def testDoesNotMutateInput(self):
+    events = [[("Speech", 0.9)], [("Speech", 0.95)]]
+    events_lib.convert_events_to_tsv_rows(events, "AudioEvents1")
+    self.assertEqual(events, [[("Speech", 0.9)], [("Speech", 0.95)]])
+
+  def testEmptyEvents(self):
+    self.assertEqual(
+        events_lib.convert_events_to_tsv_rows([], "AudioEvents1"), [])
+    self.assertEqual(
+        events_lib.convert_events_to_tsv_rows([[], []], "AudioEvents1"), [])
+
+  def testMinDurationSteps(self):
+    events = [
+        [("Speech", 0.9)],
+        [("Speech", 0.9), ("Cough", 0.8)],
+        [("Speech", 0.9)],
+        [],
+        [("Speech", 0.9)],
+    ]
+    rows = events_lib.convert_events_to_tsv_rows(
+        events, "AudioEvents1", min_duration_steps=2)
+    self.assertEqual(rows, [(0.0, 3.0, "AudioEvents1", "Speech")])
+
+  def testMatchesStepByStepReference(self):
+    random_state = np.random.RandomState(0)
+    class_names = ["A", "B", "C", "D"]
+    activity = random_state.uniform(size=[200, 4]) > 0.4
+    events = [[(class_names[j], 1.0) for j in np.flatnonzero(step)]
+              for step in activity]
+    expected = []
+    for j, class_name in enumerate(class_names):
+      begin = None
+      for i in range(len(events) + 1):
+        active = i < len(events) and activity[i, j]
+        if active and begin is None:
+          begin = i
+        elif not active and begin is not None:
+          expected.append((float(begin), float(i), "T", class_name))
+          begin = None
+    rows = events_lib.convert_events_to_tsv_rows(events, "T")
+    self.assertCountEqual(rows, expected)
+    self.assertEqual([row[1] for row in rows],
+                     sorted(row[1] for row in rows))
+
+  def testNonUniformTimestamps(self):
+    events = [
+        [("dog", 0.9)],
+        [("dog", 0.9), ("cat", 0.8)],
+        [("cat", 0.8)],
+        [],
+    ]
+    rows = events_lib.convert_events_to_tsv_rows(
+        events, "VisualObjects", timestep_s=0.5,
+        timestamps=[0.0, 2.0, 2.5, 10.0])
+    self.assertEqual(rows, [
+        (0.0, 2.5, "VisualObjects", "dog"),
+        (2.0, 10.0, "VisualObjects", "cat"),
+    ])
+
+  def testNonUniformTimestamps_lastStepUsesTimestep(self):
+    rows = events_lib.convert_events_to_tsv_rows(
+        [[], [("dog", 0.9)]], "VisualObjects", timestep_s=0.5,
+        timestamps=[0.0, 3.0])
+    self.assertEqual(rows, [(3.0, 3.5, "VisualObjects", "dog")])
+
+  def testTimestampsLengthMismatchRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"Mismatch in lengths"):
+      events_lib.convert_events_to_tsv_rows(
+          [[], []], "VisualObjects", timestamps=[0.0])
+
+  def testDecreasingTimestampsRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"non-decreasing"):
+      events_lib.convert_events_to_tsv_rows(
+          [[], []], "VisualObjects", timestamps=[1.0, 0.0])
+
+
+class FindIntervalsTest(tf.test.TestCase):
+
+  def testBooleanInput(self):
+    activity = np.array(
+        [[True, False], [True, True], [False, True], [True, True]])
+    class_indices, begin_steps, end_steps = events_lib.find_intervals(
+        activity)
+    self.assertAllEqual(class_indices, [0, 0, 1])
+    self.assertAllEqual(begin_steps, [0, 3, 1])
+    self.assertAllEqual(end_steps, [2, 4, 4])
+
+  def testScoresWithHysteresis(self):
+    scores = np.array(
+        [[0.1], [0.4], [0.6], [0.4], [0.35], [0.2], [0.4], [0.1]],
+        dtype=np.float32)
+    class_indices, begin_steps, end_steps = events_lib.find_intervals(
+        scores, threshold=0.5, off_threshold=0.3)
+    self.assertAllEqual(class_indices, [0])
+    self.assertAllEqual(begin_steps, [2])
+    self.assertAllEqual(end_steps, [5])
+    _, begin_steps, end_steps = events_lib.find_intervals(
+        scores, threshold=0.5)
+    self.assertAllEqual(begin_steps, [2])
+    self.assertAllEqual(end_steps, [3])
+
+  def testScoresWithoutThresholdRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"threshold is required"):
+      events_lib.find_intervals(np.zeros([2, 2], dtype=np.float32))
+
+  def testOffThresholdAboveThresholdRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"must not exceed"):
+      events_lib.find_intervals(
+          np.zeros([2, 2], dtype=np.float32), threshold=0.3,
+          off_threshold=0.5)
+
+  def testConvertIntervalsToTsvRows(self):
+    scores = np.array([[0.9, 0.1], [0.9, 0.8], [0.1, 0.8]])
+    rows = events_lib.convert_intervals_to_tsv_rows(
+        *events_lib.find_intervals(scores, threshold=0.5),
+        ["Speech", "Silence"],
+        "AudioEvents1",
+        timestep_s=0.5,
+        ignore_class_names=("Silence",))
+    self.assertEqual(rows, [(0.0, 1.0, "AudioEvents1", "Speech")])
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -7,51 +7,159 @@ from __future__ import print_function
 import csv
 import argparse
 
-from scipy.io import wavfile
-
 import audio_events
 import events as events_lib
+import model_assets
 import tsv_data
+import waveform_source
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "input_wav_paths",
-    help="Paths to input wav files. Separate multiple files with commas")
+    help="Paths to input audio files (.wav or any format supported by "
+    "ffmpeg, e.g., .flac). Separate multiple files with commas")
 parser.add_argument(
     "output_tsv_path", help="Path to output tsv file")
+parser.add_argument(
+    "--frame_sec",
+    type=float,
+    default=1.0,
+    help="Length of the audio frames that are classified, in seconds.")
+parser.add_argument(
+    "--hop_sec",
+    type=float,
+    default=None,
+    help="Distance between the beginnings of consecutive frames, in seconds. "
+    "Defaults to --frame_sec (no overlap).")
+parser.add_argument(
+    "--num_threads",
+    type=int,
+    default=None,
+    help="Number of threads used by the TFLite interpreter of YAMNet.")
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="Number of worker processes for audio event extraction. A value "
+    "greater than 1 shards the audio across processes, each with its own "
+    "YAMNet interpreter. A value of 0 uses all CPUs.")
+parser.add_argument(
+    "--model_cache_dir",
+    type=str,
+    default=None,
+    help="Directory in which downloaded models are cached. See "
+    "model_assets.py for pre-warming the cache for offline use.")
+parser.add_argument(
+    "--frame_scores_path",
+    type=str,
+    default=None,
+    help="If provided, the YAMNet class scores of every output frame (0.48-s "
+    "hop) are saved to this .npy file, and the events in the output tsv file "
+    "are derived from them at the same resolution. --frame_sec and --hop_sec "
+    "are ignored in this mode. Use audio_events.load_frame_scores() to load "
+    "the scores.")
+parser.add_argument(
+    "--frame_scores_dtype",
+    type=str,
+    default="float16",
+    choices=("float16", "float32"),
+    help="Data type of the scores saved to --frame_scores_path.")
 
-def main():
-  args = parser.parse_args()
 
-  wav_paths = sorted(args.input_wav_paths.split(","))
-  events = []
-  for wav_path in wav_paths:
-    fs, xs = wavfile.read(wav_path)
-    if len(xs.shape) != 1:
-        raise ValueError("Only mono audio is supported")
-
-    # TODO(#35): Resapmle waveform if fs doesn't meet YAMNet requirement.
-    def waveform_generator():
-      step_length = 16000
-      i = 0
-      while i < len(xs):
-        yield xs[i:i + step_length]
-        i += step_length
-
-    events.extend(audio_events.extract_audio_events(
-        waveform_generator, fs=fs, threshold_score=0.5))
-
-  tsv_rows = events_lib.convert_events_to_tsv_rows(
+def _extract_chunk_events_as_tsv_rows(source,
+                                      frame_sec,
+                                      hop_sec,
+                                      num_threads,
+                                      num_workers):
+  """Extracts events with scores averaged over each frame_sec chunk."""
+  frame_generator = source.frame_generator(frame_sec, hop_sec=hop_sec)
+  if num_workers == 1:
+    events = audio_events.extract_audio_events(
+        frame_generator,
+        fs=source.sample_rate,
+        threshold_score=0.5,
+        num_threads=num_threads)
+  else:
+    events = audio_events.extract_audio_events_parallel(
+        frame_generator,
+        fs=source.sample_rate,
+        threshold_score=0.5,
+        num_workers=num_workers or None,
+        num_threads=num_threads or 1)
+  return events_lib.convert_events_to_tsv_rows(
       events,
       tsv_data.AUDIO_EVENTS_TIER,
+      timestep_s=hop_sec or frame_sec,
       ignore_class_names=audio_events.YAMNET_IGNORE_CLASS_NAMES)
-  with open(args.output_tsv_path, mode="w") as f:
+
+
+def extract_audio_events_to_tsv(wav_paths,
+                                output_tsv_path,
+                                frame_sec=1.0,
+                                hop_sec=None,
+                                num_threads=None,
+                                num_workers=1,
+                                frame_scores_path=None,
+                                frame_scores_dtype="float16"):
+  """Extracts audio events from audio files into a tsv file.
+
+  This is the library equivalent of running this module as a binary. The
+  YAMNet model is loaded once per process and reused by later calls. See the
+  flags for the meaning of the arguments.
+
+  Args:
+    wav_paths: A list of paths to the input audio files, or a single path.
+    output_tsv_path: Path to the output tsv file.
+  """
+  if isinstance(wav_paths, str):
+    wav_paths = [wav_paths]
+  wav_paths = sorted(wav_paths)
+  # The files are read lazily as one logical stream, so that memory usage
+  # does not grow with the length of the session.
+  # Audio at other sample rates (e.g., 44.1 or 48 kHz) is resampled on the
+  # fly to the rate required by YAMNet.
+  source = waveform_source.WaveformSource(
+      wav_paths, target_sample_rate=audio_events.YAMNET_FS)
+  if frame_scores_path:
+    if num_workers != 1:
+      raise ValueError("--frame_scores_path requires --num_workers=1")
+    scores = audio_events.extract_frame_scores(
+        source.iter_blocks,
+        fs=source.sample_rate,
+        num_threads=num_threads)
+    audio_events.save_frame_scores(
+        frame_scores_path, scores, dtype=frame_scores_dtype)
+    tsv_rows = events_lib.convert_intervals_to_tsv_rows(
+        *events_lib.find_intervals(scores, threshold=0.5),
+        audio_events.get_yamnet_class_names(),
+        tsv_data.AUDIO_EVENTS_TIER,
+        timestep_s=audio_events.YAMNET_FRAME_HOP_SEC,
+        ignore_class_names=audio_events.YAMNET_IGNORE_CLASS_NAMES)
+  else:
+    tsv_rows = _extract_chunk_events_as_tsv_rows(
+        source, frame_sec, hop_sec, num_threads, num_workers)
+  with open(output_tsv_path, mode="w") as f:
     tsv_writer = csv.writer(f, delimiter="\t")
     tsv_writer.writerow(tsv_data.COLUMN_HEADS)
     for row in tsv_rows:
       tsv_writer.writerow(row)
 
 
+def main():
+  args = parser.parse_args()
+  if args.model_cache_dir:
+    model_assets.set_model_cache_dir(args.model_cache_dir)
+  extract_audio_events_to_tsv(
+      args.input_wav_paths.split(","),
+      args.output_tsv_path,
+      frame_sec=args.frame_sec,
+      hop_sec=args.hop_sec,
+      num_threads=args.num_threads,
+      num_workers=args.num_workers,
+      frame_scores_path=args.frame_scores_path,
+      frame_scores_dtype=args.frame_scores_dtype)
+
+
 if __name__ == "__main__":
   main()
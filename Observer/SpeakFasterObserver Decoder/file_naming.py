@@ -4,8 +4,10 @@ from __future__ import division
 from __future__ import print_function
 
 from datetime import datetime
+from datetime import timedelta
 import os
 
+import numpy as np
 import pytz
 
 ASR_TSV_FILENAME = "asr.tsv"
@@ -13,6 +15,9 @@ ASR_TSV_FILENAME = "asr.tsv"
 MERGED_TSV_FILENAME = "merged.tsv"
 CONCATENATED_AUDIO_FILENAME = "concatenated_audio.wav"
 SCREENSHOTS_MP4_FILENAME = "screenshots.mp4"
+# Directory (in the session directory) that holds the manifests of the
+# preprocessing stages, which let a rerun skip the stages that are up to date.
+STAGE_MANIFESTS_DIRNAME = ".stage_manifests"
 
 # Assumed name of the file from manual curation in ELAN.
 CURATED_TSV_FILENAME = "curated.tsv"
@@ -24,6 +29,12 @@ CURATED_PROCESSED_SPEECH_ONLY_TSV_FILENAME = (
 
 SPEAKER_ID_CONFIG_JSON_FILENAME = "speaker_id_config.json"
 
+# Length of a timestamp in the yyyymmddThhmmssfff format (i.e., with
+# millisecond precision) used by the Observer, without the optional UTC "Z"
+# suffix. Such timestamps are parsed without strptime() in bulk.
+_TIMESTAMP_LENGTH = 18
+_TIMESTAMP_T_POSITION = 8
+
 KEYPRESS_CHECKS_TSV_FILENAME = "keypress_checks.tsv"
 TRANSCIPRT_ANALYSIS_JSON_FILENAME = "transcript_analysis.json"
 
@@ -62,6 +73,101 @@ def parse_epoch_seconds_from_filename(filename, timezone):
   return tz.localize(dt).timestamp()
 
 
+def _get_digit_fields(codes, begin, end):
+  """Converts columns [begin, end) of digit codes into integers."""
+  values = np.zeros([len(codes)], dtype=np.int64)
+  for i in range(begin, end):
+    values = values * 10 + codes[:, i]
+  return values
+
+
+def parse_timestamps_from_filenames(filenames):
+  """Parses the timestamps of many SpeakFaster Observer data filenames.
+
+  Equivalent to calling parse_timestamp_from_filename() on each filename, but
+  timestamps in the standard yyyymmddThhmmssfff format are parsed with
+  vectorized numpy operations. Other timestamps (e.g., with a different number
+  of fractional digits) fall back to parse_timestamp().
+
+  Args:
+    filenames: A list of file paths.
+
+  Returns:
+    timestamps: The (naive) timestamps, as a 1D datetime64[us] numpy array.
+    is_utc: Whether each timestamp is in UTC, as a 1D bool numpy array.
+  """
+  timestamps = [
+      os.path.basename(filename).split("-", 1)[0] for filename in filenames]
+  is_utc = np.array(
+      [timestamp.endswith("Z") for timestamp in timestamps], dtype=bool)
+  timestamps = np.array(
+      [timestamp[:-1] if utc else timestamp
+       for timestamp, utc in zip(timestamps, is_utc)], dtype=np.str_)
+  output = np.zeros([len(timestamps)], dtype="datetime64[us]")
+  is_standard = np.char.str_len(timestamps) == _TIMESTAMP_LENGTH
+  if np.any(is_standard):
+    codes = (np.ascontiguousarray(timestamps[is_standard]).astype(
+        "<U%d" % _TIMESTAMP_LENGTH).view(np.uint32).reshape(
+            [-1, _TIMESTAMP_LENGTH]).astype(np.int64) - ord("0"))
+    digit_codes = np.delete(codes, _TIMESTAMP_T_POSITION, axis=1)
+    is_valid = (np.all((digit_codes >= 0) & (digit_codes <= 9), axis=1) &
+                (codes[:, _TIMESTAMP_T_POSITION] == ord("T") - ord("0")))
+    codes = np.where(is_valid[:, None], codes, 0)
+    year = _get_digit_fields(codes, 0, 4)
+    month = _get_digit_fields(codes, 4, 6)
+    day = _get_digit_fields(codes, 6, 8)
+    hour = _get_digit_fields(codes, 9, 11)
+    minute = _get_digit_fields(codes, 11, 13)
+    second = _get_digit_fields(codes, 13, 15)
+    millisecond = _get_digit_fields(codes, 15, 18)
+    is_valid &= ((year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) &
+                 (hour < 24) & (minute < 60) & (second < 60))
+    months = ((year - 1970) * 12 + np.clip(month, 1, 12) - 1).astype(
+        "datetime64[M]")
+    days_in_month = (
+        (months + 1).astype("datetime64[D]") -
+        months.astype("datetime64[D]")).astype(np.int64)
+    is_valid &= day <= days_in_month
+    parsed = (months.astype("datetime64[us]") +
+              ((((day - 1) * 24 + hour) * 60 + minute) * 60 + second) *
+              1000000 + millisecond * 1000)
+    # Invalid timestamps are left to parse_timestamp() to report.
+    is_standard[is_standard] = is_valid
+    output[is_standard] = parsed[is_valid]
+  for i in np.flatnonzero(~is_standard):
+    output[i], _ = parse_timestamp(str(timestamps[i]))
+  return output, is_utc
+
+
+def parse_epoch_seconds_from_filenames(filenames, timezone):
+  """Parses the epoch timestamps (in seconds) of many filenames.
+
+  Equivalent to calling parse_epoch_seconds_from_filename() on each filename.
+
+  Args:
+    filenames: A list of file paths.
+    timezone: Name of the timezone for timestamps that are not in UTC.
+
+  Returns:
+    The epoch timestamps in seconds, as a 1D float64 numpy array.
+  """
+  timestamps, is_utc = parse_timestamps_from_filenames(filenames)
+  local_us = (timestamps - np.datetime64(0, "us")).astype(np.int64)
+  offsets_us = np.zeros([len(local_us)], dtype=np.int64)
+  if not np.all(is_utc):
+    # The UTC offset is constant within each minute, so the timezone is only
+    # looked up once per distinct minute.
+    tz = pytz.timezone(timezone)
+    minutes, inverse = np.unique(
+        local_us[~is_utc] // 60000000, return_inverse=True)
+    minute_offsets_us = np.array([
+        tz.localize(datetime(1970, 1, 1) + timedelta(minutes=int(m)))
+        .utcoffset() // timedelta(microseconds=1) for m in minutes],
+                                 dtype=np.int64)
+    offsets_us[~is_utc] = minute_offsets_us[inverse.reshape([-1])]
+  return (local_us - offsets_us) / 1e6
+
+
 def get_data_stream_name(filename):
   """Get the data stream name.
 
@@ -3,8 +3,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import datetime
 import os
 
+import numpy as np
 import tensorflow as tf
 
 import file_naming
@@ -85,6 +87,61 @@ class ParseTimestampFromFilenameTest(tf.test.TestCase):
     self.assertAllClose(epoch_s, 1625925178.428)
 
 
+class ParseTimestampsFromFilenamesTest(tf.test.TestCase):
+
+  def testMatchesScalarParsing(self):
+    filenames = [
+        "20210710T095258428-MicWaveIn.flac",
+        os.path.join("tmp", "20210710T095258428Z-Screenshot.jpg"),
+        "20200229T235959999-Screenshot.jpg",
+        "20211231T235959000-Screenshot.jpg",
+        "20220101T000000001-Screenshot.jpg",
+        # Non-standard number of fractional digits.
+        "20210710T0952584-Screenshot.jpg",
+    ]
+    timestamps, is_utc = file_naming.parse_timestamps_from_filenames(
+        filenames)
+    self.assertEqual(timestamps.dtype, np.dtype("datetime64[us]"))
+    for filename, timestamp, utc in zip(filenames, timestamps, is_utc):
+      expected_timestamp, expected_is_utc = (
+          file_naming.parse_timestamp_from_filename(filename))
+      self.assertEqual(timestamp.astype(datetime.datetime), expected_timestamp)
+      self.assertEqual(utc, expected_is_utc)
+
+  def testEmpty(self):
+    timestamps, is_utc = file_naming.parse_timestamps_from_filenames([])
+    self.assertEmpty(timestamps)
+    self.assertEmpty(is_utc)
+    self.assertEmpty(
+        file_naming.parse_epoch_seconds_from_filenames([], "US/Eastern"))
+
+  def testRaisesErrorForInvalidTimestamps(self):
+    for filename in ("20210230T095258428-Screenshot.jpg",
+                     "20211310T095258428-Screenshot.jpg",
+                     "20210710X095258428-Screenshot.jpg",
+                     "2021071a0T95258428-Screenshot.jpg"):
+      with self.assertRaises(ValueError):
+        file_naming.parse_timestamps_from_filenames(
+            ["20210710T095258428-Screenshot.jpg", filename])
+
+  def testParseEpochS_matchesScalarParsingAcrossDaylightSavingTime(self):
+    filenames = [
+        "20210710T095258428-MicWaveIn.flac",
+        "20210710T095258428Z-MicWaveIn.flac",
+        "20211107T005959000-Screenshot.jpg",
+        "20211107T013000000-Screenshot.jpg",
+        "20211107T020000000-Screenshot.jpg",
+        "20211108T013000000-Screenshot.jpg",
+    ]
+    epochs_s = file_naming.parse_epoch_seconds_from_filenames(
+        filenames, "US/Eastern")
+    self.assertAllClose(
+        epochs_s,
+        [file_naming.parse_epoch_seconds_from_filename(filename, "US/Eastern")
+         for filename in filenames])
+    self.assertAllClose(epochs_s[0], 1625925178.428)
+
+
 class GetDataStreamNameTest(tf.test.TestCase):
 
   def testGetDataStreamName_basenameOnly_returnsCorrectName(self):
@@ -1,4 +1,5 @@
 """Google Cloud-related utilites."""
+import functools
 import os
 import tempfile
 import uuid
@@ -6,6 +7,12 @@ import uuid
 from google.cloud import storage
 
 
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+  """Returns a GCS client shared by all calls in this process."""
+  return storage.Client()
+
+
 def create_temp_gcs_bucket(prefix):
   """Creates a temporary GCS bucket.
 
@@ -16,7 +23,7 @@ def create_temp_gcs_bucket(prefix):
   Returns:
     Name of the bucket created by this call.
   """
-  storage_client = storage.Client()
+  storage_client = get_storage_client()
   bucket_name = prefix + "_" + str(uuid.uuid4())
   bucket = storage_client.bucket(bucket_name)
   bucket.storage_class = "COLDLINE"
@@ -27,7 +34,7 @@ def create_temp_gcs_bucket(prefix):
 
 def delete_gcs_bucket(bucket_name):
   """Delete a GCS bucket."""
-  storage_client = storage.Client()
+  storage_client = get_storage_client()
   bucket = storage_client.get_bucket(bucket_name)
   bucket.delete()
   print("Deleted GCS bucket %s" % bucket_name)
@@ -41,7 +48,7 @@ def upload_text_to_object(text, bucket_name, destination_blob_name):
     bucket_name: Name of the bucket to upload to.
     destination_blob_name: Blob path under the bucket.
   """
-  storage_client = storage.Client()
+  storage_client = get_storage_client()
   bucket = storage_client.bucket(bucket_name)
   blob = bucket.blob(destination_blob_name)
   temp_path = tempfile.mktemp()
@@ -56,7 +63,7 @@ def upload_text_to_object(text, bucket_name, destination_blob_name):
 
 def remote_objects_exist(bucket_name, destination_blob_prefix, file_names):
   """Determine whether all remote file objects exist."""
-  storage_client = storage.Client()
+  storage_client = get_storage_client()
   bucket = storage_client.bucket(bucket_name)
   for file_name in file_names:
     destination_blob_name = (
@@ -84,7 +91,7 @@ def upload_files_as_objects(local_dir,
     bucket_name: Name of the GCS bucket to upload the files to.
     destination_blob_prefix: Destination blobl prefix.
   """
-  storage_client = storage.Client()
+  storage_client = get_storage_client()
   bucket = storage_client.bucket(bucket_name)
   for file_name in file_names:
     file_path = os.path.join(local_dir, file_name)
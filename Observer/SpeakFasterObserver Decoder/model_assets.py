@@ -0,0 +1,384 @@
+"""Registry and on-disk cache of the models used by the decoder.
+
+Models are downloaded once into a persistent cache directory and verified
+against the SHA-256 digests pinned in REGISTRY before use. Running this module
+as a binary pre-warms the cache, e.g., before copying it to an air-gapped
+processing machine:
+
+  python model_assets.py --model_cache_dir /path/to/models
+
+To compute the digests to pin, e.g., for a new model version, download the
+assets without caching them:
+
+  python model_assets.py --fetch_sha256
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+from urllib import request
+
+# Environment variable that overrides the default cache directory. An
+# environment variable (rather than a module global) is used so that worker
+# processes inherit the setting.
+MODEL_CACHE_DIR_ENV_VAR = "SPEAKFASTER_MODEL_CACHE_DIR"
+DEFAULT_MODEL_CACHE_DIR = os.path.join(
+    pathlib.Path.home(), "SpeakFasterObs", "models")
+# Prefix of environment variables that point an asset to a local path instead
+# of the cache, e.g., SPEAKFASTER_MODEL_PATH_YAMNET_TFLITE.
+MODEL_PATH_ENV_VAR_PREFIX = "SPEAKFASTER_MODEL_PATH_"
+# If this environment variable is set to 1, missing assets are never downloaded.
+OFFLINE_ENV_VAR = "SPEAKFASTER_MODELS_OFFLINE"
+# Suffix of the file that records the checksum of a local file or directory
+# that an asset is pointed to by a SPEAKFASTER_MODEL_PATH_<NAME> environment
+# variable. The checksum is recorded on first use and verified afterwards.
+CHECKSUM_SUFFIX = ".sha256"
+# Name of the file in an extracted archive directory that records the digest of
+# the archive and of the extracted files. It is excluded from the latter.
+EXTRACTED_CHECKSUM_FILENAME = ".extracted.sha256"
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# An asset in the registry.
+#   name: Name used to look up the asset.
+#   url: URL to download the asset from.
+#   filename: Name of the file in the cache directory.
+#   sha256: Expected SHA-256 hex digest of the downloaded file. An asset
+#     without a pinned digest is never downloaded.
+#   is_archive: Whether the file is a .tar.gz archive to be extracted into a
+#     directory (e.g., a TF Hub SavedModel).
+ModelAsset = collections.namedtuple(
+    "ModelAsset", ("name", "url", "filename", "sha256", "is_archive"))
+
+YAMNET_TFLITE = "yamnet_tflite"
+YAMNET_CLASS_MAP = "yamnet_class_map"
+OBJECT_DETECTOR = "object_detector"
+
+REGISTRY = collections.OrderedDict([
+    (YAMNET_TFLITE, ModelAsset(
+        name=YAMNET_TFLITE,
+        url="https://storage.googleapis.com/tfhub-lite-models/google/lite-model/yamnet/tflite/1.tflite",
+        filename="lite-model_yamnet_tflite_1.tflite",
+        sha256=None,
+        is_archive=False)),
+    (YAMNET_CLASS_MAP, ModelAsset(
+        name=YAMNET_CLASS_MAP,
+        # A release tag rather than the master branch, so that the file does
+        # not change under its pinned digest.
+        url="https://raw.githubusercontent.com/tensorflow/models/v2.4.0/research/audioset/yamnet/yamnet_class_map.csv",
+        filename="yamnet_class_map.csv",
+        sha256=None,
+        is_archive=False)),
+    (OBJECT_DETECTOR, ModelAsset(
+        name=OBJECT_DETECTOR,
+        url="https://tfhub.dev/tensorflow/ssd_mobilenet_v2/fpnlite_640x640/1?tf-hub-format=compressed",
+        filename="ssd_mobilenet_v2_fpnlite_640x640_1.tar.gz",
+        sha256=None,
+        is_archive=True)),
+])
+
+
+def get_model_cache_dir():
+  """Returns the model cache directory currently in effect."""
+  return os.environ.get(MODEL_CACHE_DIR_ENV_VAR, DEFAULT_MODEL_CACHE_DIR)
+
+
+def set_model_cache_dir(cache_dir):
+  """Sets the model cache directory for this process and its children."""
+  os.environ[MODEL_CACHE_DIR_ENV_VAR] = cache_dir
+
+
+def _get_asset(name):
+  if name not in REGISTRY:
+    raise ValueError(
+        "Unknown model asset: %s; expected one of %s" %
+        (name, list(REGISTRY)))
+  return REGISTRY[name]
+
+
+def compute_sha256(file_path):
+  """Computes the SHA-256 hex digest of a file."""
+  hasher = hashlib.sha256()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b""):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+
+def compute_tree_sha256(dir_path):
+  """Computes the SHA-256 hex digest of the files in a directory tree.
+
+  The digest covers the relative path and the contents of every file, in
+  sorted order. EXTRACTED_CHECKSUM_FILENAME at the top level is excluded.
+  """
+  hasher = hashlib.sha256()
+  for root, dir_names, file_names in os.walk(dir_path):
+    dir_names.sort()
+    for file_name in sorted(file_names):
+      if root == dir_path and file_name == EXTRACTED_CHECKSUM_FILENAME:
+        continue
+      file_path = os.path.join(root, file_name)
+      relative_path = os.path.relpath(file_path, dir_path).replace(os.sep, "/")
+      hasher.update(relative_path.encode("utf-8") + b"\0")
+      hasher.update(compute_sha256(file_path).encode("ascii") + b"\n")
+  return hasher.hexdigest()
+
+
+def _download(url, file_path):
+  """Downloads a URL to a file atomically. Returns the SHA-256 hex digest."""
+  dir_path = os.path.dirname(file_path)
+  os.makedirs(dir_path, exist_ok=True)
+  hasher = hashlib.sha256()
+  fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as f, request.urlopen(url) as response:
+      for block in iter(lambda: response.read(DOWNLOAD_BLOCK_SIZE), b""):
+        hasher.update(block)
+        f.write(block)
+    os.replace(tmp_path, file_path)
+  finally:
+    if os.path.isfile(tmp_path):
+      os.remove(tmp_path)
+  return hasher.hexdigest()
+
+
+def _get_pinned_sha256(asset):
+  if not asset.sha256:
+    raise ValueError(
+        "No SHA-256 digest is pinned for model asset %s. Pin it in "
+        "model_assets.REGISTRY (see `python model_assets.py --fetch_sha256`), "
+        "or point %s%s to a local copy." %
+        (asset.name, MODEL_PATH_ENV_VAR_PREFIX, asset.name.upper()))
+  return asset.sha256
+
+
+def _verify_checksum(asset, file_path, sha256=None):
+  expected_sha256 = _get_pinned_sha256(asset)
+  if sha256 is None:
+    sha256 = compute_sha256(file_path)
+  if sha256 != expected_sha256:
+    raise ValueError(
+        "Checksum mismatch for model asset %s at %s: expected %s, got %s. "
+        "Delete the file to download it again." %
+        (asset.name, file_path, expected_sha256, sha256))
+
+
+def _verify_local_path(asset, local_path):
+  """Verifies a local override against the checksum recorded on first use."""
+  if os.path.isdir(local_path):
+    sha256 = compute_tree_sha256(local_path)
+  else:
+    sha256 = compute_sha256(local_path)
+  checksum_path = os.path.normpath(local_path) + CHECKSUM_SUFFIX
+  if not os.path.isfile(checksum_path):
+    try:
+      with open(checksum_path, "w") as f:
+        f.write(sha256 + "\n")
+    except OSError as e:
+      print("Cannot record the checksum of model asset %s at %s: %s" %
+            (asset.name, checksum_path, e))
+    return
+  with open(checksum_path, "r") as f:
+    expected_sha256 = f.read().strip()
+  if sha256 != expected_sha256:
+    raise ValueError(
+        "Checksum mismatch for model asset %s at %s: expected %s (recorded in "
+        "%s), got %s" %
+        (asset.name, local_path, expected_sha256, checksum_path, sha256))
+
+
+def _extract_archive(archive_path, archive_sha256, dir_path):
+  """Extracts a verified .tar.gz archive into a directory atomically.
+
+  The digests of the archive and of the extracted files are recorded in the
+  directory (see _verify_extracted_dir()). If another process extracts the
+  same archive concurrently, the directory extracted first is kept.
+  """
+  parent_dir = os.path.dirname(dir_path)
+  tmp_dir = tempfile.mkdtemp(dir=parent_dir, suffix=".tmp")
+  try:
+    with tarfile.open(archive_path, "r:gz") as tar:
+      for member in tar.getmembers():
+        member_path = os.path.realpath(os.path.join(tmp_dir, member.name))
+        if not member_path.startswith(os.path.realpath(tmp_dir)):
+          raise ValueError(
+              "Unsafe path in archive %s: %s" % (archive_path, member.name))
+      tar.extractall(tmp_dir)
+    with open(os.path.join(tmp_dir, EXTRACTED_CHECKSUM_FILENAME), "w") as f:
+      f.write("%s\n%s\n" % (archive_sha256, compute_tree_sha256(tmp_dir)))
+    try:
+      os.replace(tmp_dir, dir_path)
+    except OSError:
+      if not os.path.isdir(dir_path):
+        raise
+  finally:
+    if os.path.isdir(tmp_dir):
+      shutil.rmtree(tmp_dir)
+
+
+def _verify_extracted_dir(asset, dir_path):
+  """Verifies an extracted archive directory against its recorded digests.
+
+  The directory must have been extracted from the archive with the pinned
+  digest, and its files must not have changed since.
+  """
+  checksum_path = os.path.join(dir_path, EXTRACTED_CHECKSUM_FILENAME)
+  recorded = []
+  if os.path.isfile(checksum_path):
+    with open(checksum_path, "r") as f:
+      recorded = f.read().split()
+  if (len(recorded) != 2 or recorded[0] != _get_pinned_sha256(asset) or
+      recorded[1] != compute_tree_sha256(dir_path)):
+    raise ValueError(
+        "Extracted model asset %s at %s does not match the archive with "
+        "SHA-256 %s. Delete the directory to extract it again." %
+        (asset.name, dir_path, asset.sha256))
+
+
+def _get_extracted_dir(archive_path):
+  return archive_path[:-len(".tar.gz")]
+
+
+def get_model_path(name, cache_dir=None, offline=None):
+  """Returns the local path to a model asset, downloading it if necessary.
+
+  The path is looked up in the following order:
+    1. The SPEAKFASTER_MODEL_PATH_<NAME> environment variable, used as is.
+       Its checksum is recorded on first use and verified afterwards.
+    2. The cache directory. The file (or the extracted directory) is verified
+       against the pinned checksum.
+    3. Download into the cache directory, unless offline is True.
+
+  Args:
+    name: Name of the asset in REGISTRY, e.g., YAMNET_TFLITE.
+    cache_dir: Cache directory. Defaults to get_model_cache_dir().
+    offline: If True, raises ValueError instead of downloading a missing
+      asset. Defaults to whether $SPEAKFASTER_MODELS_OFFLINE is 1.
+
+  Returns:
+    Path to the asset file, or to the extracted directory for archives.
+
+  Raises:
+    ValueError: If the asset fails verification, if no digest is pinned for an
+      asset in the cache directory, or if the asset is missing while offline.
+  """
+  asset = _get_asset(name)
+  local_path = os.environ.get(MODEL_PATH_ENV_VAR_PREFIX + name.upper())
+  if local_path:
+    if not os.path.exists(local_path):
+      raise ValueError(
+          "Local path to model asset %s does not exist: %s" %
+          (name, local_path))
+    _verify_local_path(asset, local_path)
+    return local_path
+
+  cache_dir = cache_dir or get_model_cache_dir()
+  if offline is None:
+    offline = os.environ.get(OFFLINE_ENV_VAR) == "1"
+  file_path = os.path.join(cache_dir, asset.filename)
+  if asset.is_archive and os.path.isdir(_get_extracted_dir(file_path)):
+    _verify_extracted_dir(asset, _get_extracted_dir(file_path))
+    return _get_extracted_dir(file_path)
+  if os.path.isfile(file_path):
+    _verify_checksum(asset, file_path)
+  elif offline:
+    raise ValueError(
+        "Model asset %s is not in the cache directory %s. Pre-warm the cache "
+        "with `python model_assets.py --model_cache_dir %s`." %
+        (name, cache_dir, cache_dir))
+  else:
+    # Fail before downloading anything that could not be verified.
+    _get_pinned_sha256(asset)
+    print("Downloading model asset %s from %s..." % (name, asset.url))
+    sha256 = _download(asset.url, file_path)
+    try:
+      _verify_checksum(asset, file_path, sha256=sha256)
+    except ValueError:
+      os.remove(file_path)
+      raise
+  if asset.is_archive:
+    _extract_archive(file_path, asset.sha256, _get_extracted_dir(file_path))
+    return _get_extracted_dir(file_path)
+  return file_path
+
+
+def fetch_sha256(names=None):
+  """Downloads model assets to a temporary directory and computes digests.
+
+  The downloads are not cached. Verify the digests out of band before pinning
+  them in REGISTRY.
+
+  Args:
+    names: Names of the assets. Defaults to all assets in REGISTRY.
+
+  Returns:
+    A dict mapping asset name to the SHA-256 hex digest of its download.
+  """
+  names = names or list(REGISTRY)
+  digests = collections.OrderedDict()
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for name in names:
+      asset = _get_asset(name)
+      digests[name] = _download(
+          asset.url, os.path.join(tmp_dir, asset.filename))
+  finally:
+    shutil.rmtree(tmp_dir)
+  return digests
+
+
+def prewarm(names=None, cache_dir=None):
+  """Downloads and verifies model assets.
+
+  Args:
+    names: Names of the assets. Defaults to all assets in REGISTRY.
+    cache_dir: Cache directory. Defaults to get_model_cache_dir().
+
+  Returns:
+    A dict mapping asset name to local path.
+  """
+  names = names or list(REGISTRY)
+  return collections.OrderedDict(
+      (name, get_model_path(name, cache_dir=cache_dir)) for name in names)
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+      "Download and verify the models used by the decoder")
+  parser.add_argument(
+      "--model_cache_dir",
+      type=str,
+      default=None,
+      help="Model cache directory. Defaults to $%s or %s" %
+      (MODEL_CACHE_DIR_ENV_VAR, DEFAULT_MODEL_CACHE_DIR))
+  parser.add_argument(
+      "--assets",
+      type=str,
+      default=None,
+      help="Comma-separated names of the assets to pre-warm. Defaults to all: "
+      "%s" % ",".join(REGISTRY))
+  parser.add_argument(
+      "--fetch_sha256",
+      action="store_true",
+      help="Instead of pre-warming the cache, download the assets without "
+      "caching them and print their SHA-256 digests for pinning in REGISTRY.")
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  names = args.assets.split(",") if args.assets else None
+  if args.fetch_sha256:
+    for name, sha256 in fetch_sha256(names=names).items():
+      print("%s: %s" % (name, sha256))
+  else:
+    paths = prewarm(names=names, cache_dir=args.model_cache_dir)
+    for name, path in paths.items():
+      print("%s: %s" % (name, path))
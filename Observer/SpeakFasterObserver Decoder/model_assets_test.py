@@ -0,0 +1,208 @@
+"""Unit tests for the model_assets module."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import pathlib
+import tarfile
+from unittest import mock
+
+import tensorflow as tf
+
+import model_assets
+
+
+class GetModelPathTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._source_dir = os.path.join(self.get_temp_dir(), "source")
+    self._cache_dir = os.path.join(self.get_temp_dir(), "cache")
+    os.makedirs(self._source_dir, exist_ok=True)
+    self._source_path = os.path.join(self._source_dir, "model.tflite")
+    with open(self._source_path, "wb") as f:
+      f.write(b"model bytes")
+    self._sha256 = hashlib.sha256(b"model bytes").hexdigest()
+    checksum_path = self._source_path + model_assets.CHECKSUM_SUFFIX
+    if os.path.isfile(checksum_path):
+      os.remove(checksum_path)
+    self._env_patcher = mock.patch.dict(os.environ, {}, clear=False)
+    self._env_patcher.start()
+    for key in list(os.environ):
+      if key.startswith("SPEAKFASTER_MODEL"):
+        del os.environ[key]
+
+  def tearDown(self):
+    self._env_patcher.stop()
+    super().tearDown()
+
+  def _registerAsset(self, url=None, filename="model.tflite", sha256="",
+                     is_archive=False):
+    """Registers a test asset. Its digest is pinned unless sha256 is None."""
+    asset = model_assets.ModelAsset(
+        name="test_model",
+        url=url or pathlib.Path(self._source_path).as_uri(),
+        filename=filename,
+        sha256=self._sha256 if sha256 == "" else sha256,
+        is_archive=is_archive)
+    patcher = mock.patch.dict(model_assets.REGISTRY, {"test_model": asset})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _makeArchive(self):
+    saved_model_dir = os.path.join(self._source_dir, "saved_model")
+    os.makedirs(saved_model_dir, exist_ok=True)
+    with open(os.path.join(saved_model_dir, "saved_model.pb"), "wb") as f:
+      f.write(b"graph")
+    archive_path = os.path.join(self._source_dir, "model.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as tar:
+      tar.add(os.path.join(saved_model_dir, "saved_model.pb"),
+              arcname="saved_model.pb")
+    return archive_path, model_assets.compute_sha256(archive_path)
+
+  def testDownloadsToCacheDir(self):
+    self._registerAsset()
+    path = model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    self.assertEqual(path, os.path.join(self._cache_dir, "model.tflite"))
+    with open(path, "rb") as f:
+      self.assertEqual(f.read(), b"model bytes")
+    self.assertEqual(os.listdir(self._cache_dir), ["model.tflite"])
+
+  def testUnpinnedAssetIsNotDownloaded(self):
+    self._registerAsset(sha256=None)
+    with self.assertRaisesRegex(ValueError, r"No SHA-256 digest is pinned"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    self.assertFalse(os.path.exists(self._cache_dir))
+
+  def testUsesCacheWithoutDownloading(self):
+    self._registerAsset()
+    model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    os.remove(self._source_path)
+    path = model_assets.get_model_path(
+        "test_model", cache_dir=self._cache_dir, offline=True)
+    self.assertEqual(path, os.path.join(self._cache_dir, "model.tflite"))
+
+  def testCorruptedCachedFileRaisesValueError(self):
+    self._registerAsset()
+    path = model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    with open(path, "wb") as f:
+      f.write(b"truncated")
+    with self.assertRaisesRegex(ValueError, r"Checksum mismatch"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testPinnedChecksumMismatchRaisesValueErrorAndRemovesFile(self):
+    self._registerAsset(sha256="0" * 64)
+    with self.assertRaisesRegex(ValueError, r"Checksum mismatch"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    self.assertFalse(
+        os.path.isfile(os.path.join(self._cache_dir, "model.tflite")))
+
+  def testOfflineMissingAssetRaisesValueError(self):
+    self._registerAsset()
+    with self.assertRaisesRegex(ValueError, r"not in the cache directory"):
+      model_assets.get_model_path(
+          "test_model", cache_dir=self._cache_dir, offline=True)
+    os.environ[model_assets.OFFLINE_ENV_VAR] = "1"
+    with self.assertRaisesRegex(ValueError, r"not in the cache directory"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testCacheDirFromEnvironmentVariable(self):
+    self._registerAsset()
+    model_assets.set_model_cache_dir(self._cache_dir)
+    self.assertEqual(model_assets.get_model_cache_dir(), self._cache_dir)
+    path = model_assets.get_model_path("test_model")
+    self.assertEqual(path, os.path.join(self._cache_dir, "model.tflite"))
+
+  def testLocalPathOverrideRecordsAndVerifiesChecksum(self):
+    self._registerAsset(
+        url="https://invalid.invalid/model.tflite", sha256=None)
+    os.environ["SPEAKFASTER_MODEL_PATH_TEST_MODEL"] = self._source_path
+    self.assertEqual(
+        model_assets.get_model_path("test_model", cache_dir=self._cache_dir),
+        self._source_path)
+    with open(self._source_path + model_assets.CHECKSUM_SUFFIX, "r") as f:
+      self.assertEqual(f.read().strip(), self._sha256)
+    self.assertEqual(
+        model_assets.get_model_path("test_model", cache_dir=self._cache_dir),
+        self._source_path)
+    with open(self._source_path, "wb") as f:
+      f.write(b"other bytes")
+    with self.assertRaisesRegex(ValueError, r"Checksum mismatch"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testLocalPathOverrideToMissingFileRaisesValueError(self):
+    self._registerAsset()
+    os.environ["SPEAKFASTER_MODEL_PATH_TEST_MODEL"] = "/nonexistent/model"
+    with self.assertRaisesRegex(ValueError, r"does not exist"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testArchiveIsExtracted(self):
+    archive_path, archive_sha256 = self._makeArchive()
+    self._registerAsset(
+        url=pathlib.Path(archive_path).as_uri(), filename="model.tar.gz",
+        sha256=archive_sha256, is_archive=True)
+    path = model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    self.assertEqual(path, os.path.join(self._cache_dir, "model"))
+    self.assertTrue(os.path.isfile(os.path.join(path, "saved_model.pb")))
+    os.remove(archive_path)
+    self.assertEqual(
+        model_assets.get_model_path(
+            "test_model", cache_dir=self._cache_dir, offline=True), path)
+
+  def testModifiedExtractedDirRaisesValueError(self):
+    archive_path, archive_sha256 = self._makeArchive()
+    self._registerAsset(
+        url=pathlib.Path(archive_path).as_uri(), filename="model.tar.gz",
+        sha256=archive_sha256, is_archive=True)
+    path = model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+    with open(os.path.join(path, "saved_model.pb"), "wb") as f:
+      f.write(b"tampered")
+    with self.assertRaisesRegex(ValueError, r"does not match the archive"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testExtractedDirWithoutRecordedDigestsRaisesValueError(self):
+    archive_path, archive_sha256 = self._makeArchive()
+    self._registerAsset(
+        url=pathlib.Path(archive_path).as_uri(), filename="model.tar.gz",
+        sha256=archive_sha256, is_archive=True)
+    os.makedirs(os.path.join(self._cache_dir, "model"))
+    with self.assertRaisesRegex(ValueError, r"does not match the archive"):
+      model_assets.get_model_path("test_model", cache_dir=self._cache_dir)
+
+  def testExtractArchiveKeepsDirectoryExtractedConcurrently(self):
+    archive_path = os.path.join(self._source_dir, "model.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as tar:
+      tar.add(self._source_path, arcname="model.tflite")
+    dir_path = os.path.join(self._cache_dir, "model")
+    os.makedirs(dir_path)
+    with open(os.path.join(dir_path, "saved_model.pb"), "wb") as f:
+      f.write(b"graph")
+    model_assets._extract_archive(
+        archive_path, model_assets.compute_sha256(archive_path), dir_path)
+    self.assertEqual(os.listdir(dir_path), ["saved_model.pb"])
+    self.assertEqual(os.listdir(self._cache_dir), ["model"])
+
+  def testUnknownAssetRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"Unknown model asset"):
+      model_assets.get_model_path("foo", cache_dir=self._cache_dir)
+
+  def testPrewarm(self):
+    self._registerAsset()
+    paths = model_assets.prewarm(
+        names=["test_model"], cache_dir=self._cache_dir)
+    self.assertEqual(
+        paths, {"test_model": os.path.join(self._cache_dir, "model.tflite")})
+
+  def testFetchSha256DoesNotCache(self):
+    self._registerAsset(sha256=None)
+    model_assets.set_model_cache_dir(self._cache_dir)
+    self.assertEqual(
+        model_assets.fetch_sha256(names=["test_model"]),
+        {"test_model": self._sha256})
+    self.assertFalse(os.path.exists(self._cache_dir))
+
+
+if __name__ == "__main__":
+  tf.test.main()
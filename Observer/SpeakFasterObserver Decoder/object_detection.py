@@ -4,13 +4,17 @@ from __future__ import division
 from __future__ import print_function
 
 import glob
-import tempfile
+import queue
+import threading
 
 import cv2
 import numpy as np
 import tensorflow as tf
 import tensorflow_hub as hub
 
+import file_naming
+import model_assets
+
 
 def read_image(input_image_path):
   """Reads a single image file as a tensor.
@@ -26,12 +30,31 @@ def read_image(input_image_path):
   return tf.expand_dims(tf.cast(image, tf.uint8), 0)
 
 
-def read_images(input_image_glob, frame_rate):
+def get_image_timestamps(file_paths):
+  """Gets the timestamps of images from their file names.
+
+  Args:
+    file_paths: Paths to the image files, with names in the SpeakFaster
+      Observer format (e.g., 20210710T095258428-Screenshot.jpg), sorted by
+      time.
+
+  Returns:
+    The timestamps relative to the first image, in seconds, as a list of
+      floats.
+  """
+  timestamps, _ = file_naming.parse_timestamps_from_filenames(file_paths)
+  if not len(timestamps):
+    return []
+  return ((timestamps - timestamps[0]) / np.timedelta64(1, "s")).tolist()
+
+
+def read_images(input_image_glob, frame_rate=None):
   """Reads an image file and returns its tensor representation.
 
   Args:
     input_image_glob: Glob pattern for th input images.
-    frame_rate: Frame rate in fps.
+    frame_rate: Frame rate in fps. If None, the timestamps are parsed from the
+      file names (see get_image_timestamps()).
 
   Yields:
     (image_tensor, timestamp), wherein
@@ -39,34 +62,104 @@ def read_images(input_image_glob, frame_rate):
       - timestamp is the relative timestamp for the image frame in seconds.
   """
   file_paths = sorted(glob.glob(input_image_glob))
-  timestamp = 0
-  for file_path in file_paths:
+  if frame_rate is None:
+    timestamps = get_image_timestamps(file_paths)
+  else:
+    timestamps = [i / frame_rate for i in range(len(file_paths))]
+  for file_path, timestamp in zip(file_paths, timestamps):
     yield read_image(file_path), timestamp
-    timestamp += 1.0 / frame_rate
 
 
-def read_video_file(video_file_path):
+# Maximum number of video frames decoded ahead of the consumer.
+VIDEO_PREFETCH_FRAMES = 8
+# Timeout for blocking queue operations of the prefetch thread, so that it
+# notices when the consumer stops early.
+_PREFETCH_QUEUE_TIMEOUT_SEC = 0.1
+
+
+def _iter_prefetched(iterable, max_prefetch):
+  """Iterates over an iterable in a background thread.
+
+  Args:
+    iterable: The iterable. It is consumed in a background thread.
+    max_prefetch: Maximum number of items produced ahead of the consumer.
+
+  Yields:
+    The items of the iterable, in order. Exceptions raised by the iterable
+      are re-raised in the consumer's thread.
+  """
+  items = queue.Queue(maxsize=max_prefetch)
+  stopped = threading.Event()
+  end = object()
+
+  def put(item):
+    while not stopped.is_set():
+      try:
+        items.put(item, timeout=_PREFETCH_QUEUE_TIMEOUT_SEC)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+      put((end, None))
+    except Exception as e:  # pylint: disable=broad-except
+      put((end, e))
+
+  thread = threading.Thread(target=produce, daemon=True)
+  thread.start()
+  try:
+    while True:
+      item, error = items.get()
+      if error is not None:
+        raise error
+      if item is end:
+        return
+      yield item
+  finally:
+    stopped.set()
+    thread.join()
+
+
+def _iter_video_frames(video_file_path):
+  """Yields the frames of a video file as (1, height, width, 3) RGB tensors.
+
+  Each frame is yielded along with its presentation timestamp in seconds.
+  """
+  video_cap = cv2.VideoCapture(video_file_path)
+  try:
+    success, image = video_cap.read()
+    while success:
+      timestamp = video_cap.get(cv2.CAP_PROP_POS_MSEC) / 1e3
+      image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+      yield tf.convert_to_tensor(image[np.newaxis], dtype=tf.uint8), timestamp
+      success, image = video_cap.read()
+  finally:
+    video_cap.release()
+
+
+def read_video_file(video_file_path, prefetch_frames=VIDEO_PREFETCH_FRAMES):
   """Reads given video file.
 
+  The frames are converted to RGB in memory and decoded in a background
+  thread, at most prefetch_frames ahead of the consumer.
+
   Args:
     video_file_path: Path to the input video file.
+    prefetch_frames: Maximum number of frames decoded ahead of the consumer.
 
   Yields:
     (image_tensor, timestamp), wherein
       - image_tensor is a (1, height, width, 3)-shape, uint8-dtype tf.Tensor.
-      - timestamp is the relative timestamp for the image frame in seconds.
+      - timestamp is the presentation timestamp of the frame in seconds,
+        which need not be evenly spaced (e.g., for the variable-frame-rate
+        videos from video.stitch_images_into_mp4()).
   """
-  video_cap = cv2.VideoCapture(video_file_path)
-  success, image = video_cap.read()
-  frame_rate = video_cap.get(cv2.CAP_PROP_FPS)
-  timestamp = 0.0
-  tmp_image_path = tempfile.mktemp(suffix=".jpg")
-  while success:
-    cv2.imwrite(tmp_image_path, image)     # save frame as JPEG file
-    yield read_image(tmp_image_path), timestamp
-    timestamp += 1.0 / frame_rate
-    success, image = video_cap.read()
-  tf.io.gfile.remove(tmp_image_path)
+  return _iter_prefetched(_iter_video_frames(video_file_path), prefetch_frames)
 
 
 def get_video_fps(video_file_path):
@@ -76,7 +169,11 @@ def get_video_fps(video_file_path):
 
 
 COCO_LABELS_PATH = "coco_labels.csv"
-OBJECT_DETECTION_MODEL_URL = "https://tfhub.dev/tensorflow/ssd_mobilenet_v2/fpnlite_640x640/1"
+OBJECT_DETECTION_MODEL_URL = model_assets.REGISTRY[
+    model_assets.OBJECT_DETECTOR].url
+# Size of the downsampled grayscale frames compared by detect_objects() to
+# skip frames that have not changed.
+CHANGE_DETECTION_THUMBNAIL_SIZE = (64, 64)
 _cached_objects = {
     "detector": None,
     "coco_labels": None,
@@ -98,13 +195,45 @@ def get_coco_labels():
   return _cached_objects["coco_labels"]
 
 
-def detect_objects(frame_generator, threshold_score=0.5):
+def _get_change_detection_thumbnail(image_tensor):
+  """Returns a small grayscale version of a frame, with values in [0, 1]."""
+  image = cv2.cvtColor(np.asarray(image_tensor[0]), cv2.COLOR_RGB2GRAY)
+  return cv2.resize(
+      image, CHANGE_DETECTION_THUMBNAIL_SIZE,
+      interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+
+def _parse_detections(scores, class_indices, coco_labels, threshold_score):
+  class_indices = class_indices.astype(np.int32)
+  class_indices = class_indices[scores > threshold_score]
+  scores = scores[scores > threshold_score]
+  frame_output = []
+  for class_index, score in zip(class_indices, scores):
+    class_name = coco_labels[class_index]
+    frame_output.append((class_name, score))
+  return frame_output
+
+
+def detect_objects(frame_generator,
+                   threshold_score=0.5,
+                   change_threshold=None,
+                   batch_size=1):
   """Detect objects in a series of images frames.
 
   Args:
     frame_generator: A generator that yields the (image_tensor, timestamp),
       wherein image_tensor is a (1, height, width, 3)-shape, uint8-dtype
       tf.Tensor, and timestamp is the timestamp of the frame (in seconds).
+    threshold_score: Minimum score of the detected objects.
+    change_threshold: If not None, a frame whose mean absolute difference
+      from the last frame run through the detector (on downsampled grayscale
+      versions, in the [0, 1] range) is below this threshold is not run
+      through the detector, and reuses the detections of that frame. This
+      speeds up detection on series of mostly identical screenshots.
+    batch_size: Maximum number of frames (of the same size) run through the
+      detector at a time. Values greater than 1 require a detector that
+      accepts batched input; the default SSD MobileNetV2 model from TF Hub
+      accepts only a batch size of 1.
 
   Returns:
     A list of lists. The length of the outer list is equal to the number
@@ -114,19 +243,44 @@ def detect_objects(frame_generator, threshold_score=0.5):
       the corresponding waveform.
   """
   if not _cached_objects["detector"]:
-     _cached_objects["detector"] = hub.load(OBJECT_DETECTION_MODEL_URL)
+     _cached_objects["detector"] = hub.load(
+         model_assets.get_model_path(model_assets.OBJECT_DETECTOR))
   detector = _cached_objects["detector"]
   coco_labels = get_coco_labels()
-  output = []
+  # For each frame, the index of the frame whose detections it uses.
+  source_indices = []
+  detections = dict()
+  pending = []
+
+  def flush_pending():
+    detector_output = detector(
+        tf.concat([image_tensor for _, image_tensor in pending], 0))
+    all_scores = detector_output["detection_scores"].numpy()
+    all_class_indices = detector_output["detection_classes"].numpy()
+    for j, (index, _) in enumerate(pending):
+      detections[index] = _parse_detections(
+          all_scores[j], all_class_indices[j], coco_labels, threshold_score)
+    del pending[:]
+
+  key_thumbnail = None
   for image_tensor, timestamp in frame_generator:
-    detector_output = detector(image_tensor)
-    scores = detector_output["detection_scores"][0].numpy()
-    class_indices = detector_output["detection_classes"][0].numpy().astype(np.int32)
-    class_indices = class_indices[scores > threshold_score]
-    scores = scores[scores > threshold_score]
-    frame_output = []
-    for class_index, score in zip(class_indices, scores):
-      class_name = coco_labels[class_index]
-      frame_output.append((class_name, score))
-    output.append(frame_output)
-  return output
+    index = len(source_indices)
+    if change_threshold is not None:
+      thumbnail = _get_change_detection_thumbnail(image_tensor)
+      if (key_thumbnail is not None and
+          np.mean(np.abs(thumbnail - key_thumbnail)) < change_threshold):
+        source_indices.append(source_indices[-1])
+        continue
+      key_thumbnail = thumbnail
+    source_indices.append(index)
+    if pending and pending[0][1].shape != image_tensor.shape:
+      flush_pending()
+    pending.append((index, image_tensor))
+    if len(pending) >= batch_size:
+      flush_pending()
+  if pending:
+    flush_pending()
+  if change_threshold is not None:
+    print("Ran object detection on %d of %d frames" %
+          (len(detections), len(source_indices)))
+  return [list(detections[index]) for index in source_indices]
@@ -4,7 +4,12 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import shutil
+import subprocess
+from unittest import mock
 
+import cv2
+import numpy as np
 import tensorflow as tf
 
 import object_detection
@@ -29,6 +34,38 @@ class ObjectDetectionTest(tf.test.TestCase):
     self.assertAllClose([timestamp for _, timestamp in output],
                         [0.0, 0.25, 0.5])
 
+  def testReadImagesWithTimestampsFromFileNames(self):
+    image_dir = os.path.join(self.get_temp_dir(), "screenshots")
+    os.makedirs(image_dir, exist_ok=True)
+    for i, timestamp in enumerate(
+        ("20210710T095258428", "20210710T095300928", "20210710T095301028")):
+      shutil.copy(
+          "testdata/pic%.4d-standard-size.jpg" % (i + 1),
+          os.path.join(image_dir, "%s-Screenshot.jpg" % timestamp))
+    output = list(object_detection.read_images(
+        os.path.join(image_dir, "*.jpg")))
+    self.assertAllClose([timestamp for _, timestamp in output],
+                        [0.0, 2.5, 2.6])
+
+  def testReadVideoFile_variableFrameRate(self):
+    tmp_dir = self.get_temp_dir()
+    concat_path = os.path.join(tmp_dir, "concat.txt")
+    with open(concat_path, "w") as f:
+      for i, duration in enumerate((1.0, 3.0)):
+        f.write("file '%s'\n" % os.path.abspath(
+            "testdata/pic%.4d-standard-size.jpg" % (i + 1)))
+        f.write("duration %.1f\n" % duration)
+      f.write("file '%s'\n" % os.path.abspath(
+          "testdata/pic0003-standard-size.jpg"))
+    video_path = os.path.join(tmp_dir, "vfr.mp4")
+    subprocess.check_call(
+        ["ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0",
+         "-i", concat_path, "-vsync", "vfr", video_path])
+    timestamps = [
+        timestamp
+        for _, timestamp in object_detection.read_video_file(video_path)]
+    self.assertAllClose(timestamps[:3], [0.0, 1.0, 4.0], atol=0.05)
+
   def testReadImageFromVideoFile(self):
     generator = object_detection.read_video_file("testdata/test_video_1.mp4")
     output = list(generator)
@@ -40,6 +77,21 @@ class ObjectDetectionTest(tf.test.TestCase):
     self.assertAllClose([timestamp for _, timestamp in output],
                         [0.0, 1.0, 2.0, 3.0, 4.0])
 
+  def testReadVideoFile_framesAreRgb(self):
+    video_cap = cv2.VideoCapture("testdata/test_video_1.mp4")
+    _, bgr_image = video_cap.read()
+    video_cap.release()
+    image_tensor, _ = next(
+        object_detection.read_video_file("testdata/test_video_1.mp4"))
+    self.assertAllEqual(image_tensor[0].numpy(), bgr_image[:, :, ::-1])
+
+  def testReadVideoFile_stopEarly(self):
+    generator = object_detection.read_video_file(
+        "testdata/test_video_1.mp4", prefetch_frames=1)
+    _, timestamp = next(generator)
+    self.assertEqual(timestamp, 0.0)
+    generator.close()
+
   def testGetVideoFps(self):
     self.assertEqual(
         object_detection.get_video_fps("testdata/test_video_1.mp4"), 1.0)
@@ -70,6 +122,77 @@ class ObjectDetectionTest(tf.test.TestCase):
     self.assertGreaterEqual(min(scores), 0.5)
 
 
+class IterPrefetchedTest(tf.test.TestCase):
+
+  def testYieldsItemsInOrder(self):
+    self.assertEqual(
+        list(object_detection._iter_prefetched(iter(range(100)), 3)),
+        list(range(100)))
+
+  def testReraisesError(self):
+    def items():
+      yield 1
+      raise ValueError("bad frame")
+    generator = object_detection._iter_prefetched(items(), 2)
+    self.assertEqual(next(generator), 1)
+    with self.assertRaisesRegex(ValueError, r"bad frame"):
+      next(generator)
+
+
+class _FakeDetector(object):
+  """Detects "apple" in frames whose mean pixel value is above 100."""
+
+  def __init__(self):
+    self.batch_sizes = []
+
+  def __call__(self, image_tensor):
+    self.batch_sizes.append(int(image_tensor.shape[0]))
+    means = tf.reduce_mean(tf.cast(image_tensor, tf.float32), axis=[1, 2, 3])
+    scores = tf.stack(
+        [tf.cast(means > 100, tf.float32) * 0.9,
+         tf.fill(tf.shape(means), 0.1)], axis=1)
+    classes = tf.tile(
+        tf.constant([[53.0, 1.0]]), [tf.shape(image_tensor)[0], 1])
+    return {"detection_scores": scores, "detection_classes": classes}
+
+
+class DetectObjectsWithFakeDetectorTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._detector = _FakeDetector()
+    patcher = mock.patch.dict(
+        object_detection._cached_objects, {"detector": self._detector})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _frames(self, pixel_values, shape=(1, 8, 8, 3)):
+    for i, value in enumerate(pixel_values):
+      yield tf.constant(np.full(shape, value, dtype=np.uint8)), float(i)
+
+  def testChangeThresholdSkipsUnchangedFrames(self):
+    output = object_detection.detect_objects(
+        self._frames([200, 201, 200, 0, 1, 200]), change_threshold=0.05)
+    self.assertEqual(
+        [[class_name for class_name, _ in frame] for frame in output],
+        [["apple"], ["apple"], ["apple"], [], [], ["apple"]])
+    self.assertEqual(self._detector.batch_sizes, [1, 1, 1])
+
+  def testBatchingMatchesUnbatched(self):
+    pixel_values = [200, 0, 150, 0, 255]
+    unbatched = object_detection.detect_objects(self._frames(pixel_values))
+    batched = object_detection.detect_objects(
+        self._frames(pixel_values), batch_size=2)
+    self.assertEqual(batched, unbatched)
+    self.assertEqual(self._detector.batch_sizes, [1] * 5 + [2, 2, 1])
+
+  def testBatchingFlushesOnShapeChange(self):
+    frames = list(self._frames([200, 200])) + list(
+        self._frames([0], shape=(1, 4, 4, 3)))
+    output = object_detection.detect_objects(iter(frames), batch_size=8)
+    self.assertLen(output, 3)
+    self.assertEqual(self._detector.batch_sizes, [2, 1])
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -4,10 +4,11 @@ Can generate various statistics (WPM, KSR, Error Rate) as well
 as output files capable of being used in other tools.
 """
 import argparse
-import csv
 import datetime
+import functools
 import glob
 import jsonpickle
+import numpy as np
 import os
 import re
 import string
@@ -28,6 +29,10 @@ MIN_GAZE_TIME = datetime.timedelta(milliseconds=300)
 # Assume that after 90 seconds of inactivity we are doing a new utterance
 LONG_DELTA_TIME = datetime.timedelta(seconds=90)
 
+# Maximum number of keypress protobuf files whose columns are cached by
+# load_keypress_columns().
+KEYPRESS_COLUMNS_CACHE_SIZE = 64
+
 CONTROL_KEYS = {
     "Left": "↶",  # Back one word
     "Right": "↷",  # Forward one word
@@ -950,6 +955,39 @@ def load_keypresses_from_protobuf_file(keypress_filepath):
     return keypresses
 
 
+def load_keypress_columns(keypress_filepath):
+    """Loads the keypresses of a protobuf file as columns.
+
+    The columns are cached by the path, size and modification time of the
+    file, so that stages that read the same file parse it only once.
+
+    Returns:
+        timestamps_ns: Epoch timestamps of the keypresses in nanoseconds, as
+            a read-only 1D int64 numpy array, in the order of the file.
+        keys: The keys as a tuple of strings.
+    """
+    stat = os.stat(keypress_filepath)
+    return _load_keypress_columns(
+        os.path.abspath(keypress_filepath), stat.st_size, stat.st_mtime_ns
+    )
+
+
+@functools.lru_cache(maxsize=KEYPRESS_COLUMNS_CACHE_SIZE)
+def _load_keypress_columns(keypress_filepath, size, mtime_ns):
+    del size, mtime_ns  # Used only as part of the cache key.
+    keypresses = load_keypresses_from_protobuf_file(keypress_filepath)
+    timestamps_ns = np.array(
+        [
+            keypress.Timestamp.seconds * 1000000000 + keypress.Timestamp.nanos
+            for keypress in keypresses.keyPresses
+        ],
+        dtype=np.int64,
+    )
+    timestamps_ns.flags.writeable = False
+    keys = tuple(keypress.KeyPress for keypress in keypresses.keyPresses)
+    return timestamps_ns, keys
+
+
 def load_keypresses_from_tsv_file(tsv_filepath):
     """Loads keypresses from a TSV file.
 
@@ -959,15 +997,10 @@ def load_keypresses_from_tsv_file(tsv_filepath):
     Returns:
       A list of (timestamp_s, key_content) tuples.
     """
-    timestamps_s = []
-    key_contents = []
-    with open(tsv_filepath, "rt") as f:
-        for t_begin, t_end, tier, content in csv.reader(f, delimiter="\t"):
-            if tier != tsv_data.KEYPRESS_TIER:
-                continue
-            timestamps_s.append(float(t_begin))
-            key_contents.append(content)
-    return list(zip(timestamps_s, key_contents))
+    table = tsv_data.read_tsv(
+        tsv_filepath, tiers=(tsv_data.KEYPRESS_TIER,), use_cache=True
+    )
+    return list(zip(table.tbegins.tolist(), table.contents))
 
 
 def check_keypresses(ref_keypresses, proc_keypresses):
@@ -459,5 +459,34 @@ class PhraseTest(unittest.TestCase):
     os.remove(temp_tsv_path)
 
 
+class LoadKeypressColumnsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.protobuf_path = os.path.join(self.temp_dir, "1-Keypresses.protobuf")
+    self.writeKeypresses(["h", "i"], [1634567890123, 1634567890456])
+
+  def writeKeypresses(self, chars, timestamps_millis):
+    keypresses = create_keypresses(chars, timestamps_millis=timestamps_millis)
+    with open(self.protobuf_path, "wb") as f:
+      f.write(keypresses.SerializeToString())
+
+  def testLoadsColumns(self):
+    timestamps_ns, keys = process_keypresses.load_keypress_columns(
+        self.protobuf_path)
+    self.assertEqual(list(timestamps_ns),
+                     [1634567890123000000, 1634567890456000000])
+    self.assertEqual(keys, ("h", "i"))
+    self.assertFalse(timestamps_ns.flags.writeable)
+
+  def testReloadsChangedFile(self):
+    process_keypresses.load_keypress_columns(self.protobuf_path)
+    self.writeKeypresses(["a", "b", "c"], [1000, 2000, 3000])
+    timestamps_ns, keys = process_keypresses.load_keypress_columns(
+        self.protobuf_path)
+    self.assertEqual(list(timestamps_ns), [1000000000, 2000000000, 3000000000])
+    self.assertEqual(keys, ("a", "b", "c"))
+
+
 if __name__ == "__main__":
   unittest.main()
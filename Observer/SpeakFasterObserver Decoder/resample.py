@@ -0,0 +1,184 @@
+"""Streaming polyphase resampling of audio waveforms."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+import numpy as np
+from scipy import signal
+
+# Half length of the anti-aliasing filter, in units of input (or output,
+# whichever is at the lower rate) samples. Same as scipy.signal.resample_poly.
+FILTER_HALF_LENGTH = 10
+KAISER_BETA = 5.0
+# Number of input samples processed at a time by resample().
+BLOCK_LENGTH = 1 << 16
+
+
+class StreamingResampler(object):
+  """Resamples a waveform chunk by chunk with a polyphase FIR filter.
+
+  The output is equivalent to that of scipy.signal.resample_poly() on the
+  whole waveform (with the same Kaiser-window filter), but only the filter
+  history is kept between chunks.
+  """
+
+  def __init__(self, from_rate_hz, to_rate_hz):
+    """Constructor of StreamingResampler.
+
+    Args:
+      from_rate_hz: Sample rate of the input, as an int.
+      to_rate_hz: Sample rate of the output, as an int.
+    """
+    if from_rate_hz <= 0 or to_rate_hz <= 0:
+      raise ValueError(
+          "Sample rates must be positive; got %s and %s" %
+          (from_rate_hz, to_rate_hz))
+    gcd = math.gcd(int(from_rate_hz), int(to_rate_hz))
+    self._up = int(to_rate_hz) // gcd
+    self._down = int(from_rate_hz) // gcd
+    max_rate = max(self._up, self._down)
+    h = signal.firwin(
+        2 * FILTER_HALF_LENGTH * max_rate + 1, 1.0 / max_rate,
+        window=("kaiser", KAISER_BETA)) * self._up
+    # Group delay of the filter, in upsampled samples.
+    self._delay = (len(h) - 1) // 2
+    # Polyphase decomposition: self._phases[p, q] = h[p + up * q].
+    num_taps_per_phase = -(-len(h) // self._up)
+    h = np.pad(h, [0, num_taps_per_phase * self._up - len(h)])
+    self._phases = h.reshape([num_taps_per_phase, self._up]).T.astype(
+        np.float32)
+    self._num_taps_per_phase = num_taps_per_phase
+    # Input samples that are still needed, starting at global index
+    # self._buffer_start. Samples before index 0 are zeros.
+    self._buffer = np.zeros([num_taps_per_phase - 1], dtype=np.float32)
+    self._buffer_start = -(num_taps_per_phase - 1)
+    self._num_input_samples = 0
+    self._next_output_index = 0
+    self._flushed = False
+
+  @property
+  def up(self):
+    return self._up
+
+  @property
+  def down(self):
+    return self._down
+
+  def _compute_outputs(self, end_output_index):
+    """Computes the outputs in [self._next_output_index, end_output_index)."""
+    output_indices = np.arange(
+        self._next_output_index, end_output_index, dtype=np.int64)
+    positions = output_indices * self._down + self._delay
+    # Index of the latest input sample that each output depends on.
+    latest_inputs = positions // self._up
+    phases = positions % self._up
+    input_indices = (latest_inputs[:, None] -
+                     np.arange(self._num_taps_per_phase)[None, :])
+    taps = self._buffer[input_indices - self._buffer_start]
+    ys = np.sum(taps * self._phases[phases], axis=1)
+    self._next_output_index = end_output_index
+    # Discard the input samples that are no longer needed.
+    next_latest_input = (
+        end_output_index * self._down + self._delay) // self._up
+    discard = min(
+        next_latest_input - (self._num_taps_per_phase - 1) -
+        self._buffer_start,
+        len(self._buffer))
+    if discard > 0:
+      self._buffer = self._buffer[discard:]
+      self._buffer_start += discard
+    return ys
+
+  def _available_output_end(self, num_available_inputs):
+    # Output n is available iff (n * down + delay) // up < num_inputs.
+    return max(
+        self._next_output_index,
+        -(-(num_available_inputs * self._up - self._delay) // self._down))
+
+  def process(self, xs):
+    """Resamples a chunk of the waveform.
+
+    Args:
+      xs: The next chunk of the waveform, as a 1D numpy array. int16 samples
+        are scaled to the [-1, 1] range.
+
+    Returns:
+      The resampled samples that are available so far, as a 1D float32 numpy
+        array. Its length may differ from chunk to chunk.
+    """
+    if self._flushed:
+      raise ValueError("Cannot process more samples after flush()")
+    if len(xs.shape) != 1:
+      raise ValueError("Only mono audio is supported")
+    if xs.dtype == np.int16:
+      xs = xs.astype(np.float32) / 32768
+    else:
+      xs = xs.astype(np.float32)
+    self._buffer = np.concatenate([self._buffer, xs])
+    self._num_input_samples += len(xs)
+    return self._compute_outputs(
+        self._available_output_end(self._num_input_samples))
+
+  def flush(self):
+    """Returns the remaining resampled samples at the end of the waveform.
+
+    The total number of output samples is ceil(num_inputs * up / down).
+    """
+    self._flushed = True
+    total_outputs = -(-self._num_input_samples * self._up // self._down)
+    if total_outputs <= self._next_output_index:
+      return np.zeros([0], dtype=np.float32)
+    num_padding = (
+        (total_outputs * self._down + self._delay) // self._up + 1 -
+        self._num_input_samples)
+    self._buffer = np.concatenate(
+        [self._buffer, np.zeros([max(num_padding, 0)], dtype=np.float32)])
+    return self._compute_outputs(total_outputs)
+
+
+def iter_resampled(chunks, from_rate_hz, to_rate_hz):
+  """Resamples an iterable of waveform chunks lazily.
+
+  Args:
+    chunks: An iterable of 1D numpy arrays.
+    from_rate_hz: Sample rate of the input.
+    to_rate_hz: Sample rate of the output.
+
+  Yields:
+    Non-empty chunks of resampled float32 samples in the [-1, 1] range
+      (for int16 input) or in the original range (for float input).
+  """
+  resampler = StreamingResampler(from_rate_hz, to_rate_hz)
+  for xs in chunks:
+    ys = resampler.process(xs)
+    if len(ys):
+      yield ys
+  ys = resampler.flush()
+  if len(ys):
+    yield ys
+
+
+def resample(xs, from_rate_hz, to_rate_hz, block_length=BLOCK_LENGTH):
+  """Resamples a whole waveform, block by block.
+
+  Args:
+    xs: The waveform as a 1D numpy array of dtype int16 or float.
+    from_rate_hz: Sample rate of the input.
+    to_rate_hz: Sample rate of the output.
+    block_length: Number of input samples processed at a time.
+
+  Returns:
+    The resampled waveform as a 1D numpy array of the same dtype as xs.
+  """
+  if from_rate_hz == to_rate_hz:
+    return xs
+  ys = np.concatenate(
+      [np.zeros([0], dtype=np.float32)] +
+      list(iter_resampled(
+          (xs[i:i + block_length] for i in range(0, len(xs), block_length)),
+          from_rate_hz, to_rate_hz)))
+  if xs.dtype == np.int16:
+    return np.clip(np.round(ys * 32768), -32768, 32767).astype(np.int16)
+  return ys.astype(xs.dtype)
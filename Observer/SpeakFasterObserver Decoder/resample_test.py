@@ -0,0 +1,78 @@
+"""Unit tests for the resample module."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy import signal
+import tensorflow as tf
+
+import resample
+
+
+class StreamingResamplerTest(tf.test.TestCase):
+
+  def _resampleInChunks(self, xs, from_rate_hz, to_rate_hz, chunk_lengths):
+    resampler = resample.StreamingResampler(from_rate_hz, to_rate_hz)
+    outputs = []
+    i = 0
+    for chunk_length in chunk_lengths:
+      outputs.append(resampler.process(xs[i:i + chunk_length]))
+      i += chunk_length
+    outputs.append(resampler.process(xs[i:]))
+    outputs.append(resampler.flush())
+    return np.concatenate(outputs)
+
+  def testMatchesResamplePoly(self):
+    xs = np.random.RandomState(0).normal(size=[44100 + 123]).astype(np.float32)
+    for from_rate_hz, to_rate_hz in ((44100, 16000), (48000, 16000),
+                                     (8000, 16000)):
+      ys = self._resampleInChunks(
+          xs, from_rate_hz, to_rate_hz, [1, 1000, 7, 20000])
+      gcd = np.gcd(from_rate_hz, to_rate_hz)
+      expected = signal.resample_poly(
+          xs.astype(np.float64), to_rate_hz // gcd, from_rate_hz // gcd)
+      self.assertEqual(ys.shape, expected.shape)
+      self.assertAllClose(ys, expected, atol=1e-5)
+
+  def testOutputIsIndependentOfChunking(self):
+    xs = np.random.RandomState(1).normal(size=[48000]).astype(np.float32)
+    ys_1 = self._resampleInChunks(xs, 48000, 16000, [48000])
+    ys_2 = self._resampleInChunks(xs, 48000, 16000, [3] * 1000)
+    self.assertAllClose(ys_1, ys_2, atol=1e-6)
+
+  def testProcessAfterFlushRaisesValueError(self):
+    resampler = resample.StreamingResampler(48000, 16000)
+    resampler.flush()
+    with self.assertRaisesRegex(ValueError, r"after flush"):
+      resampler.process(np.zeros(10, dtype=np.float32))
+
+  def testReducesRatio(self):
+    resampler = resample.StreamingResampler(44100, 16000)
+    self.assertEqual(resampler.up, 160)
+    self.assertEqual(resampler.down, 441)
+
+
+class ResampleTest(tf.test.TestCase):
+
+  def testInt16InputPreservesDtypeAndScale(self):
+    ts = np.arange(48000) / 48000
+    xs = (10000 * np.sin(2 * np.pi * 440 * ts)).astype(np.int16)
+    ys = resample.resample(xs, 48000, 16000, block_length=1000)
+    self.assertEqual(ys.dtype, np.int16)
+    self.assertLen(ys, 16000)
+    expected = 10000 * np.sin(2 * np.pi * 440 * np.arange(16000) / 16000)
+    self.assertAllClose(ys[100:-100], expected[100:-100], atol=50)
+
+  def testSameRateIsNoOp(self):
+    xs = np.arange(10, dtype=np.int16)
+    self.assertIs(resample.resample(xs, 16000, 16000), xs)
+
+  def testIterResampled(self):
+    chunks = [np.zeros(4410, dtype=np.float32) for _ in range(10)]
+    ys = np.concatenate(list(resample.iter_resampled(chunks, 44100, 16000)))
+    self.assertLen(ys, 16000)
+
+
+if __name__ == "__main__":
+  tf.test.main()
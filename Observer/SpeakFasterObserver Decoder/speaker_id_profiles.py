@@ -5,10 +5,11 @@ import os
 import requests
 import tempfile
 
-import librosa
 import numpy as np
 from scipy.io import wavfile
 
+import resample
+
 MIN_WAV_LENGTH_SECONDS = 20
 REQUIRED_SAMPLE_RATE_HZ = 16000
 ENROLL_MAX_WAV_LENGTH_SECONDS = 90
@@ -82,14 +83,17 @@ def _check_and_load_wav_file_length(wav_path):
       # Resample the audio to 16000 Hz.
       print("Resampling audio file %s from %d to %d Hz" %
              (wav_path, fs, REQUIRED_SAMPLE_RATE_HZ))
-      xs_hat = librosa.resample(
-          xs.astype(np.float32), fs, REQUIRED_SAMPLE_RATE_HZ).astype(np.int16)
+      # Only the part of the audio that is used for enrollment is resampled.
+      xs = xs[:int(np.ceil(ENROLL_MAX_WAV_LENGTH_SECONDS * fs))]
+      xs_hat = resample.resample(
+          xs, fs, REQUIRED_SAMPLE_RATE_HZ).astype(np.int16)
       max_length = int(ENROLL_MAX_WAV_LENGTH_SECONDS * REQUIRED_SAMPLE_RATE_HZ)
       if len(xs_hat) > max_length:
         xs_hat = xs_hat[:max_length]
       wav_path = tempfile.mktemp(suffix=".wav")
       to_delete_wav = True
       wavfile.write(wav_path, REQUIRED_SAMPLE_RATE_HZ, xs_hat)
+      fs = REQUIRED_SAMPLE_RATE_HZ
     else:
       raise ValueError(
           "Sampling rate mismatch (%d != %d); upsampling is not supported" %
@@ -0,0 +1,330 @@
+"""Runs processing stages that form a dependency graph, concurrently.
+
+Each stage declares the files that it reads (inputs) and writes (outputs). A
+stage depends on the stages that write its inputs, and starts as soon as all
+of them have finished, so independent stages run at the same time.
+
+Optionally, each stage that runs successfully records a manifest of its
+inputs (sizes, modification times and hashes), parameters and outputs. On
+the next run, a stage is skipped if its manifest shows that its outputs are
+up to date, like in make, but with content hashes so that touched or
+rewritten but unchanged inputs do not cause reruns.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+# A processing stage.
+#   name: Unique name of the stage.
+#   func: A callable with no arguments that performs the stage.
+#   inputs: Paths to the files that the stage reads. Files not written by
+#     other stages must exist before the stages are run.
+#   outputs: Paths to the files that the stage writes. Each file can be
+#     written by only one stage.
+#   params: Optional JSON-serializable parameters that affect the outputs
+#     (e.g., a time offset or a number of speakers), recorded in the manifest.
+Stage = collections.namedtuple(
+    "Stage", ("name", "func", "inputs", "outputs", "params"),
+    defaults=(None,))
+
+# Name of a force_stages entry that forces all stages to run.
+FORCE_ALL_STAGES = "all"
+MANIFEST_SUFFIX = ".manifest.json"
+# Bump this to invalidate existing manifests when their format changes.
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def get_stage_dependencies(stages):
+  """Determines the dependencies between stages from their inputs and outputs.
+
+  Args:
+    stages: A list of Stage objects.
+
+  Returns:
+    An OrderedDict mapping the name of each stage to the list of names of the
+      stages that it depends on, in the order of `stages`.
+
+  Raises:
+    ValueError: If the stage names or outputs are not unique, or if the
+      dependencies contain a cycle.
+  """
+  output_to_stage_name = dict()
+  names = set()
+  for stage in stages:
+    if stage.name in names:
+      raise ValueError("Duplicate stage name: %s" % stage.name)
+    names.add(stage.name)
+    for output in stage.outputs:
+      output = os.path.abspath(output)
+      if output in output_to_stage_name:
+        raise ValueError(
+            "Output %s is written by both stages %s and %s" %
+            (output, output_to_stage_name[output], stage.name))
+      output_to_stage_name[output] = stage.name
+  dependencies = collections.OrderedDict()
+  for stage in stages:
+    dependencies[stage.name] = []
+    for stage_input in stage.inputs:
+      dependency = output_to_stage_name.get(os.path.abspath(stage_input))
+      if dependency is not None and dependency not in dependencies[stage.name]:
+        dependencies[stage.name].append(dependency)
+  # Check for cycles by repeatedly removing stages without pending
+  # dependencies.
+  pending = {name: set(deps) for name, deps in dependencies.items()}
+  while pending:
+    ready = [name for name, deps in pending.items() if not deps]
+    if not ready:
+      raise ValueError(
+          "Stages have cyclic dependencies: %s" % ", ".join(sorted(pending)))
+    for name in ready:
+      del pending[name]
+    for deps in pending.values():
+      deps.difference_update(ready)
+  return dependencies
+
+
+def run_stages(stages, max_workers=None, manifest_dir=None,
+               force_stages=None):
+  """Runs stages with as much concurrency as their dependencies allow.
+
+  The stages are run in threads. They are expected to spend most of their
+  time in subprocesses, I/O or native code that releases the GIL.
+
+  Args:
+    stages: A list of Stage objects.
+    max_workers: Maximum number of stages that run at the same time. Defaults
+      to the number of stages.
+    manifest_dir: If not None, the directory in which the manifests of the
+      stages are kept. A stage is then skipped if its inputs (by content),
+      parameters and outputs are unchanged since it last ran successfully.
+      If None, all stages are run.
+    force_stages: Names of stages that are run even if they are up to date,
+      or FORCE_ALL_STAGES. Stages that depend on them are rerun only if their
+      outputs change.
+
+  Returns:
+    An OrderedDict mapping the name of each stage to the return value of its
+      func, or None if the stage was skipped.
+
+  Raises:
+    ValueError: If the stages are invalid (see get_stage_dependencies()), if
+      an input that is not written by any stage is missing, if a stage
+      does not write its declared outputs, or if force_stages contains an
+      unknown stage name.
+    Any exception raised by a stage, after the stages that are already
+      running have finished. Stages that have not started are not run.
+  """
+  dependencies = get_stage_dependencies(stages)
+  force_stages = set(force_stages or [])
+  if FORCE_ALL_STAGES in force_stages:
+    force_stages = set(dependencies)
+  unknown_stages = force_stages - set(dependencies)
+  if unknown_stages:
+    raise ValueError(
+        "Unknown stages to force: %s; expected some of %s" %
+        (", ".join(sorted(unknown_stages)), ", ".join(dependencies)))
+  produced = set(
+      os.path.abspath(output) for stage in stages for output in stage.outputs)
+  for stage in stages:
+    for stage_input in stage.inputs:
+      if (os.path.abspath(stage_input) not in produced and
+          not os.path.exists(stage_input)):
+        raise ValueError(
+            "Missing input of stage %s: %s" % (stage.name, stage_input))
+  if not stages:
+    return collections.OrderedDict()
+  if manifest_dir is not None:
+    os.makedirs(manifest_dir, exist_ok=True)
+
+  stages_by_name = {stage.name: stage for stage in stages}
+  pending = {name: set(deps) for name, deps in dependencies.items()}
+  results = dict()
+  error = None
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers or len(stages)) as executor:
+    futures = dict()
+
+    def submit_ready_stages():
+      for name in [name for name, deps in pending.items() if not deps]:
+        del pending[name]
+        futures[executor.submit(
+            _run_stage, stages_by_name[name], manifest_dir,
+            name in force_stages)] = name
+
+    submit_ready_stages()
+    while futures:
+      done, _ = concurrent.futures.wait(
+          futures, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        name = futures.pop(future)
+        try:
+          results[name], elapsed_s, skipped = future.result()
+        except Exception as e:  # pylint: disable=broad-except
+          print("Stage %s failed: %s" % (name, e))
+          error = error or e
+          continue
+        if skipped:
+          print("Skipped stage %s: it is up to date" % name)
+        else:
+          print("Finished stage %s in %.1f s" % (name, elapsed_s))
+        for deps in pending.values():
+          deps.discard(name)
+      if error is None:
+        submit_ready_stages()
+  if error is not None:
+    raise error
+  return collections.OrderedDict(
+      (stage.name, results[stage.name]) for stage in stages)
+
+
+def _run_stage(stage, manifest_dir, force):
+  """Runs a stage unless it is up to date, and checks its outputs.
+
+  Returns:
+    result: Return value of the stage's func, or None if it is skipped.
+    elapsed_s: Time spent, in seconds.
+    skipped: Whether the stage is skipped because it is up to date.
+  """
+  t0 = time.time()
+  if manifest_dir is not None:
+    manifest_path = os.path.join(manifest_dir, stage.name + MANIFEST_SUFFIX)
+    manifest = _read_manifest(manifest_path)
+    previous_inputs = {
+        record["path"]: record for record in manifest.get("inputs", [])}
+    # Inputs are recorded before the stage runs, so that changes made while
+    # it runs are detected next time.
+    input_records = [
+        _get_file_record(
+            stage_input, manifest_dir,
+            previous_inputs.get(_get_relative_path(stage_input, manifest_dir)),
+            with_hash=True)
+        for stage_input in stage.inputs]
+    if not force and _is_up_to_date(
+        stage, manifest, input_records, manifest_dir):
+      if input_records != manifest["inputs"]:
+        # Record the new modification times of the unchanged inputs, so that
+        # they need not be hashed again.
+        manifest["inputs"] = input_records
+        _write_manifest(manifest_path, manifest)
+      return None, time.time() - t0, True
+    if os.path.isfile(manifest_path):
+      os.remove(manifest_path)
+  print("Starting stage %s" % stage.name)
+  result = stage.func()
+  missing_outputs = [
+      output for output in stage.outputs if not os.path.exists(output)]
+  if missing_outputs:
+    raise ValueError(
+        "Stage %s did not write its outputs: %s" %
+        (stage.name, missing_outputs))
+  if manifest_dir is not None:
+    _write_manifest(manifest_path, {
+        "version": MANIFEST_VERSION,
+        "params": _normalize_params(stage.params),
+        "inputs": input_records,
+        "outputs": [
+            _get_file_record(output, manifest_dir)
+            for output in stage.outputs],
+    })
+  return result, time.time() - t0, False
+
+
+def _normalize_params(params):
+  """Converts params to their JSON form (e.g., tuples to lists)."""
+  return json.loads(json.dumps(params, sort_keys=True))
+
+
+def _get_relative_path(file_path, manifest_dir):
+  # Paths are relative to the manifest directory, so that a directory that
+  # holds both the data and the manifests can be moved.
+  return os.path.relpath(os.path.abspath(file_path), manifest_dir)
+
+
+def _compute_sha1(file_path):
+  hasher = hashlib.sha1()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+
+def _get_file_record(file_path, manifest_dir, previous_record=None,
+                     with_hash=False):
+  """Gets the manifest record of a file.
+
+  Args:
+    file_path: Path to the file.
+    manifest_dir: The manifest directory.
+    previous_record: The record of the same file in the previous manifest,
+      if any. Its hash is reused if the size and modification time of the file
+      are unchanged.
+    with_hash: Whether to include the SHA-1 hash of the contents.
+
+  Returns:
+    The record as a dict.
+  """
+  stat = os.stat(file_path)
+  record = {
+      "path": _get_relative_path(file_path, manifest_dir),
+      "size": stat.st_size,
+      "mtime_ns": stat.st_mtime_ns,
+  }
+  if with_hash:
+    if (previous_record and previous_record.get("sha1") and
+        previous_record["size"] == record["size"] and
+        previous_record["mtime_ns"] == record["mtime_ns"]):
+      record["sha1"] = previous_record["sha1"]
+    else:
+      record["sha1"] = _compute_sha1(file_path)
+  return record
+
+
+def _is_up_to_date(stage, manifest, input_records, manifest_dir):
+  """Checks whether the outputs of a stage are current according to manifest.
+  """
+  if manifest.get("version") != MANIFEST_VERSION:
+    return False
+  if manifest.get("params") != _normalize_params(stage.params):
+    return False
+  def get_contents(record):
+    return record["path"], record["size"], record["sha1"]
+  if (sorted(get_contents(record) for record in manifest["inputs"]) !=
+      sorted(get_contents(record) for record in input_records)):
+    return False
+  # The outputs must not have been deleted or modified since.
+  output_records = manifest["outputs"]
+  if (sorted(record["path"] for record in output_records) != sorted(
+      _get_relative_path(output, manifest_dir) for output in stage.outputs)):
+    return False
+  for record in output_records:
+    output_path = os.path.join(manifest_dir, record["path"])
+    if (not os.path.exists(output_path) or
+        _get_file_record(output_path, manifest_dir) != record):
+      return False
+  return True
+
+
+def _read_manifest(manifest_path):
+  """Reads a manifest. Returns an empty dict if it is missing or invalid."""
+  if not os.path.isfile(manifest_path):
+    return dict()
+  try:
+    with open(manifest_path, "r") as f:
+      return json.load(f)
+  except ValueError:
+    return dict()
+
+
+def _write_manifest(manifest_path, manifest):
+  tmp_path = manifest_path + ".tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(tmp_path, manifest_path)
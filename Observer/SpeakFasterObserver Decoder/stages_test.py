@@ -0,0 +1,228 @@
+"""Unit tests for the stages module."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+
+import tensorflow as tf
+
+import stages
+
+
+class RunStagesTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(RunStagesTest, self).setUp()
+    self.input_path = os.path.join(self.get_temp_dir(), "input.txt")
+    with open(self.input_path, "w") as f:
+      f.write("input")
+
+  def _path(self, filename):
+    return os.path.join(self.get_temp_dir(), filename)
+
+  def _makeCopyStage(self, name, input_paths, output_path, log=None,
+                     barrier=None):
+    def func():
+      if barrier is not None:
+        barrier.wait(timeout=10)
+      contents = []
+      for input_path in input_paths:
+        with open(input_path, "r") as f:
+          contents.append(f.read())
+      with open(output_path, "w") as f:
+        f.write("+".join(contents))
+      if log is not None:
+        log.append(name)
+      return name
+    return stages.Stage(name, func, input_paths, [output_path])
+
+  def testRunsIndependentStagesConcurrently(self):
+    log = []
+    # Both stages must be waiting on the barrier at the same time.
+    barrier = threading.Barrier(2)
+    merge_stage = self._makeCopyStage(
+        "merge", [self._path("a.txt"), self._path("b.txt")],
+        self._path("merged.txt"), log=log)
+    results = stages.run_stages([
+        merge_stage,
+        self._makeCopyStage(
+            "a", [self.input_path], self._path("a.txt"), log=log,
+            barrier=barrier),
+        self._makeCopyStage(
+            "b", [self.input_path], self._path("b.txt"), log=log,
+            barrier=barrier),
+    ])
+    self.assertEqual(list(results), ["merge", "a", "b"])
+    self.assertEqual(results["merge"], "merge")
+    self.assertEqual(log[-1], "merge")
+    with open(self._path("merged.txt"), "r") as f:
+      self.assertEqual(f.read(), "input+input")
+
+  def testMaxWorkersOfOneRunsStagesInDependencyOrder(self):
+    log = []
+    stages.run_stages([
+        self._makeCopyStage(
+            "c", [self._path("b.txt")], self._path("c.txt"), log=log),
+        self._makeCopyStage(
+            "b", [self._path("a.txt")], self._path("b.txt"), log=log),
+        self._makeCopyStage(
+            "a", [self.input_path], self._path("a.txt"), log=log),
+    ], max_workers=1)
+    self.assertEqual(log, ["a", "b", "c"])
+
+  def testGetStageDependencies(self):
+    dependencies = stages.get_stage_dependencies([
+        self._makeCopyStage(
+            "merge", [self._path("a.txt"), self._path("b.txt")],
+            self._path("merged.txt")),
+        self._makeCopyStage("a", [self.input_path], self._path("a.txt")),
+        self._makeCopyStage("b", [self.input_path], self._path("b.txt")),
+    ])
+    self.assertEqual(
+        dict(dependencies), {"merge": ["a", "b"], "a": [], "b": []})
+
+  def testFailedStageStopsDependentStages(self):
+    log = []
+
+    def fail():
+      raise RuntimeError("Stage failure")
+
+    with self.assertRaisesRegex(RuntimeError, "Stage failure"):
+      stages.run_stages([
+          stages.Stage("a", fail, [self.input_path], [self._path("a.txt")]),
+          self._makeCopyStage(
+              "b", [self._path("a.txt")], self._path("b.txt"), log=log),
+      ])
+    self.assertEmpty(log)
+
+  def testRaisesErrorForMissingInput(self):
+    with self.assertRaisesRegex(ValueError, "Missing input of stage a"):
+      stages.run_stages([
+          self._makeCopyStage(
+              "a", [self._path("nonexistent.txt")], self._path("a.txt"))])
+
+  def testRaisesErrorForMissingOutput(self):
+    with self.assertRaisesRegex(ValueError, "did not write its outputs"):
+      stages.run_stages([
+          stages.Stage(
+              "a", lambda: None, [self.input_path], [self._path("a.txt")])])
+
+  def testRaisesErrorForCyclicDependencies(self):
+    with self.assertRaisesRegex(ValueError, "cyclic dependencies: a, b"):
+      stages.run_stages([
+          self._makeCopyStage("a", [self._path("b.txt")], self._path("a.txt")),
+          self._makeCopyStage("b", [self._path("a.txt")], self._path("b.txt")),
+      ])
+
+  def testRaisesErrorForDuplicateOutputs(self):
+    with self.assertRaisesRegex(ValueError, "written by both stages a and b"):
+      stages.run_stages([
+          self._makeCopyStage("a", [self.input_path], self._path("a.txt")),
+          self._makeCopyStage("b", [self.input_path], self._path("a.txt")),
+      ])
+
+
+class RunStagesWithManifestsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(RunStagesWithManifestsTest, self).setUp()
+    self.data_dir = os.path.join(self.get_temp_dir(), "data")
+    os.makedirs(self.data_dir, exist_ok=True)
+    self.manifest_dir = os.path.join(self.data_dir, ".manifests")
+    self.input_path = self._path("input.txt")
+    with open(self.input_path, "w") as f:
+      f.write("input")
+    self.log = []
+
+  def _path(self, filename):
+    return os.path.join(self.data_dir, filename)
+
+  def _makeCopyStage(self, name, input_paths, output_path, params=None):
+    def func():
+      contents = []
+      for input_path in input_paths:
+        with open(input_path, "r") as f:
+          contents.append(f.read())
+      with open(output_path, "w") as f:
+        f.write("+".join(contents))
+      self.log.append(name)
+    return stages.Stage(name, func, input_paths, [output_path], params)
+
+  def _makeStages(self, params=None):
+    return [
+        self._makeCopyStage("a", [self.input_path], self._path("a.txt"),
+                            params=params),
+        self._makeCopyStage("b", [self._path("a.txt")], self._path("b.txt")),
+    ]
+
+  def _runStages(self, params=None, force_stages=None):
+    del self.log[:]
+    stages.run_stages(
+        self._makeStages(params=params), manifest_dir=self.manifest_dir,
+        force_stages=force_stages)
+    return list(self.log)
+
+  def testSkipsUpToDateStages(self):
+    self.assertEqual(self._runStages(), ["a", "b"])
+    self.assertTrue(os.path.isfile(
+        os.path.join(self.manifest_dir, "a" + stages.MANIFEST_SUFFIX)))
+    self.assertEqual(self._runStages(), [])
+
+  def testTouchedButUnchangedInputDoesNotRerun(self):
+    self._runStages()
+    stat = os.stat(self.input_path)
+    os.utime(self.input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    self.assertEqual(self._runStages(), [])
+
+  def testChangedInputRerunsDependentStages(self):
+    self._runStages()
+    with open(self.input_path, "w") as f:
+      f.write("new input")
+    self.assertEqual(self._runStages(), ["a", "b"])
+    with open(self._path("b.txt"), "r") as f:
+      self.assertEqual(f.read(), "new input")
+
+  def testChangedParamsRerunStage(self):
+    self._runStages(params={"speaker_count": 2})
+    self.assertEqual(self._runStages(params={"speaker_count": 2}), [])
+    # Output a.txt is rewritten with the same contents, so b is not rerun.
+    self.assertEqual(self._runStages(params={"speaker_count": 3}), ["a"])
+
+  def testDeletedOrModifiedOutputReruns(self):
+    self._runStages()
+    os.remove(self._path("b.txt"))
+    self.assertEqual(self._runStages(), ["b"])
+    with open(self._path("a.txt"), "w") as f:
+      f.write("edited")
+    self.assertEqual(self._runStages(), ["a"])
+
+  def testFailedStageRerunsOnlyThatStage(self):
+    self._runStages()
+    with open(self.input_path, "w") as f:
+      f.write("new input")
+
+    def fail():
+      raise RuntimeError("Transient failure")
+
+    failing_stages = self._makeStages()
+    failing_stages[1] = stages.Stage(
+        "b", fail, [self._path("a.txt")], [self._path("b.txt")])
+    del self.log[:]
+    with self.assertRaisesRegex(RuntimeError, "Transient failure"):
+      stages.run_stages(failing_stages, manifest_dir=self.manifest_dir)
+    self.assertEqual(self.log, ["a"])
+    self.assertEqual(self._runStages(), ["b"])
+
+  def testForceStages(self):
+    self._runStages()
+    self.assertEqual(self._runStages(force_stages=["b"]), ["b"])
+    self.assertEqual(
+        self._runStages(force_stages=[stages.FORCE_ALL_STAGES]), ["a", "b"])
+    with self.assertRaisesRegex(ValueError, "Unknown stages to force: c"):
+      self._runStages(force_stages=["c"])
+
+
+if __name__ == "__main__":
+  tf.test.main()
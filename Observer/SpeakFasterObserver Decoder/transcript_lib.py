@@ -1,5 +1,4 @@
 """Module for speech transcripts."""
-import csv
 import re
 from datetime import datetime
 
@@ -30,15 +29,9 @@ def load_transcripts_from_tsv_file(tsv_filepath):
   """
   column_order, has_header = elan_process_curated.infer_columns(tsv_filepath)
   rows = elan_process_curated.load_rows(
-      tsv_filepath, column_order, has_header=has_header)
-  timestamps_s = []
-  key_contents = []
-  for t_begin, t_end, tier, content in rows:
-    if tier != tsv_data.SPEECH_TRANSCRIPT_TIER:
-      continue
-    timestamps_s.append(float(t_begin))
-    key_contents.append(content)
-  return list(zip(timestamps_s, key_contents))
+      tsv_filepath, column_order, has_header=has_header,
+      tiers=(tsv_data.SPEECH_TRANSCRIPT_TIER,))
+  return [(t_begin, content) for t_begin, _, _, content in rows]
 
 
 def remove_markups(input_str):
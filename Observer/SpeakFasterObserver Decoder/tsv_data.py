@@ -1,6 +1,20 @@
 """Utilities for SpeakFaster data in the TSV format."""
 
+import collections
 import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import locale
+import mmap
+import os
+import tempfile
+import time
+import warnings
+
+import numpy as np
 
 DELIMITER = "\t"
 
@@ -26,29 +40,771 @@ VISUAL_OBJECTS_EVENTS_TIER = "VisualObjects1"
 ALL_TIERS = (AUDIO_EVENTS_TIER, KEYPRESS_TIER, KEYPRESS_PHRASE_TIER,
              SPEECH_TRANSCRIPT_TIER, VISUAL_OBJECTS_EVENTS_TIER)
 
+# Number of decimal places of the times (i.e., millisecond precision).
+TIME_DECIMALS = 3
+# Number of rows formatted and written at a time by write_rows().
+WRITE_BLOCK_ROWS = 1 << 16
+# Number of rows sorted in memory at a time by merge_tsv_files(), for files
+# that are not sorted by tBegin.
+MERGE_SORT_CHUNK_ROWS = 1 << 18
+# Suffix of the binary sidecar file that caches the parsed rows of a TSV file.
+# See read_tsv().
+CACHE_SUFFIX = ".cache.npz"
+# Suffix of the sidecar file of rows read with ignore_empty_fields=True, so
+# that readers with either setting do not overwrite each other's sidecar.
+IGNORE_EMPTY_FIELDS_CACHE_SUFFIX = ".ignore_empty_fields" + CACHE_SUFFIX
+# Bump this to invalidate existing sidecar files when their format changes.
+CACHE_VERSION = 1
+CACHE_ENCODING = "utf-8"
+# A TSV file modified within this interval before its sidecar file was
+# written is checked by hash, since a later modification within the
+# resolution of the modification time could go unnoticed.
+CACHE_RACY_INTERVAL_NS = 2 * 10**9
+HASH_BLOCK_SIZE = 1 << 20
+
+# The rows of a TSV file, as columns. Returned by read_tsv().
+#   tbegins: tBegin of each row in seconds, as a 1D float64 numpy array.
+#   tends: tEnd of each row in seconds, as a 1D float64 numpy array.
+#   tier_codes: Tier of each row as an index into tier_names, as a 1D int32
+#     numpy array.
+#   tier_names: Names of the tiers of the rows, as a tuple of strings, in the
+#     order of their first appearance.
+#   contents: Content of each row, as a list of strings.
+#   row_numbers: 1-based number of each row among all the (non-empty) rows
+#     of the file after the header, as a 1D int64 numpy array. Useful for error
+#     messages when rows are filtered or reordered.
+TsvTable = collections.namedtuple(
+    "TsvTable",
+    ("tbegins", "tends", "tier_codes", "tier_names", "contents",
+     "row_numbers"))
 
-def merge_tsv_files(tsv_paths, merged_path):
+
+def merge_tsv_files(tsv_paths, merged_path,
+                    sort_chunk_rows=MERGE_SORT_CHUNK_ROWS):
   """Merge multiple tsv files into one.
 
-  The rows are sorted by ascending tBegin.
+  The rows are sorted by ascending tBegin. Rows with equal tBegin keep the
+  order of the files and of the rows within each file.
+
+  The files are merged in a streaming fashion, so that memory use does not
+  grow with their sizes. Files that are sorted by tBegin (the usual case) are
+  read row by row. Files that are not are sorted externally first, in
+  chunks of sort_chunk_rows rows kept in temporary files.
 
   Args:
     tsv_path: Paths to tsv files to be merged.
     merged_path: Path to the result of merging.
+    sort_chunk_rows: Number of rows sorted in memory at a time for files that
+      are not sorted.
+
+  Raises:
+    ValueError: If a file does not start with the expected column heads.
+  """
+  # This pass validates the headers before anything is written.
+  are_sorted = [_is_sorted_by_tbegin(tsv_path) for tsv_path in tsv_paths]
+  merged_dir = os.path.dirname(os.path.abspath(merged_path))
+  tmp_path = merged_path + ".tmp"
+  with tempfile.TemporaryDirectory(dir=merged_dir) as tmp_dir:
+    row_iterators = []
+    for tsv_path, is_sorted in zip(tsv_paths, are_sorted):
+      if is_sorted:
+        row_iterators.append(_iter_rows(tsv_path))
+      else:
+        print("Rows of %s are not sorted by %s: sorting them externally" %
+              (tsv_path, TBEGIN_COLUMN_HEAD))
+        row_iterators.append(_iter_externally_sorted_rows(
+            tsv_path, tmp_dir, sort_chunk_rows))
+    try:
+      with open(tmp_path, "w") as f:
+        f.write(HEADER + "\n")
+        f.writelines(
+            DELIMITER.join(row) + "\n"
+            for row in heapq.merge(*row_iterators, key=_get_tbegin))
+      os.replace(tmp_path, merged_path)
+    finally:
+      if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+
+def read_tsv(tsv_path,
+             column_order=None,
+             has_header=None,
+             tiers=None,
+             ignore_empty_fields=False,
+             use_mmap=False,
+             use_cache=False):
+  """Reads the rows of a TSV file as columns.
+
+  Files without quote characters and with four fields in every row (the
+  usual case) are parsed with numpy operations on the bytes of the whole
+  file, without creating an object per field: the tiers are encoded as
+  categories, rows of other tiers are dropped, and then the times and the
+  contents of the remaining rows are parsed in bulk. Other files are parsed
+  with csv.reader. Empty rows are skipped.
+
+  Args:
+    tsv_path: Path to the TSV file.
+    column_order: Column indices of tBegin, tEnd, Tier and Content, as a
+      tuple of integers. Defaults to the order in the header, if any, or else
+      the order of COLUMN_HEADS.
+    has_header: Whether the file starts with a header row. If None, a header
+      is detected by its column heads.
+    tiers: If not None, only the rows of these tiers are kept.
+    ignore_empty_fields: Whether empty fields are removed from each row
+      before the columns are assigned (e.g., for files exported by ELAN that
+      may have extra delimiters).
+    use_mmap: Whether to parse the file from a memory map instead of reading
+      it into memory first.
+    use_cache: Whether to keep the parsed rows (of all tiers) in a binary
+      sidecar file next to the TSV file (see get_cache_path()), and to load
+      them from it instead of parsing the file while the file is unchanged.
+
+  Returns:
+    A TsvTable. Leading and trailing whitespace is removed from the tier
+      names.
+
+  Raises:
+    ValueError: If a row does not have exactly four fields, or if a tBegin or
+      tEnd is not a number.
+  """
+  encoding = locale.getpreferredencoding(False)
+  if use_cache:
+    # The file is stat'ed before it is read, so that changes made while it is
+    # read are detected next time.
+    stat = os.stat(tsv_path)
+    table = _load_cached_table(
+        tsv_path, stat, encoding, column_order, has_header,
+        ignore_empty_fields)
+    if table is not None:
+      return table if tiers is None else select_tiers(table, tiers)
+  raw_data = _read_bytes(tsv_path, use_mmap)
+  data = raw_data
+  if data.find(b"\r") != -1:
+    # Translate newlines like open() in text mode does.
+    data = bytes(data).replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+  if len(data) and data[-1:] != b"\n":
+    # Make every field end with a delimiter or newline.
+    data = bytes(data) + b"\n"
+  body_start = 0
+  while data[body_start:body_start + 1] == b"\n":
+    body_start += 1
+  first_line = None
+  if body_start < len(data):
+    first_line_end = data.find(b"\n", body_start)
+    first_line = bytes(data[body_start:first_line_end]).decode(encoding)
+  column_order, has_header = _resolve_columns(
+      first_line, column_order, has_header, ignore_empty_fields)
+  if has_header and first_line is not None:
+    body_start = first_line_end + 1
+  table = _parse_tsv(
+      tsv_path, data, body_start, encoding, column_order,
+      None if use_cache else tiers, ignore_empty_fields)
+  if use_cache:
+    _write_cached_table(tsv_path, table, {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": hashlib.sha1(raw_data).hexdigest(),
+        "encoding": encoding,
+        "first_line": first_line,
+        "column_order": list(column_order),
+        "has_header": has_header,
+        "ignore_empty_fields": ignore_empty_fields,
+    })
+    if tiers is not None:
+      table = select_tiers(table, tiers)
+  return table
+
+
+def get_tiers(table):
+  """Returns the tier names of the rows of a TsvTable, as a list."""
+  return [table.tier_names[code] for code in table.tier_codes.tolist()]
+
+
+def get_cache_path(tsv_path, ignore_empty_fields=False):
+  """Returns the path to the binary sidecar file of a TSV file.
+
+  The sidecar file is hidden, and its name does not end in .tsv, so that it
+  is not mistaken for data (e.g., when the TSV files of a session are
+  uploaded).
+
+  Args:
+    tsv_path: Path to the TSV file.
+    ignore_empty_fields: ignore_empty_fields as passed to read_tsv(). The rows
+      read with either setting are kept in separate sidecar files.
+  """
+  dir_path, basename = os.path.split(tsv_path)
+  suffix = (IGNORE_EMPTY_FIELDS_CACHE_SUFFIX if ignore_empty_fields
+            else CACHE_SUFFIX)
+  return os.path.join(dir_path, "." + basename + suffix)
+
+
+def _resolve_columns(first_line, column_order, has_header,
+                     ignore_empty_fields):
+  """Determines the column order and whether there is a header.
+
+  Args:
+    first_line: The first non-empty line of the file, or None if the file is
+      empty.
+    column_order: column_order as passed to read_tsv().
+    has_header: has_header as passed to read_tsv().
+    ignore_empty_fields: ignore_empty_fields as passed to read_tsv().
+
+  Returns:
+    The column order, as a tuple of integers.
+    Whether the file has a header row.
+  """
+  if first_line is not None:
+    header = _split_line(first_line, ignore_empty_fields)
+    is_header = sorted(header) == sorted(COLUMN_HEADS)
+    if has_header is None:
+      has_header = is_header
+    if has_header and column_order is None and is_header:
+      column_order = tuple(header.index(head) for head in COLUMN_HEADS)
+  if column_order is None:
+    column_order = (0, 1, 2, 3)
+  return tuple(column_order), bool(has_header)
+
+
+def _parse_tsv(tsv_path, data, body_start, encoding, column_order, tiers,
+               ignore_empty_fields):
+  """Parses the rows of a TSV file from its bytes. See read_tsv()."""
+  buf = np.frombuffer(data, dtype=np.uint8) if len(data) else np.zeros(
+      [0], dtype=np.uint8)
+  field_bounds = None
+  if data.find(b'"') == -1:
+    field_bounds = _find_fields(buf, body_start)
+    if (field_bounds is not None and ignore_empty_fields and
+        np.any(field_bounds[0] == field_bounds[1])):
+      field_bounds = None
+  if field_bounds is None:
+    return _read_tsv_with_csv_reader(
+        tsv_path, bytes(data[body_start:]).decode(encoding), column_order,
+        tiers, ignore_empty_fields)
+
+  field_starts, field_ends = field_bounds
+  col_tbegin, col_tend, col_tier, col_content = column_order
+  tier_codes, tier_names = _encode_categories(
+      buf, field_starts[:, col_tier], field_ends[:, col_tier], encoding)
+  row_numbers = np.arange(1, len(tier_codes) + 1, dtype=np.int64)
+  if tiers is not None:
+    keep, tier_codes, tier_names = _filter_tiers(tier_codes, tier_names, tiers)
+    field_starts = field_starts[keep]
+    field_ends = field_ends[keep]
+    row_numbers = row_numbers[keep]
+  return TsvTable(
+      tbegins=_parse_floats(
+          buf, field_starts[:, col_tbegin], field_ends[:, col_tbegin],
+          encoding),
+      tends=_parse_floats(
+          buf, field_starts[:, col_tend], field_ends[:, col_tend], encoding),
+      tier_codes=tier_codes,
+      tier_names=tier_names,
+      contents=_decode_fields(
+          buf, field_starts[:, col_content], field_ends[:, col_content],
+          encoding),
+      row_numbers=row_numbers)
+
+
+def _load_cached_table(tsv_path, stat, encoding, column_order, has_header,
+                       ignore_empty_fields):
+  """Loads the rows of a TSV file from its sidecar file.
+
+  Returns:
+    A TsvTable of the rows of all tiers, or None if there is no sidecar file,
+      or if it is outdated or was written with different arguments.
+  """
+  cache_path = get_cache_path(tsv_path, ignore_empty_fields)
+  if not os.path.isfile(cache_path):
+    return None
+  try:
+    with np.load(cache_path, allow_pickle=False) as npz:
+      metadata = json.loads(str(npz["metadata"]))
+      if (metadata.get("version") != CACHE_VERSION or
+          metadata["size"] != stat.st_size or
+          metadata["encoding"] != encoding or
+          metadata["ignore_empty_fields"] != ignore_empty_fields):
+        return None
+      if (_resolve_columns(
+              metadata["first_line"], column_order, has_header,
+              ignore_empty_fields) !=
+          (tuple(metadata["column_order"]), metadata["has_header"])):
+        return None
+      # Like in git, the modification time is trusted only if the file was
+      # not modified shortly before the sidecar file was written, which could
+      # go unnoticed by the modification time.
+      if (metadata["mtime_ns"] != stat.st_mtime_ns or
+          metadata["written_ns"] - stat.st_mtime_ns < CACHE_RACY_INTERVAL_NS):
+        if _compute_sha1(tsv_path) != metadata["sha1"]:
+          return None
+      arrays = {key: npz[key] for key in npz.files if key != "metadata"}
+  except (OSError, ValueError, KeyError) as e:
+    print("Ignoring the invalid cache file %s: %s" % (cache_path, e))
+    return None
+  blob = arrays["content_bytes"]
+  starts = arrays["content_starts"]
+  ends = arrays["content_ends"]
+  if metadata["contents_have_newlines"]:
+    contents = [bytes(blob[begin:end]).decode(CACHE_ENCODING)
+                for begin, end in zip(starts.tolist(), ends.tolist())]
+  else:
+    contents = _decode_fields(blob, starts, ends, CACHE_ENCODING)
+  table = TsvTable(
+      tbegins=arrays["tbegins"],
+      tends=arrays["tends"],
+      tier_codes=arrays["tier_codes"],
+      tier_names=tuple(metadata["tier_names"]),
+      contents=contents,
+      row_numbers=arrays["row_numbers"])
+  if metadata["mtime_ns"] != stat.st_mtime_ns:
+    # Record the new modification time of the unchanged file, so that it
+    # need not be hashed again.
+    metadata["mtime_ns"] = stat.st_mtime_ns
+    _write_cached_table(tsv_path, table, metadata)
+  return table
+
+
+def _write_cached_table(tsv_path, table, metadata):
+  """Writes the rows of a TSV file to its sidecar file, atomically.
+
+  Failure to write (e.g., in a read-only directory) is reported but not
+  raised, since the sidecar file is only an optimization.
+  """
+  cache_path = get_cache_path(tsv_path, metadata["ignore_empty_fields"])
+  tmp_path = cache_path + ".tmp"
+  # Contents are stored as one UTF-8 blob with the offsets of each content.
+  # Unless a content contains a newline, each content is followed by a
+  # newline, so that contents can be decoded with one decode call.
+  text = "\n".join(table.contents)
+  contents_have_newlines = text.count("\n") > max(len(table.contents) - 1, 0)
+  if contents_have_newlines:
+    encoded = [content.encode(CACHE_ENCODING) for content in table.contents]
+    content_ends = np.cumsum(
+        [len(item) for item in encoded], dtype=np.int64)
+    content_starts = content_ends - [len(item) for item in encoded]
+    # A byte follows the last content, as _decode_fields() expects.
+    content_bytes = np.frombuffer(b"".join(encoded) + b"\n", dtype=np.uint8)
+  else:
+    content_bytes = np.frombuffer(
+        (text + "\n").encode(CACHE_ENCODING), dtype=np.uint8)
+    content_ends = np.flatnonzero(content_bytes == ord("\n"))
+    content_starts = np.concatenate([[0], content_ends[:-1] + 1])
+    if not table.contents:
+      content_ends = content_starts = np.zeros([0], dtype=np.int64)
+  metadata = dict(metadata)
+  metadata.update({
+      "version": CACHE_VERSION,
+      "written_ns": time.time_ns(),
+      "tier_names": list(table.tier_names),
+      "contents_have_newlines": bool(contents_have_newlines),
+  })
+  try:
+    with open(tmp_path, "wb") as f:
+      np.savez(
+          f,
+          metadata=np.array(json.dumps(metadata)),
+          tbegins=table.tbegins,
+          tends=table.tends,
+          tier_codes=table.tier_codes,
+          row_numbers=table.row_numbers,
+          content_bytes=content_bytes,
+          content_starts=content_starts.astype(np.int64),
+          content_ends=content_ends.astype(np.int64))
+    os.replace(tmp_path, cache_path)
+  except OSError as e:
+    print("Cannot write the cache file %s: %s" % (cache_path, e))
+  finally:
+    if os.path.isfile(tmp_path):
+      os.remove(tmp_path)
+
+
+def _compute_sha1(file_path):
+  hasher = hashlib.sha1()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+
+def select_tiers(table, tiers):
+  """Selects the rows of the given tiers of a TsvTable.
+
+  Args:
+    table: A TsvTable, e.g., as returned by read_tsv().
+    tiers: Names of the tiers whose rows are kept.
+
+  Returns:
+    A TsvTable of the selected rows, in their original order.
+  """
+  keep, tier_codes, tier_names = _filter_tiers(
+      table.tier_codes, table.tier_names, tiers)
+  return TsvTable(
+      tbegins=table.tbegins[keep],
+      tends=table.tends[keep],
+      tier_codes=tier_codes,
+      tier_names=tier_names,
+      contents=list(itertools.compress(table.contents, keep)),
+      row_numbers=table.row_numbers[keep])
+
+
+def _read_bytes(tsv_path, use_mmap):
+  """Returns the contents of a file as bytes or as a read-only memory map."""
+  with open(tsv_path, "rb") as f:
+    if not use_mmap or not os.fstat(f.fileno()).st_size:
+      return f.read()
+    # The map stays valid after the file is closed. It is unmapped when it is
+    # garbage-collected, i.e., after the arrays that view it are.
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _split_line(line, ignore_empty_fields):
+  items = line.split(DELIMITER)
+  if ignore_empty_fields:
+    items = [item for item in items if item]
+  return items
+
+
+def _find_fields(buf, body_start):
+  """Finds the fields of the rows, if every row has len(COLUMN_HEADS) fields.
+
+  Args:
+    buf: The bytes of the file as a uint8 numpy array, ending with a newline.
+    body_start: Offset of the first row (after the header, if any).
+
+  Returns:
+    Begin offsets of the fields and end offsets (i.e., offsets of the
+      delimiter or newline after each field), as two
+      [num_rows, len(COLUMN_HEADS)] int64 numpy arrays, or None if any
+      non-empty line has a different number of fields.
+  """
+  body = buf[body_start:]
+  separators = np.flatnonzero(
+      (body == ord(DELIMITER)) | (body == ord("\n"))) + body_start
+  num_fields = len(COLUMN_HEADS)
+  if not len(separators):
+    empty = np.zeros([0, num_fields], dtype=np.int64)
+    return empty, empty
+  field_starts = np.concatenate([[body_start], separators[:-1] + 1])
+  is_newline = buf[separators] == ord("\n")
+  is_empty_line = is_newline & (field_starts == separators) & np.concatenate(
+      [[True], is_newline[:-1]])
+  if np.any(is_empty_line):
+    separators = separators[~is_empty_line]
+    field_starts = field_starts[~is_empty_line]
+    is_newline = is_newline[~is_empty_line]
+  if len(separators) % num_fields or np.any(
+      is_newline.reshape([-1, num_fields]) !=
+      (np.arange(num_fields) == num_fields - 1)):
+    return None
+  return (field_starts.reshape([-1, num_fields]),
+          separators.reshape([-1, num_fields]))
+
+
+def _select_fields(buf, starts, ends):
+  """Selects the bytes of fields, each followed by its delimiter or newline.
+
+  Returns:
+    The selected bytes as a uint8 numpy array.
+    The offsets of the delimiters and newlines in it.
+  """
+  lengths = ends - starts + 1
+  offsets = np.cumsum(lengths) - lengths
+  indices = np.arange(offsets[-1] + lengths[-1]) + np.repeat(
+      starts - offsets, lengths)
+  return buf[indices], offsets + lengths - 1
+
+
+def _decode_fields(buf, starts, ends, encoding):
+  """Decodes fields into a list of strings with one decode call."""
+  if not len(starts):
+    return []
+  selected, terminators = _select_fields(buf, starts, ends)
+  selected[terminators] = ord("\n")
+  return selected.tobytes().decode(encoding).split("\n")[:-1]
+
+
+def _parse_floats(buf, starts, ends, encoding):
+  """Parses fields as float64 numbers, like float() does."""
+  if not len(starts):
+    return np.zeros([0], dtype=np.float64)
+  selected, terminators = _select_fields(buf, starts, ends)
+  selected[terminators] = ord(" ")
+  # np.fromstring() parses whitespace-separated numbers in C. The fields must
+  # be non-empty and contain no whitespace for the numbers to correspond to
+  # the fields. Invalid numbers end the parsing early.
+  if (np.all(ends > starts) and
+      np.count_nonzero(selected <= ord(" ")) == len(starts)):
+    try:
+      with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(selected.tobytes(), dtype=np.float64, sep=" ")
+      if len(values) == len(starts):
+        return values
+    except ValueError:
+      pass
+  return np.array(
+      [float(field) for field in _decode_fields(buf, starts, ends, encoding)],
+      dtype=np.float64)
+
+
+def _encode_categories(buf, starts, ends, encoding):
+  """Encodes stripped fields as categories.
+
+  There are few distinct fields (e.g., tiers), so the fields are grouped by
+  their lengths and first bytes, and each group is compared with its first
+  field, byte by byte, which is faster than decoding or sorting the fields.
+
+  Returns:
+    codes: Index of the category of each field, as a 1D int32 numpy array.
+    names: Names of the categories in the order of their first appearance,
+      as a tuple of strings.
+  """
+  lengths = ends - starts
+  keys = lengths * 256 + np.where(lengths > 0, buf[starts], 0)
+  # words[i] holds the 8 bytes from offset i (unaligned), for comparing
+  # 8 bytes at a time.
+  words = np.ndarray(
+      [max(len(buf) - 7, 0)], dtype="<u8", buffer=buf, strides=[1])
+  _, group_ids = np.unique(keys, return_inverse=True)
+  group_ids = group_ids.ravel()
+  codes = np.empty([len(starts)], dtype=np.int32)
+  name_to_code = dict()
+  first_rows = []
+  for group_id in range(int(group_ids.max()) + 1 if len(group_ids) else 0):
+    rows = np.flatnonzero(group_ids == group_id)
+    while len(rows):
+      # Find the rows equal to the first one.
+      first_start = starts[rows[0]]
+      length = lengths[rows[0]]
+      is_equal = np.ones([len(rows)], dtype=bool)
+      row_starts = starts[rows]
+      if length >= 8:
+        # The last word may overlap the previous one.
+        for i in sorted(set(range(0, length - 7, 8)) | {length - 8}):
+          is_equal &= words[row_starts + i] == words[first_start + i]
+      else:
+        for i in range(1, length):
+          is_equal &= buf[row_starts + i] == buf[first_start + i]
+      name = bytes(buf[first_start:first_start + length]).decode(
+          encoding).strip()
+      if name not in name_to_code:
+        name_to_code[name] = len(name_to_code)
+        first_rows.append(rows[0])
+      else:
+        first_rows[name_to_code[name]] = min(
+            first_rows[name_to_code[name]], rows[0])
+      codes[rows[is_equal]] = name_to_code[name]
+      rows = rows[~is_equal]
+  # Number the categories in the order of their first appearance.
+  order = np.argsort(first_rows)
+  renumbering = np.empty([len(order)], dtype=np.int32)
+  renumbering[order] = np.arange(len(order))
+  names = list(name_to_code)
+  return renumbering[codes], tuple(names[i] for i in order)
+
+
+def _filter_tiers(tier_codes, tier_names, tiers):
+  """Selects the rows of the given tiers.
+
+  Returns:
+    keep: Whether each row is kept, as a 1D bool numpy array.
+    tier_codes: The tier codes of the kept rows, renumbered.
+    tier_names: The names of the tiers of the kept rows.
+  """
+  tiers = set(tiers)
+  keep = np.isin(tier_codes, [
+      code for code, name in enumerate(tier_names) if name in tiers])
+  kept_codes = np.unique(tier_codes[keep])
+  return (keep,
+          np.searchsorted(kept_codes, tier_codes[keep]).astype(np.int32),
+          tuple(tier_names[code] for code in kept_codes))
+
+
+def _read_tsv_with_csv_reader(tsv_path, text, column_order, tiers,
+                              ignore_empty_fields):
+  """Reads the rows of a TSV file (after the header) with csv.reader."""
+  columns = [[] for _ in COLUMN_HEADS]
+  reader = csv.reader(io.StringIO(text), delimiter=DELIMITER)
+  for i, row in enumerate(row for row in reader if row):
+    if ignore_empty_fields:
+      row = [item for item in row if item]
+    if len(row) != len(COLUMN_HEADS):
+      raise ValueError(
+          "Line %d of the file %s contains %d columns; expected %d" %
+          (i + 1, tsv_path, len(row), len(COLUMN_HEADS)))
+    for column, item in zip(columns, row):
+      column.append(item)
+  tbegins, tends, tier_strs, contents = (columns[i] for i in column_order)
+  tier_names = []
+  tier_codes = []
+  for tier in tier_strs:
+    tier = tier.strip()
+    if tier not in tier_names:
+      tier_names.append(tier)
+    tier_codes.append(tier_names.index(tier))
+  tier_codes = np.array(tier_codes, dtype=np.int32)
+  tier_names = tuple(tier_names)
+  row_numbers = np.arange(1, len(contents) + 1, dtype=np.int64)
+  if tiers is not None:
+    keep, tier_codes, tier_names = _filter_tiers(tier_codes, tier_names, tiers)
+    tbegins = list(itertools.compress(tbegins, keep))
+    tends = list(itertools.compress(tends, keep))
+    contents = list(itertools.compress(contents, keep))
+    row_numbers = row_numbers[keep]
+  return TsvTable(
+      tbegins=np.array([float(t) for t in tbegins], dtype=np.float64),
+      tends=np.array([float(t) for t in tends], dtype=np.float64),
+      tier_codes=tier_codes,
+      tier_names=tier_names,
+      contents=contents,
+      row_numbers=row_numbers)
+
+
+def _get_tbegin(row):
+  return float(row[0])
+
+
+def _iter_rows(tsv_path):
+  """Yields the non-empty rows of a tsv file, after checking its header."""
+  with open(tsv_path, "r") as f:
+    reader = csv.reader(f, delimiter=DELIMITER)
+    header = next((row for row in reader if row), None)
+    if header != list(COLUMN_HEADS):
+      raise ValueError("In file %s, expected column heads %s, got %s" %
+          (tsv_path, COLUMN_HEADS, header))
+    for row in reader:
+      if row:
+        yield row
+
+
+def _is_sorted_by_tbegin(tsv_path):
+  previous_tbegin = -float("inf")
+  for row in _iter_rows(tsv_path):
+    tbegin = _get_tbegin(row)
+    if tbegin < previous_tbegin:
+      return False
+    previous_tbegin = tbegin
+  return True
+
+
+def _iter_run_rows(run_path):
+  with open(run_path, "r", newline="") as f:
+    for row in csv.reader(f, delimiter=DELIMITER):
+      yield row
+
+
+def _iter_externally_sorted_rows(tsv_path, tmp_dir, sort_chunk_rows):
+  """Sorts the rows of a tsv file by tBegin, stably, using temporary files.
+
+  Each chunk of rows is sorted in memory and written to a temporary file (a
+  run), then the runs are merged.
+
+  Returns:
+    An iterator over the sorted rows.
+  """
+  rows = _iter_rows(tsv_path)
+  run_iterators = []
+  while True:
+    chunk = list(itertools.islice(rows, sort_chunk_rows))
+    if not chunk:
+      break
+    chunk.sort(key=_get_tbegin)
+    fd, run_path = tempfile.mkstemp(dir=tmp_dir, suffix=".tsv")
+    with os.fdopen(fd, "w", newline="") as f:
+      csv.writer(f, delimiter=DELIMITER, lineterminator="\n").writerows(chunk)
+    run_iterators.append(_iter_run_rows(run_path))
+  return heapq.merge(*run_iterators, key=_get_tbegin)
+
+
+def format_times(times_s):
+  """Formats times with TIME_DECIMALS decimal places, like "%.3f" does.
+
+  This is a vectorized equivalent of `["%.3f" % t for t in times_s]`: the
+  digits of all the times are computed as numpy arrays.
+
+  Args:
+    times_s: Times in seconds, as a 1D array-like of floats.
+
+  Returns:
+    A list of strings.
+  """
+  times_s = np.asarray(times_s, dtype=np.float64)
+  if not times_s.size:
+    return []
+  if not np.all(np.isfinite(times_s)):
+    raise ValueError("Cannot format non-finite times")
+  frac_scale = 10**TIME_DECIMALS
+  scaled = times_s * frac_scale
+  rounded = np.rint(scaled)
+  # Where the rounded product is halfway between two integers, the exact
+  # product may not be. Round those by the sign of the rounding error of the
+  # product, computed exactly by splitting the times into halves (Dekker).
+  ties = scaled - np.floor(scaled) == 0.5
+  if np.any(ties):
+    tie_times_s = times_s[ties]
+    split = 134217729.0 * tie_times_s
+    high = split - (split - tie_times_s)
+    low = tie_times_s - high
+    errors = (high * frac_scale - scaled[ties]) + low * frac_scale
+    rounded[ties] = np.where(
+        errors > 0, np.ceil(scaled[ties]),
+        np.where(errors < 0, np.floor(scaled[ties]), rounded[ties]))
+  magnitudes = np.abs(rounded.astype(np.int64))
+  int_parts = magnitudes // frac_scale
+  frac_parts = magnitudes % frac_scale
+  int_width = len(str(int(int_parts.max())))
+  int_digit_counts = np.ones(len(int_parts), dtype=np.int64)
+  for power in range(1, int_width):
+    int_digit_counts += int_parts >= 10**power
+  # Each row holds an optional sign, the (left-padded) integer digits, the
+  # decimal point, the fractional digits and a newline that separates rows.
+  chars = np.empty([len(times_s), int_width + TIME_DECIMALS + 3],
+                   dtype=np.uint8)
+  chars[:, 0] = ord("-")
+  for i in range(int_width):
+    chars[:, 1 + i] = int_parts // 10**(int_width - 1 - i) % 10 + ord("0")
+  chars[:, 1 + int_width] = ord(".")
+  for i in range(TIME_DECIMALS):
+    chars[:, 2 + int_width + i] = (
+        frac_parts // 10**(TIME_DECIMALS - 1 - i) % 10 + ord("0"))
+  chars[:, -1] = ord("\n")
+  keep = np.ones(chars.shape, dtype=bool)
+  # Like "%.3f", keep the sign of negative times that round to zero.
+  keep[:, 0] = np.signbit(times_s)
+  keep[:, 1:1 + int_width] = (
+      np.arange(int_width) >= int_width - int_digit_counts[:, None])
+  return chars[keep].tobytes().decode("ascii").split("\n")[:-1]
+
+
+def write_rows(f, tbegins, tends, tiers, contents,
+               block_rows=WRITE_BLOCK_ROWS):
+  """Writes rows to an open TSV file in large blocks.
+
+  The times are formatted with format_times() and each block of rows is
+  written with a single write call, which is much faster than formatting and
+  writing the rows one by one for millions of rows.
+
+  Args:
+    f: The file object, opened for writing text.
+    tbegins: Begin times of the rows in seconds, as a 1D array-like.
+    tends: End times of the rows in seconds, as a 1D array-like.
+    tiers: The tier of all the rows, as a string, or the tiers of the
+      individual rows, as a sequence of strings.
+    contents: Contents of the rows, as a sequence of strings.
+    block_rows: Number of rows written at a time.
   """
-  rows = []
-  for tsv_path in tsv_paths:
-    with open(tsv_path, "r") as f:
-      reader = csv.reader(f, delimiter=DELIMITER)
-      file_rows = list(reader)
-      # Discard empty rows.
-      file_rows = [row for row in file_rows if row]
-      if file_rows[0] != list(COLUMN_HEADS):
-        raise ValueError("In file %s, expected column heads %s, got %s" %
-            (tsv_path, COLUMN_HEADS, file_rows[0]))
-      rows.extend(file_rows[1:])
-  rows = sorted(rows, key=lambda row: float(row[0]))
-  with open(merged_path, "w") as f:
-    f.write(HEADER + "\n")
-    for row in rows:
-      f.write(DELIMITER.join(row) + "\n")
+  num_rows = len(contents)
+  if len(tbegins) != num_rows or len(tends) != num_rows or (
+      not isinstance(tiers, str) and len(tiers) != num_rows):
+    raise ValueError("Mismatch in the lengths of the columns")
+  for start in range(0, num_rows, block_rows):
+    end = min(start + block_rows, num_rows)
+    length = end - start
+    # Each row is made of 8 parts: 4 fields, 3 delimiters and a newline.
+    parts = [DELIMITER] * (8 * length)
+    parts[0::8] = format_times(tbegins[start:end])
+    parts[2::8] = format_times(tends[start:end])
+    parts[4::8] = [tiers] * length if isinstance(tiers, str) else list(
+        tiers[start:end])
+    parts[6::8] = list(contents[start:end])
+    parts[7::8] = ["\n"] * length
+    f.write("".join(parts))
@@ -1,7 +1,9 @@
 """Unit tests for modeul tsv_data."""
 import csv
 import os
+from unittest import mock
 
+import numpy as np
 import tensorflow as tf
 
 import tsv_data
@@ -91,6 +93,46 @@ class MergeTsvFilesTest(tf.test.TestCase):
     self.assertEqual(rows[2], ["11.100", "11.200", "Keypress", "i"])
     self.assertEqual(rows[3], ["12.100", "12.200", "SpeechTranscript", "Hello"])
 
+  def testMergeUnsortedFile_sortsExternallyAndStably(self):
+    tsv_path_3 = os.path.join(self.get_temp_dir(), "3.tsv")
+    with open(tsv_path_3, "w") as f:
+      f.write(tsv_data.HEADER + "\n")
+      f.write("11.100\t11.300\tAudioEvents1\tSpeech\n")
+      f.write("0.500\t0.600\tAudioEvents1\tMusic\n")
+      f.write("10.100\t10.300\tAudioEvents1\tSpeech\n")
+      f.write("0.100\t0.200\tAudioEvents1\tSilence\n")
+      f.write("0.500\t0.700\tAudioEvents1\tTyping\n")
+    merged_tsv_path = os.path.join(self.get_temp_dir(), "merged.tsv")
+    tsv_data.merge_tsv_files(
+        [self.tsv_path_1, tsv_path_3, self.tsv_path_2], merged_tsv_path,
+        sort_chunk_rows=2)
+    with open(merged_tsv_path) as f:
+      reader = csv.reader(f, delimiter=tsv_data.DELIMITER)
+      rows = list(reader)
+    self.assertEqual(rows, [
+        list(tsv_data.COLUMN_HEADS),
+        ["0.100", "0.200", "AudioEvents1", "Silence"],
+        ["0.100", "1.100", "SpeechTranscript", "Hello how are you"],
+        ["0.500", "0.600", "AudioEvents1", "Music"],
+        ["0.500", "0.700", "AudioEvents1", "Typing"],
+        ["10.100", "10.200", "Keypress", "h"],
+        ["10.100", "10.300", "AudioEvents1", "Speech"],
+        ["11.100", "11.200", "Keypress", "i"],
+        ["11.100", "11.300", "AudioEvents1", "Speech"],
+        ["12.100", "13.100", "SpeechTranscript", "What's up"],
+    ])
+    self.assertNotIn("merged.tsv.tmp", os.listdir(self.get_temp_dir()))
+
+  def testEmptyFile_raisesValueErrorWithoutWritingOutput(self):
+    empty_tsv_path = os.path.join(self.get_temp_dir(), "empty.tsv")
+    with open(empty_tsv_path, "w") as f:
+      pass
+    merged_tsv_path = os.path.join(self.get_temp_dir(), "merged_empty.tsv")
+    with self.assertRaisesRegex(ValueError, "expected column heads"):
+      tsv_data.merge_tsv_files(
+          [self.tsv_path_1, empty_tsv_path], merged_tsv_path)
+    self.assertFalse(os.path.exists(merged_tsv_path))
+
 
 class TsvDataTest(tf.test.TestCase):
 
@@ -98,5 +140,346 @@ class TsvDataTest(tf.test.TestCase):
     self.assertLen(set(tsv_data.ALL_TIERS), len(tsv_data.ALL_TIERS))
 
 
+class ReadTsvTest(tf.test.TestCase):
+
+  def _write(self, text, mode="w"):
+    tsv_path = os.path.join(self.get_temp_dir(), "input.tsv")
+    with open(tsv_path, mode) as f:
+      f.write(text)
+    return tsv_path
+
+  def _to_rows(self, table):
+    return list(zip(table.tbegins.tolist(), table.tends.tolist(),
+                    tsv_data.get_tiers(table), table.contents))
+
+  def testReadsColumns(self):
+    tsv_path = self._write(
+        tsv_data.HEADER + "\n"
+        "0.100\t1.100\tSpeechTranscript\tHello how are you\n"
+        "10.100\t10.200\tKeypress\th\n"
+        "11.100\t11.200\tKeypress\ti\n")
+    table = tsv_data.read_tsv(tsv_path)
+    self.assertEqual(table.tbegins.dtype, np.float64)
+    self.assertAllEqual(table.tbegins, [0.1, 10.1, 11.1])
+    self.assertAllEqual(table.tends, [1.1, 10.2, 11.2])
+    self.assertAllEqual(table.tier_codes, [0, 1, 1])
+    self.assertEqual(table.tier_names, ("SpeechTranscript", "Keypress"))
+    self.assertEqual(table.contents, ["Hello how are you", "h", "i"])
+    self.assertAllEqual(table.row_numbers, [1, 2, 3])
+
+  def testFiltersTiers(self):
+    tsv_path = self._write(
+        tsv_data.HEADER + "\n"
+        "0.100\t1.100\tSpeechTranscript\tHello\n"
+        "10.100\t10.200\tKeypress\th\n"
+        "10.500\t11.000\tAudioEvents1\tSpeech\n"
+        "11.100\t11.200\tKeypress\ti\n")
+    table = tsv_data.read_tsv(
+        tsv_path,
+        tiers=(tsv_data.KEYPRESS_TIER, tsv_data.AUDIO_EVENTS_TIER))
+    self.assertEqual(self._to_rows(table), [
+        (10.1, 10.2, "Keypress", "h"),
+        (10.5, 11.0, "AudioEvents1", "Speech"),
+        (11.1, 11.2, "Keypress", "i")])
+    self.assertAllEqual(table.tier_codes, [0, 1, 0])
+    self.assertAllEqual(table.row_numbers, [2, 3, 4])
+
+  def testColumnOrderFromHeader(self):
+    tsv_path = self._write(
+        "Tier\ttBegin\ttEnd\tContent\n"
+        "Keypress\t2.5\t2.6\tV\n"
+        "SpeechTranscript\t0.1\t0.9\tHello, my friend\n")
+    table = tsv_data.read_tsv(tsv_path)
+    self.assertEqual(self._to_rows(table), [
+        (2.5, 2.6, "Keypress", "V"),
+        (0.1, 0.9, "SpeechTranscript", "Hello, my friend")])
+
+  def testNoHeaderWithColumnOrder(self):
+    tsv_path = self._write(
+        "Keypress\t2.5\t2.6\tV\n"
+        "SpeechTranscript \t0.1\t0.9\tHello\n")
+    table = tsv_data.read_tsv(tsv_path, column_order=(1, 2, 0, 3))
+    self.assertEqual(self._to_rows(table), [
+        (2.5, 2.6, "Keypress", "V"),
+        (0.1, 0.9, "SpeechTranscript", "Hello")])
+
+  def testSkipsEmptyLinesAndTranslatesNewlines(self):
+    tsv_path = self._write(
+        b"\r\ntBegin\ttEnd\tTier\tContent\r\n\r\n"
+        b"1.0\t2.0\tKeypress\ta\r\n\r\n"
+        b"3.0\t4.0\tKeypress\t\xc3\xa9", mode="wb")
+    table = tsv_data.read_tsv(tsv_path)
+    self.assertEqual(self._to_rows(table), [
+        (1.0, 2.0, "Keypress", "a"), (3.0, 4.0, "Keypress", "\u00e9")])
+
+  def testTimesLikeFloat(self):
+    times = ["1", "-0.000", "12.3456789", ".5", "7.", "1e3", " 2.5",
+             "0.30000000000000004", "123456789.123456789"]
+    tsv_path = self._write("".join(
+        "%s\t%s\tKeypress\ta\n" % (t, t) for t in times))
+    table = tsv_data.read_tsv(tsv_path)
+    self.assertEqual(table.tbegins.tolist(), [float(t) for t in times])
+    self.assertEqual(
+        [np.signbit(t) for t in table.tbegins], [False, True] + [False] * 7)
+
+  def testQuotedFieldsAreReadLikeCsvReader(self):
+    text = (tsv_data.HEADER + "\n"
+            "1.0\t2.0\tSpeechTranscript\t\"Hello\" she said\n"
+            "3.0\t4.0\tSpeechTranscript\tThe \"end\"\n")
+    tsv_path = self._write(text)
+    table = tsv_data.read_tsv(tsv_path)
+    with open(tsv_path, "r") as f:
+      expected_rows = list(csv.reader(f, delimiter=tsv_data.DELIMITER))[1:]
+    self.assertEqual(
+        [[str(row[0]), str(row[1]), row[2], row[3]]
+         for row in self._to_rows(table)],
+        [[str(float(row[0])), str(float(row[1])), row[2], row[3]]
+         for row in expected_rows])
+
+  def testIgnoreEmptyFields(self):
+    tsv_path = self._write(
+        "Keypress\t\t2.5\t2.6\tV\n"
+        "SpeechTranscript\t0.1\t0.9\tHello\t\n")
+    table = tsv_data.read_tsv(
+        tsv_path, column_order=(1, 2, 0, 3), ignore_empty_fields=True)
+    self.assertEqual(self._to_rows(table), [
+        (2.5, 2.6, "Keypress", "V"), (0.1, 0.9, "SpeechTranscript", "Hello")])
+
+  def testUseMmap(self):
+    tsv_path = self._write(
+        tsv_data.HEADER + "\n" + "1.000\t2.000\tKeypress\ta\n" * 100)
+    self.assertEqual(
+        self._to_rows(tsv_data.read_tsv(tsv_path, use_mmap=True)),
+        self._to_rows(tsv_data.read_tsv(tsv_path)))
+
+  def testEmptyFile(self):
+    for text in ("", tsv_data.HEADER + "\n"):
+      table = tsv_data.read_tsv(self._write(text), use_mmap=True)
+      self.assertEqual(table.contents, [])
+      self.assertEqual(table.tbegins.shape, (0,))
+      self.assertEqual(table.tier_names, ())
+
+  def testWrongNumberOfColumns_raisesValueError(self):
+    tsv_path = self._write(
+        tsv_data.HEADER + "\n1.0\t2.0\tKeypress\ta\n1.0\t2.0\tKeypress\n")
+    with self.assertRaisesRegex(
+        ValueError, r"Line 2 .* contains 3 columns; expected 4"):
+      tsv_data.read_tsv(tsv_path)
+
+  def testInvalidTime_raisesValueError(self):
+    tsv_path = self._write(
+        tsv_data.HEADER + "\n1.0\t2.0\tKeypress\ta\n1.0x\t2.0\tKeypress\tb\n")
+    with self.assertRaisesRegex(ValueError, "1.0x"):
+      tsv_data.read_tsv(tsv_path)
+
+
+class ReadTsvCacheTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(ReadTsvCacheTest, self).setUp()
+    self.tsv_path = os.path.join(self.get_temp_dir(), "cached.tsv")
+    self._write(
+        tsv_data.HEADER + "\n"
+        "0.100\t1.100\tSpeechTranscript\tHello how are you\n"
+        "10.100\t10.200\tKeypress\th\n"
+        "11.100\t11.200\tKeypress\ti\n")
+    for ignore_empty_fields in (False, True):
+      cache_path = tsv_data.get_cache_path(self.tsv_path, ignore_empty_fields)
+      if os.path.isfile(cache_path):
+        os.remove(cache_path)
+
+  def _write(self, text, mtime_ns=10**18):
+    with open(self.tsv_path, "w") as f:
+      f.write(text)
+    # Make the modification time old enough to be trusted.
+    os.utime(self.tsv_path, ns=(mtime_ns, mtime_ns))
+
+  def _read(self, **kwargs):
+    with mock.patch.object(
+        tsv_data, "_parse_tsv", wraps=tsv_data._parse_tsv) as parse_tsv:
+      table = tsv_data.read_tsv(self.tsv_path, use_cache=True, **kwargs)
+    return table, parse_tsv.called
+
+  def _assertTablesEqual(self, table, expected_table):
+    self.assertAllEqual(table.tbegins, expected_table.tbegins)
+    self.assertAllEqual(table.tends, expected_table.tends)
+    self.assertAllEqual(table.tier_codes, expected_table.tier_codes)
+    self.assertEqual(table.tier_names, expected_table.tier_names)
+    self.assertEqual(table.contents, expected_table.contents)
+    self.assertAllEqual(table.row_numbers, expected_table.row_numbers)
+
+  def testGetCachePath(self):
+    self.assertEqual(
+        tsv_data.get_cache_path(os.path.join("session", "merged.tsv")),
+        os.path.join("session", ".merged.tsv.cache.npz"))
+    self.assertEqual(
+        tsv_data.get_cache_path(
+            os.path.join("session", "merged.tsv"), ignore_empty_fields=True),
+        os.path.join("session", ".merged.tsv.ignore_empty_fields.cache.npz"))
+
+  def testReloadsFromSidecarWithoutParsing(self):
+    table, parsed = self._read()
+    self.assertTrue(parsed)
+    self.assertTrue(os.path.isfile(tsv_data.get_cache_path(self.tsv_path)))
+    self._assertTablesEqual(table, tsv_data.read_tsv(self.tsv_path))
+    for tiers in (None, (tsv_data.KEYPRESS_TIER,), ("NoSuchTier",)):
+      table, parsed = self._read(tiers=tiers)
+      self.assertFalse(parsed)
+      self._assertTablesEqual(
+          table, tsv_data.read_tsv(self.tsv_path, tiers=tiers))
+
+  def testEquivalentArguments_useSidecar(self):
+    self._read()
+    for kwargs in (dict(column_order=(0, 1, 2, 3)),
+                   dict(has_header=True)):
+      _, parsed = self._read(**kwargs)
+      self.assertFalse(parsed)
+
+  def testIgnoreEmptyFields_usesSeparateSidecar(self):
+    self._write("Keypress\t\t2.5\t2.6\tV\n")
+    self._read(column_order=(1, 2, 0, 3), ignore_empty_fields=True)
+    with self.assertRaisesRegex(ValueError, "contains 5 columns"):
+      self._read(column_order=(1, 2, 0, 3))
+    # Reading with the other setting did not replace the sidecar.
+    table, parsed = self._read(
+        column_order=(1, 2, 0, 3), ignore_empty_fields=True)
+    self.assertFalse(parsed)
+    self.assertEqual(table.contents, ["V"])
+    self.assertTrue(os.path.isfile(
+        tsv_data.get_cache_path(self.tsv_path, ignore_empty_fields=True)))
+    self.assertFalse(os.path.isfile(tsv_data.get_cache_path(self.tsv_path)))
+
+  def testDifferentArguments_parseAgain(self):
+    self._read()
+    table, parsed = self._read(has_header=True, column_order=(1, 0, 2, 3))
+    self.assertTrue(parsed)
+    self.assertAllEqual(table.tbegins, [1.1, 10.2, 11.2])
+    # The sidecar now holds the rows for the latest arguments.
+    _, parsed = self._read()
+    self.assertTrue(parsed)
+
+  def testModifiedFileOfSameSize_isParsedAgain(self):
+    self._read()
+    with open(self.tsv_path, "r") as f:
+      text = f.read()
+    self._write(
+        text.replace("Keypress\th", "Keypress\tj"), mtime_ns=10**18 + 1)
+    table, parsed = self._read()
+    self.assertTrue(parsed)
+    self.assertEqual(table.contents, ["Hello how are you", "j", "i"])
+
+  def testRecentlyModifiedFile_isCheckedByHash(self):
+    with open(self.tsv_path, "w") as f:
+      f.write(tsv_data.HEADER + "\n1.0\t2.0\tKeypress\ta\n")
+    self._read()
+    mtime_ns = os.stat(self.tsv_path).st_mtime_ns
+    with open(self.tsv_path, "w") as f:
+      f.write(tsv_data.HEADER + "\n1.0\t2.0\tKeypress\tb\n")
+    # Within the resolution of the modification time.
+    os.utime(self.tsv_path, ns=(mtime_ns, mtime_ns))
+    table, parsed = self._read()
+    self.assertTrue(parsed)
+    self.assertEqual(table.contents, ["b"])
+
+  def testTouchedUnchangedFile_isHashedOnce(self):
+    self._read()
+    os.utime(self.tsv_path, ns=(10**18 + 1, 10**18 + 1))
+    with mock.patch.object(
+        tsv_data, "_compute_sha1", wraps=tsv_data._compute_sha1) as sha1:
+      _, parsed = self._read()
+      self.assertFalse(parsed)
+      self.assertEqual(sha1.call_count, 1)
+      _, parsed = self._read()
+      self.assertFalse(parsed)
+      self.assertEqual(sha1.call_count, 1)
+
+  def testContentsWithNewlines(self):
+    self._write(
+        tsv_data.HEADER + "\n"
+        "1.0\t2.0\tSpeechTranscript\t\"Two\nlines\"\n"
+        "3.0\t4.0\tSpeechTranscript\t\u00e9\n")
+    self._read()
+    table, parsed = self._read()
+    self.assertFalse(parsed)
+    self.assertEqual(table.contents, ["Two\nlines", "\u00e9"])
+
+  def testEmptyFile(self):
+    self._write("")
+    self._read()
+    table, parsed = self._read()
+    self.assertFalse(parsed)
+    self.assertEqual(table.contents, [])
+    self.assertEqual(table.tbegins.shape, (0,))
+
+  def testInvalidSidecar_isReplaced(self):
+    with open(tsv_data.get_cache_path(self.tsv_path), "wb") as f:
+      f.write(b"invalid")
+    table, parsed = self._read()
+    self.assertTrue(parsed)
+    self.assertEqual(table.contents, ["Hello how are you", "h", "i"])
+    _, parsed = self._read()
+    self.assertFalse(parsed)
+
+
+class FormatTimesTest(tf.test.TestCase):
+
+  def testFormatsLikePercentFormatting(self):
+    times_s = [0.0, -0.0, 0.1, 1.2345, 12.3455, -0.0004, -12.3456, 0.0005,
+               0.0015, 9.9995, 999.9996, 1234567.891]
+    self.assertEqual(
+        tsv_data.format_times(times_s), ["%.3f" % t for t in times_s])
+
+  def testRandomTimes(self):
+    times_s = np.concatenate([
+        np.random.uniform(-1e4, 1e6, 1000),
+        np.random.randint(-10**6, 10**6, 1000) * 0.0005])
+    self.assertEqual(
+        tsv_data.format_times(times_s), ["%.3f" % t for t in times_s])
+
+  def testEmpty(self):
+    self.assertEqual(tsv_data.format_times([]), [])
+
+  def testNonFiniteTimes_raisesValueError(self):
+    with self.assertRaisesRegex(ValueError, "non-finite"):
+      tsv_data.format_times([1.0, np.nan])
+
+
+class WriteRowsTest(tf.test.TestCase):
+
+  def testWritesRowsInBlocks(self):
+    tsv_path = os.path.join(self.get_temp_dir(), "rows.tsv")
+    tbegins = np.array([0.1, 1.25, 2.0, 10.0005, 100.0])
+    keys = ("a", "b", "Space", "\u00e9", "c")
+    with open(tsv_path, "w") as f:
+      f.write(tsv_data.HEADER + "\n")
+      tsv_data.write_rows(
+          f, tbegins, tbegins + 0.1, tsv_data.KEYPRESS_TIER, keys,
+          block_rows=2)
+    with open(tsv_path, "r") as f:
+      self.assertEqual(f.read(), "".join(
+          [tsv_data.HEADER + "\n"] +
+          ["%.3f\t%.3f\tKeypress\t%s\n" % (t, t + 0.1, key)
+           for t, key in zip(tbegins, keys)]))
+
+  def testPerRowTiers(self):
+    tsv_path = os.path.join(self.get_temp_dir(), "rows.tsv")
+    with open(tsv_path, "w") as f:
+      tsv_data.write_rows(
+          f, [0.0, 1.0], [0.5, 2.0],
+          [tsv_data.KEYPRESS_TIER, tsv_data.SPEECH_TRANSCRIPT_TIER],
+          ["h", "Hello"])
+    with open(tsv_path, "r") as f:
+      rows = list(csv.reader(f, delimiter=tsv_data.DELIMITER))
+    self.assertEqual(rows, [["0.000", "0.500", "Keypress", "h"],
+                            ["1.000", "2.000", "SpeechTranscript", "Hello"]])
+
+  def testMismatchInLengths_raisesValueError(self):
+    tsv_path = os.path.join(self.get_temp_dir(), "rows.tsv")
+    with open(tsv_path, "w") as f:
+      with self.assertRaisesRegex(ValueError, "Mismatch"):
+        tsv_data.write_rows(
+            f, [0.0, 1.0], [0.5], tsv_data.KEYPRESS_TIER, ["a", "b"])
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -0,0 +1,181 @@
+"""Energy-based voice activity detection (VAD) for audio waveforms."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+DEFAULT_FRAME_SEC = 0.03
+# A frame is considered speech if its energy exceeds the estimated noise floor
+# by at least this margin.
+DEFAULT_ENERGY_MARGIN_DB = 12.0
+# Frames with energy below this absolute level (in dB relative to int16 full
+# scale) are never considered speech.
+DEFAULT_MIN_ENERGY_DB = -60.0
+# Frames with a zero-crossing rate above this threshold are considered
+# unvoiced speech (e.g., fricatives) if their energy is within
+# DEFAULT_ENERGY_MARGIN_DB / 2 below the speech threshold.
+DEFAULT_ZCR_THRESHOLD = 0.25
+# Percentile of frame energies used as the noise floor estimate.
+NOISE_FLOOR_PERCENTILE = 10
+# The noise floor estimate is clamped to at least this far below the median
+# frame energy. Without the clamp, the percentile lands at speech level on
+# audio that is mostly speech, and quieter speech frames are missed.
+MIN_NOISE_FLOOR_BELOW_MEDIAN_DB = 24.0
+DEFAULT_PADDING_SEC = 0.3
+# Speech regions separated by gaps shorter than this are merged.
+DEFAULT_MIN_GAP_SEC = 0.5
+
+
+def compute_frame_features(xs, sample_rate_hz, frame_sec=DEFAULT_FRAME_SEC):
+  """Computes frame energy and zero-crossing rate of a waveform.
+
+  Args:
+    xs: Mono waveform as a 1D numpy array of dtype int16 or float32. float32
+      waveforms are assumed to be in the [-1, 1] range.
+    sample_rate_hz: Sample rate of the waveform.
+    frame_sec: Length of non-overlapping frames, in seconds. A trailing
+      partial frame is discarded.
+
+  Returns:
+    energies_db: Energy of each frame in dB relative to full scale, as a 1D
+      float32 numpy array.
+    zcrs: Zero-crossing rate of each frame (fraction of adjacent sample pairs
+      with a sign change), as a 1D float32 numpy array.
+  """
+  if len(xs.shape) != 1:
+    raise ValueError("Only mono audio is supported")
+  if xs.dtype == np.int16:
+    xs = xs.astype(np.float32) / 32768
+  elif xs.dtype != np.float32:
+    raise ValueError("Got unsupported ndarray dtype: %s" % xs.dtype)
+  frame_length = max(int(sample_rate_hz * frame_sec), 2)
+  num_frames = len(xs) // frame_length
+  frames = xs[:num_frames * frame_length].reshape([num_frames, frame_length])
+  energies_db = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+  signs = np.signbit(frames)
+  zcrs = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+  return energies_db.astype(np.float32), zcrs.astype(np.float32)
+
+
+def detect_speech_regions(xs,
+                          sample_rate_hz,
+                          frame_sec=DEFAULT_FRAME_SEC,
+                          energy_margin_db=DEFAULT_ENERGY_MARGIN_DB,
+                          min_energy_db=DEFAULT_MIN_ENERGY_DB,
+                          zcr_threshold=DEFAULT_ZCR_THRESHOLD,
+                          padding_sec=DEFAULT_PADDING_SEC,
+                          min_gap_sec=DEFAULT_MIN_GAP_SEC):
+  """Detects regions of a waveform that likely contain speech.
+
+  Args:
+    xs: Mono waveform as a 1D numpy array of dtype int16 or float32.
+    sample_rate_hz: Sample rate of the waveform.
+    frame_sec: Length of the analysis frames, in seconds.
+    energy_margin_db: Margin above the estimated noise floor for a frame to be
+      considered speech.
+    min_energy_db: Absolute minimum energy of speech frames, in dB relative
+      to full scale.
+    zcr_threshold: Zero-crossing rate above which slightly quieter frames are
+      also considered (unvoiced) speech.
+    padding_sec: Padding added to both sides of every speech region.
+    min_gap_sec: Regions separated by gaps shorter than this are merged.
+
+  Returns:
+    Speech regions as a list of (begin_sample, end_sample) tuples, sorted
+      and non-overlapping.
+  """
+  energies_db, zcrs = compute_frame_features(
+      xs, sample_rate_hz, frame_sec=frame_sec)
+  if not len(energies_db):
+    return []
+  noise_floor_db = min(
+      np.percentile(energies_db, NOISE_FLOOR_PERCENTILE),
+      np.median(energies_db) - MIN_NOISE_FLOOR_BELOW_MEDIAN_DB)
+  threshold_db = max(noise_floor_db + energy_margin_db, min_energy_db)
+  is_speech = (energies_db >= threshold_db) | (
+      (energies_db >= threshold_db - energy_margin_db / 2) &
+      (zcrs >= zcr_threshold))
+  if not np.any(is_speech):
+    return []
+
+  frame_length = max(int(sample_rate_hz * frame_sec), 2)
+  padded = np.concatenate([[False], is_speech, [False]])
+  edges = np.diff(padded.astype(np.int8))
+  begins = np.where(edges == 1)[0] * frame_length
+  ends = np.where(edges == -1)[0] * frame_length
+  padding = int(padding_sec * sample_rate_hz)
+  begins = np.maximum(begins - padding, 0)
+  ends = np.minimum(ends + padding, len(xs))
+
+  regions = [(int(begins[0]), int(ends[0]))]
+  min_gap = int(min_gap_sec * sample_rate_hz)
+  for begin, end in zip(begins[1:], ends[1:]):
+    if begin - regions[-1][1] < min_gap:
+      regions[-1] = (regions[-1][0], int(end))
+    else:
+      regions.append((int(begin), int(end)))
+  return regions
+
+
+class TimeMap(object):
+  """Maps times in a waveform compacted to speech regions back to the original.
+  """
+
+  def __init__(self, regions, sample_rate_hz):
+    """Constructor of TimeMap.
+
+    Args:
+      regions: Speech regions as a list of (begin_sample, end_sample) tuples,
+        as returned by detect_speech_regions().
+      sample_rate_hz: Sample rate of the waveform.
+    """
+    lengths = np.array([end - begin for begin, end in regions], dtype=np.int64)
+    self._original_begins_sec = np.array(
+        [begin for begin, _ in regions], dtype=np.float64) / sample_rate_hz
+    self._compacted_begins_sec = np.concatenate(
+        [[0], np.cumsum(lengths)[:-1]]).astype(np.float64) / sample_rate_hz
+    self._compacted_duration_sec = np.sum(lengths) / sample_rate_hz
+
+  @property
+  def compacted_duration_sec(self):
+    return self._compacted_duration_sec
+
+  def to_original_time(self, compacted_time_sec, is_end=False):
+    """Maps compacted time(s) to time(s) in the original waveform.
+
+    A time on the boundary between two regions is ambiguous: it maps to the
+    begin of the later region, unless `is_end` is True, in which case it maps
+    to the end of the earlier region.
+
+    Args:
+      compacted_time_sec: A float or a numpy array of floats, in seconds.
+      is_end: Whether the time(s) are end times, e.g., of words.
+
+    Returns:
+      Time(s) in the original waveform, in the same shape as the input.
+    """
+    if not len(self._original_begins_sec):
+      raise ValueError("Cannot map time with an empty TimeMap")
+    indices = np.searchsorted(
+        self._compacted_begins_sec, compacted_time_sec,
+        side="left" if is_end else "right") - 1
+    indices = np.maximum(indices, 0)
+    return (self._original_begins_sec[indices] +
+            compacted_time_sec - self._compacted_begins_sec[indices])
+
+
+def compact_to_speech_regions(xs, regions):
+  """Concatenates the speech regions of a waveform.
+
+  Args:
+    xs: Mono waveform as a 1D numpy array.
+    regions: Speech regions as a list of (begin_sample, end_sample) tuples.
+
+  Returns:
+    The concatenated samples of the regions as a 1D numpy array of the same
+      dtype as xs.
+  """
+  if not regions:
+    return xs[:0]
+  return np.concatenate([xs[begin:end] for begin, end in regions])
@@ -0,0 +1,93 @@
+"""Unit tests for the vad module."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import vad
+
+
+def _make_waveform(segments, fs=16000):
+  """Makes an int16 waveform from (duration_sec, amplitude) segments."""
+  rng = np.random.RandomState(42)
+  parts = []
+  for duration_sec, amplitude in segments:
+    n = int(duration_sec * fs)
+    parts.append(amplitude * np.sin(2 * np.pi * 200 * np.arange(n) / fs) +
+                 rng.normal(0, 10, size=[n]))
+  return np.concatenate(parts).astype(np.int16)
+
+
+class ComputeFrameFeaturesTest(tf.test.TestCase):
+
+  def testEnergyAndZeroCrossingRate(self):
+    xs = np.array([1000, -1000] * 240 + [0] * 480, dtype=np.int16)
+    energies_db, zcrs = vad.compute_frame_features(xs, 16000, frame_sec=0.03)
+    self.assertLen(energies_db, 2)
+    self.assertAllClose(energies_db[0], 20 * np.log10(1000 / 32768), atol=0.01)
+    self.assertLess(energies_db[1], -90)
+    self.assertAllClose(zcrs, [1.0, 0.0])
+
+  def testStereoRaisesValueError(self):
+    with self.assertRaisesRegex(ValueError, r"Only mono"):
+      vad.compute_frame_features(np.zeros([100, 2], dtype=np.int16), 16000)
+
+
+class DetectSpeechRegionsTest(tf.test.TestCase):
+
+  def testDetectsTwoRegionsWithPadding(self):
+    xs = _make_waveform([(3, 0), (1, 5000), (3, 0), (2, 5000), (3, 0)])
+    regions = vad.detect_speech_regions(xs, 16000, padding_sec=0.2)
+    self.assertLen(regions, 2)
+    self.assertAllClose(np.array(regions[0]) / 16000, [2.8, 4.2], atol=0.05)
+    self.assertAllClose(np.array(regions[1]) / 16000, [6.8, 9.2], atol=0.05)
+
+  def testMergesRegionsWithShortGaps(self):
+    xs = _make_waveform([(3, 0), (1, 5000), (0.3, 0), (1, 5000), (3, 0)])
+    regions = vad.detect_speech_regions(
+        xs, 16000, padding_sec=0.0, min_gap_sec=0.5)
+    self.assertLen(regions, 1)
+
+  def testMostlySpeechDetectsQuieterSpeech(self):
+    # 95% speech whose level varies over 12 dB, with a 0.5-s pause.
+    speech = [(0.25, amplitude) for amplitude in [2000, 4000, 8000] * 6]
+    xs = _make_waveform(
+        speech + [(0.25, 2000), (0.5, 0), (0.25, 2000)] + speech)
+    regions = vad.detect_speech_regions(
+        xs, 16000, padding_sec=0.0, min_gap_sec=0.3)
+    self.assertLen(regions, 2)
+    self.assertAllClose(np.array(regions[0]) / 16000, [0.0, 4.75], atol=0.05)
+    self.assertAllClose(np.array(regions[1]) / 16000, [5.25, 10.0], atol=0.05)
+
+  def testSilenceOnlyReturnsNoRegions(self):
+    self.assertEqual(
+        vad.detect_speech_regions(np.zeros(16000 * 5, dtype=np.int16), 16000),
+        [])
+
+
+class TimeMapTest(tf.test.TestCase):
+
+  def testMapsCompactedTimeToOriginalTime(self):
+    time_map = vad.TimeMap([(16000, 32000), (48000, 80000)], 16000)
+    self.assertAllClose(time_map.compacted_duration_sec, 3.0)
+    self.assertAllClose(
+        time_map.to_original_time(np.array([0.0, 0.5, 1.0, 2.5])),
+        [1.0, 1.5, 3.0, 4.5])
+
+  def testMapsEndTimeOnRegionBoundaryToEndOfEarlierRegion(self):
+    time_map = vad.TimeMap([(16000, 32000), (48000, 80000)], 16000)
+    self.assertAllClose(
+        time_map.to_original_time(np.array([0.0, 0.5, 1.0, 2.5]), is_end=True),
+        [1.0, 1.5, 2.0, 4.5])
+
+  def testCompactToSpeechRegions(self):
+    xs = np.arange(10, dtype=np.int16)
+    self.assertAllEqual(
+        vad.compact_to_speech_regions(xs, [(1, 3), (6, 8)]), [1, 2, 6, 7])
+    self.assertLen(vad.compact_to_speech_regions(xs, []), 0)
+
+
+if __name__ == "__main__":
+  tf.test.main()
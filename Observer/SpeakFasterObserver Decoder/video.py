@@ -1,5 +1,8 @@
 """Module for processing videos."""
 
+import concurrent.futures
+import hashlib
+import json
 import os
 import shutil
 import subprocess
@@ -11,11 +14,180 @@ import numpy as np
 
 import file_naming
 
+# For duplicate detection, images are decoded at 1/DUPLICATE_DRAFT_SCALE of
+# their size, which JPEG supports natively (and cheaply) in the DCT domain.
+DUPLICATE_DRAFT_SCALE = 8
+# Size of the thumbnails compared for near-duplicate detection.
+DUPLICATE_THUMBNAIL_SIZE = (32, 32)
+# A JPEG file ends with this marker, possibly followed by padding of up to
+# JPEG_END_SEARCH_LENGTH bytes. A missing marker indicates a truncated file.
+JPEG_END_OF_IMAGE_MARKER = b"\xff\xd9"
+JPEG_END_SEARCH_LENGTH = 1024
+MAX_REPORTED_INVALID_IMAGES = 20
+DEFAULT_SEGMENT_DURATION_S = 3600.0
+# ffmpeg output options for one frame per image at its start time (variable
+# frame rate), rather than frames repeated at a constant rate. -vsync is used
+# (rather than its newer alias -fps_mode) to support older versions of ffmpeg.
+VFR_OUTPUT_OPTIONS = ["-vsync", "vfr"]
+SEGMENT_CACHE_DIR_SUFFIX = "_segments"
+# Bump this to invalidate cached segments, e.g., when the encoding options
+# change.
+SEGMENT_CACHE_VERSION = 2
+
+
+def _compute_image_signature(image_path):
+  """Computes the duplicate-detection signature of an image.
+
+  Returns:
+    digest: Hex digest of the reduced-size grayscale pixels.
+    thumbnail: A small grayscale thumbnail as a uint8 numpy array.
+  """
+  with Image.open(image_path) as image:
+    image.draft("L", (max(1, image.width // DUPLICATE_DRAFT_SCALE),
+                      max(1, image.height // DUPLICATE_DRAFT_SCALE)))
+    image = image.convert("L")
+    digest = hashlib.sha1(image.tobytes()).hexdigest()
+    thumbnail = np.asarray(
+        image.resize(DUPLICATE_THUMBNAIL_SIZE, Image.BILINEAR), dtype=np.uint8)
+  return digest, thumbnail
+
+
+def compute_image_signatures(image_paths, num_workers=None):
+  """Computes the duplicate-detection signatures of images in parallel.
+
+  Threads (rather than processes) are used, since Pillow and hashlib release
+  the GIL while decoding and hashing, and since forking is unsafe while other
+  stages run TensorFlow Lite and gRPC in threads of the same process.
+
+  Args:
+    image_paths: Paths to the image files.
+    num_workers: Number of worker threads. Defaults to the number of CPUs.
+      If 1, the signatures are computed in the current thread.
+
+  Returns:
+    A list of (digest, thumbnail) tuples, one for each image.
+  """
+  num_workers = num_workers or os.cpu_count()
+  if num_workers == 1 or len(image_paths) <= 1:
+    return [_compute_image_signature(path) for path in image_paths]
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=num_workers) as executor:
+    return list(executor.map(_compute_image_signature, image_paths))
+
+
+def _read_image_header(image_path):
+  """Reads the size of an image and checks the integrity of a JPEG file.
+
+  Only the header and the end of the file are read.
+
+  Returns:
+    size: (width, height) of the image, or None if the header is unreadable.
+    error: A description of the problem with the image, or None if it is
+      valid.
+  """
+  try:
+    with Image.open(image_path) as image:
+      size = image.size
+      image_format = image.format
+  except (IOError, SyntaxError) as e:
+    return None, "cannot read the image header (%s)" % e
+  if image_format == "JPEG":
+    with open(image_path, "rb") as f:
+      f.seek(0, os.SEEK_END)
+      f.seek(max(0, f.tell() - JPEG_END_SEARCH_LENGTH))
+      if JPEG_END_OF_IMAGE_MARKER not in f.read():
+        return size, "missing the JPEG end-of-image marker (truncated file?)"
+  return size, None
+
+
+def validate_images(image_paths, num_workers=None):
+  """Checks that images are intact and of the same size.
+
+  The images are checked in parallel without decoding them, so that a
+  corrupt image fails fast rather than in the middle of video encoding.
+
+  Args:
+    image_paths: Paths to the image files.
+    num_workers: Number of worker threads. Defaults to the number of CPUs.
+
+  Returns:
+    (width, height) of the images.
+
+  Raises:
+    ValueError: If any image is unreadable, truncated or of a different size
+      from the first valid image. The message lists the offending images.
+  """
+  if not image_paths:
+    raise ValueError("Empty image paths")
+  num_workers = num_workers or os.cpu_count()
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=num_workers) as executor:
+    headers = list(executor.map(_read_image_header, image_paths))
+  expected_size = None
+  errors = []
+  for image_path, (size, error) in zip(image_paths, headers):
+    if error is None and expected_size is None:
+      expected_size = size
+    if error is None and size != expected_size:
+      error = "size %dx%d differs from %dx%d of the other images" % (
+          size + expected_size)
+    if error is not None:
+      errors.append("%s: %s" % (image_path, error))
+  if errors:
+    raise ValueError(
+        "Found %d invalid image(s) out of %d:\n%s%s" %
+        (len(errors), len(image_paths),
+         "\n".join(errors[:MAX_REPORTED_INVALID_IMAGES]),
+         "\n..." if len(errors) > MAX_REPORTED_INVALID_IMAGES else ""))
+  return expected_size
+
+
+def collapse_duplicate_images(image_paths,
+                              pts,
+                              signatures,
+                              max_mean_abs_diff=0.0):
+  """Merges runs of identical or near-identical consecutive images.
+
+  Each run is represented by its first image, which lasts until the start of
+  the next run, so that the times of all remaining frames are unchanged. The
+  last image is always kept, so that the end time is unchanged as well.
+
+  Args:
+    image_paths: Paths to the images, in time order.
+    pts: Presentation times of the images in seconds.
+    signatures: Signatures of the images, as returned by
+      compute_image_signatures().
+    max_mean_abs_diff: An image is merged into the current run if its
+      signature digest equals that of the run's first image, or if the mean
+      absolute difference between their thumbnails (in 0-255 units) is at
+      most this value. If 0, only identical images are merged.
+
+  Returns:
+    The paths and pts of the remaining images, as two lists.
+  """
+  kept_indices = []
+  for i, (digest, thumbnail) in enumerate(signatures):
+    if kept_indices and i < len(signatures) - 1:
+      run_digest, run_thumbnail = signatures[kept_indices[-1]]
+      if digest == run_digest or (
+          max_mean_abs_diff > 0 and
+          np.mean(np.abs(thumbnail.astype(np.int16) - run_thumbnail)) <=
+          max_mean_abs_diff):
+        continue
+    kept_indices.append(i)
+  return ([image_paths[i] for i in kept_indices],
+          [pts[i] for i in kept_indices])
+
 
 def stitch_images_into_mp4(image_paths,
                            start_time_epoch_s,
                            timezone,
-                           out_mp4_path):
+                           out_mp4_path,
+                           collapse_duplicates=True,
+                           max_mean_abs_diff=0.0,
+                           num_workers=None,
+                           segment_duration_s=DEFAULT_SEGMENT_DURATION_S,
+                           segment_cache_dir=None):
   """Stitch a series of images of the same size into a video.
 
   The video will have no audio track.
@@ -27,27 +199,52 @@ def stitch_images_into_mp4(image_paths,
     blank (black) frame.
   timezone: Name of the timezone for the timestamps in the image file names.
   output_mp4_path: Path to the output mp4 video file.
+  collapse_duplicates: Whether runs of identical consecutive images are
+    merged into single longer frames. See collapse_duplicate_images().
+  max_mean_abs_diff: Tolerance for merging near-identical images. See
+    collapse_duplicate_images().
+  num_workers: Number of workers for image validation and duplicate
+    detection.
+  segment_duration_s: If not None, the video is encoded as segments of about
+    this duration, which are cached by the contents and timing of their
+    images in segment_cache_dir, and then concatenated without re-encoding.
+    Segments are cut at the start times of images, and keep one frame per
+    image (variable frame rate) like the whole video. Re-running after new
+    screenshots are added only encodes the segments that changed (typically
+    the last one). If None, the whole video is encoded at once.
+  segment_cache_dir: Directory of the cached segments. Defaults to a
+    directory next to out_mp4_path.
   """
   if not image_paths:
     raise ValueError("Empty image paths")
+  if segment_duration_s is not None and not segment_duration_s > 0:
+    raise ValueError(
+        "segment_duration_s must be positive; got %s" % segment_duration_s)
 
   # Find the first image path to include.
   image_paths = sorted(image_paths)
-  for start_index, image_path in enumerate(image_paths):
-    video_start_epochs_s = file_naming.parse_epoch_seconds_from_filename(
-        image_path, timezone)
-    if video_start_epochs_s >= start_time_epoch_s:
-      initial_frame_duration_s = video_start_epochs_s - start_time_epoch_s
-      break
+  epochs_s = file_naming.parse_epoch_seconds_from_filenames(
+      image_paths, timezone)
+  out_of_order_indices = np.flatnonzero(np.diff(epochs_s) < 0)
+  if len(out_of_order_indices):
+    raise ValueError(
+        "Timestamp of image file is out of order: %s" %
+        image_paths[out_of_order_indices[0] + 1])
+  start_index = int(np.searchsorted(epochs_s, start_time_epoch_s))
+  if start_index == len(image_paths):
+    raise ValueError(
+        "All %d images are before the start time" % len(image_paths))
+  initial_frame_duration_s = epochs_s[start_index] - start_time_epoch_s
   print("The screenshot video file will start from frame %d (0-based); "
         "Discarding %d frames." % (start_index, start_index))
-  image_paths == image_paths[start_index:]
+  image_paths = image_paths[start_index:]
+  pts = (epochs_s[start_index:] - epochs_s[start_index]).tolist()
 
-  tmp_dir = tempfile.mkdtemp()
-  pts = [0]
+  # Check all the images before spending time on encoding.
+  image_width, image_height = validate_images(
+      image_paths, num_workers=num_workers)
 
-  # Get the dimensions of the first image.
-  image_width, image_height = Image.open(image_paths[0]).size
+  tmp_dir = tempfile.mkdtemp()
   # Create the image file for the first frame.
   if initial_frame_duration_s > 0:
     print("Creating an initial blank frame with duration %f s" %
@@ -55,33 +252,168 @@ def stitch_images_into_mp4(image_paths,
     initial_frame_image_path = os.path.join(tmp_dir, "first_frame.jpg")
     Image.new("RGB", (image_width, image_height)).save(initial_frame_image_path)
 
-  timestamp0, _ = file_naming.parse_timestamp_from_filename(image_paths[0])
-  for image_path in image_paths[1:]:
-    timestamp, _ = file_naming.parse_timestamp_from_filename(image_path)
-    if timestamp < timestamp0:
-      raise ValueError(
-          "Timestamp of image file is out of order: %s" % image_path)
-    dt = timestamp - timestamp0
-    pts.append(dt.seconds + dt.microseconds / 1e6)
-  frame_durations_s = np.diff(pts)
-  n_images = len(image_paths)
-
-  input_file_path = os.path.join(tmp_dir, "input.txt")
-  with open(input_file_path, "w") as f:
-    if initial_frame_duration_s > 0:
-      f.write("file %s\n" % normalize_path(initial_frame_image_path))
-      f.write("duration %.6f\n" % initial_frame_duration_s)
-    for i in range(n_images):
-      f.write("file %s\n" % normalize_path(image_paths[i]))
-      if i < n_images - 1:
-        f.write("duration %.6f\n" % frame_durations_s[i])
+  if collapse_duplicates:
+    num_images = len(image_paths)
+    image_paths, pts = collapse_duplicate_images(
+        image_paths, pts,
+        compute_image_signatures(image_paths, num_workers=num_workers),
+        max_mean_abs_diff=max_mean_abs_diff)
+    print("Collapsed %d screenshots into %d distinct frames" %
+          (num_images, len(image_paths)))
 
-  subprocess.check_call([
-      "ffmpeg", "-f", "concat", "-safe", "0",
-      "-i", input_file_path, out_mp4_path])
+  # Entries of (image_path, start time in the video in seconds).
+  entries = []
+  if initial_frame_duration_s > 0:
+    entries.append((initial_frame_image_path, 0.0))
+  for image_path, image_pts in zip(image_paths, pts):
+    entries.append((image_path, initial_frame_duration_s + image_pts))
+
+  if segment_duration_s is None:
+    input_file_path = os.path.join(tmp_dir, "input.txt")
+    _write_concat_list(input_file_path, entries)
+    subprocess.check_call([
+        "ffmpeg", "-y", "-f", "concat", "-safe", "0",
+        "-i", input_file_path] + VFR_OUTPUT_OPTIONS + [out_mp4_path])
+  else:
+    if segment_cache_dir is None:
+      segment_cache_dir = (
+          os.path.splitext(out_mp4_path)[0] + SEGMENT_CACHE_DIR_SUFFIX)
+    segment_paths, segment_starts_s = _encode_segments(
+        entries, segment_duration_s, segment_cache_dir, tmp_dir,
+        num_workers=num_workers)
+    segments_list_path = os.path.join(tmp_dir, "segments.txt")
+    with open(segments_list_path, "w") as f:
+      for i, segment_path in enumerate(segment_paths):
+        f.write("file %s\n" % _quote_concat_path(segment_path))
+        if i < len(segment_paths) - 1:
+          # The last frame of a segment lasts until the start of the next
+          # segment, which the encoded segment itself does not record.
+          f.write("duration %.6f\n" %
+                  (segment_starts_s[i + 1] - segment_starts_s[i]))
+    subprocess.check_call([
+        "ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0",
+        "-i", segments_list_path, "-c", "copy", out_mp4_path])
   shutil.rmtree(tmp_dir)
 
 
+def _quote_concat_path(file_path):
+  """Quotes a path for an ffmpeg concat list."""
+  return "'%s'" % normalize_path(os.path.abspath(file_path)).replace(
+      "'", "'\\''")
+
+
+def _write_concat_list(list_path, entries):
+  """Writes an ffmpeg concat list of images.
+
+  Args:
+    list_path: Path to the list file to write.
+    entries: A list of (image_path, start_s) tuples, sorted by start_s. The
+      last image is shown for a single frame.
+  """
+  with open(list_path, "w") as f:
+    for i, (image_path, start_s) in enumerate(entries):
+      f.write("file %s\n" % _quote_concat_path(image_path))
+      if i < len(entries) - 1:
+        f.write("duration %.6f\n" % (entries[i + 1][1] - start_s))
+
+
+def _hash_file(file_path):
+  hasher = hashlib.sha1()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+
+def _split_into_segments(entries, segment_duration_s):
+  """Splits image entries into segments at the start times of images.
+
+  A segment starts with the first image at or after each multiple of
+  segment_duration_s, so that no image is repeated across segments and
+  appending images changes only the last segment.
+
+  Args:
+    entries: A list of (image_path, start_s) tuples, sorted by start_s, the
+      first of which starts at 0.
+    segment_duration_s: Approximate duration of each segment.
+
+  Returns:
+    A list of (segment_entries, start_s) tuples, where start_s is the start
+      time of the segment, and the start times of segment_entries are
+      relative to it.
+  """
+  segments = []
+  segment_index = None
+  for image_path, start_s in entries:
+    index = int(start_s // segment_duration_s)
+    if index != segment_index:
+      segment_index = index
+      segments.append(([], start_s))
+    segment_entries, segment_start_s = segments[-1]
+    segment_entries.append((image_path, start_s - segment_start_s))
+  return segments
+
+
+def _encode_segment(segment_entries, file_digests, cache_dir, tmp_dir):
+  """Encodes a segment into the cache directory, unless it is there already.
+
+  Returns:
+    Path to the encoded segment.
+  """
+  key = hashlib.sha1(json.dumps({
+      "version": SEGMENT_CACHE_VERSION,
+      "entries": [(file_digests[image_path], round(start_s, 6))
+                  for image_path, start_s in segment_entries],
+  }).encode("utf-8")).hexdigest()
+  segment_path = os.path.join(cache_dir, key + ".mp4")
+  if os.path.isfile(segment_path):
+    return segment_path
+  list_path = os.path.join(tmp_dir, key + ".txt")
+  _write_concat_list(list_path, segment_entries)
+  tmp_segment_path = os.path.join(tmp_dir, key + ".mp4")
+  subprocess.check_call([
+      "ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0",
+      "-i", list_path] + VFR_OUTPUT_OPTIONS + [tmp_segment_path])
+  shutil.move(tmp_segment_path, segment_path + ".tmp")
+  os.replace(segment_path + ".tmp", segment_path)
+  return segment_path
+
+
+def _encode_segments(entries, segment_duration_s, cache_dir, tmp_dir,
+                     num_workers=None):
+  """Encodes image entries as cached segments.
+
+  Only the segments whose inputs (image contents and timing) have changed
+  since the last call with the same cache directory are encoded. Segments
+  in the cache directory that are no longer used are deleted.
+
+  Returns:
+    Paths to the segments, in time order.
+    Start times of the segments in the video, in seconds.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  image_paths = sorted(set(image_path for image_path, _ in entries))
+  num_workers = num_workers or os.cpu_count()
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=num_workers) as executor:
+    file_digests = dict(
+        zip(image_paths, executor.map(_hash_file, image_paths)))
+  segments = _split_into_segments(entries, segment_duration_s)
+  existing = set(os.listdir(cache_dir))
+  segment_paths = [
+      _encode_segment(segment_entries, file_digests, cache_dir, tmp_dir)
+      for segment_entries, _ in segments]
+  num_cached = sum(
+      os.path.basename(path) in existing for path in segment_paths)
+  print("Encoded %d of %d screenshot video segments (%d cached)" %
+        (len(segments) - num_cached, len(segments), num_cached))
+  used = set(os.path.basename(path) for path in segment_paths)
+  for filename in os.listdir(cache_dir):
+    if filename.endswith(".mp4") and filename not in used:
+      os.remove(os.path.join(cache_dir, filename))
+  return segment_paths, [start_s for _, start_s in segments]
+
+
 def normalize_path(file_path):
   """Normalizes path for ffmpeg, which requires forward slash.
 
@@ -2,6 +2,7 @@
 import os
 
 from PIL import Image
+import cv2
 import ffmpeg
 import numpy as np
 import tensorflow as tf
@@ -10,22 +11,19 @@ import file_naming
 import video
 
 
-class StitchImagesIntoMp4Test(tf.test.TestCase):
+def _create_image(dir_path, w, h, pixel_value, image_file_name):
+  """Creates a uniformly gray image file and returns its path."""
+  image_abs_path = os.path.join(dir_path, image_file_name)
+  Image.new("RGB", (w, h), (pixel_value,) * 3).save(image_abs_path)
+  return image_abs_path
+
 
-  def _createImage(self, w, h, pixel_value, image_file_name):
-    image_abs_path = os.path.join(self.get_temp_dir(), image_file_name)
-    image = Image.new("RGB", (w, h))
-    pixels = image.load()
-    for i in range(w):
-      for j in range(h):
-        pixels[i, j] = (pixel_value, pixel_value, pixel_value)
-    image.save(image_abs_path)
-    return image_abs_path
+class StitchImagesIntoMp4Test(tf.test.TestCase):
 
   def testStichOneImage(self):
     filename = "20210903T120000000-Screenshot.jpg"
     timezone = "US/Eastern"
-    image_path_1 = self._createImage(800, 600, 0, filename)
+    image_path_1 = _create_image(self.get_temp_dir(), 800, 600, 0, filename)
     video_start_epoch_s = file_naming.parse_epoch_seconds_from_filename(filename, timezone)
     start_time_epoch_s = video_start_epoch_s - 5.0
     out_mp4_path = os.path.join(self.get_temp_dir(), "stiched.mp4")
@@ -35,9 +33,12 @@ class StitchImagesIntoMp4Test(tf.test.TestCase):
     self.assertAllClose(float(probe["streams"][0]["duration"]), 5.0, atol=0.1)
 
   def testStichThreeImages(self):
-    image_path_1 = self._createImage(800, 600, 0, "20210903T120000000-Screenshot.jpg")
-    image_path_2 = self._createImage(800, 600, 60, "20210903T120000200-Screenshot.jpg")
-    image_path_3 = self._createImage(800, 600, 120, "20210903T120001000-Screenshot.jpg")
+    image_path_1 = _create_image(self.get_temp_dir(), 800, 600, 0,
+                                 "20210903T120000000-Screenshot.jpg")
+    image_path_2 = _create_image(self.get_temp_dir(), 800, 600, 60,
+                                 "20210903T120000200-Screenshot.jpg")
+    image_path_3 = _create_image(self.get_temp_dir(), 800, 600, 120,
+                                 "20210903T120001000-Screenshot.jpg")
     timezone = "US/Central"
     video_start_epoch_s = file_naming.parse_epoch_seconds_from_filename(
         "20210903T120000000-Screenshot.jpg", timezone)
@@ -48,12 +49,17 @@ class StitchImagesIntoMp4Test(tf.test.TestCase):
         timezone, out_mp4_path)
 
     probe = ffmpeg.probe(out_mp4_path)
-    self.assertAllClose(float(probe["streams"][0]["duration"]), 11.8, atol=0.1)
+    # The video has one frame per image (variable frame rate), so it ends
+    # shortly after the start of the last image.
+    self.assertAllClose(float(probe["streams"][0]["duration"]), 11.0, atol=0.1)
 
   def testStichThreeImages_noInitialFrame(self):
-    image_path_1 = self._createImage(800, 600, 0, "20210903T120000000-Screenshot.jpg")
-    image_path_2 = self._createImage(800, 600, 60, "20210903T120000200-Screenshot.jpg")
-    image_path_3 = self._createImage(800, 600, 120, "20210903T120001000-Screenshot.jpg")
+    image_path_1 = _create_image(self.get_temp_dir(), 800, 600, 0,
+                                 "20210903T120000000-Screenshot.jpg")
+    image_path_2 = _create_image(self.get_temp_dir(), 800, 600, 60,
+                                 "20210903T120000200-Screenshot.jpg")
+    image_path_3 = _create_image(self.get_temp_dir(), 800, 600, 120,
+                                 "20210903T120001000-Screenshot.jpg")
     timezone = "US/Central"
     video_start_epoch_s = file_naming.parse_epoch_seconds_from_filename(
         "20210903T120000000-Screenshot.jpg", timezone)
@@ -64,7 +70,7 @@ class StitchImagesIntoMp4Test(tf.test.TestCase):
         out_mp4_path)
 
     probe = ffmpeg.probe(out_mp4_path)
-    self.assertAllClose(float(probe["streams"][0]["duration"]), 1.1, atol=0.1)
+    self.assertAllClose(float(probe["streams"][0]["duration"]), 1.0, atol=0.1)
 
   def testStichOneImage(self):
     out_mp4_path = os.path.join(self.get_temp_dir(), "stiched.mp4")
@@ -72,20 +78,249 @@ class StitchImagesIntoMp4Test(tf.test.TestCase):
       video.stitch_images_into_mp4([], 5.0, "US/Central", out_mp4_path)
 
 
-class MakeDummyVideoFileTest(tf.test.TestCase):
+class CollapseDuplicateImagesTest(tf.test.TestCase):
+
+  def testComputeImageSignatures(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, value, "%d.jpg" % i)
+             for i, value in enumerate((10, 10, 200))]
+    signatures = video.compute_image_signatures(paths, num_workers=2)
+    self.assertLen(signatures, 3)
+    self.assertEqual(signatures[0][0], signatures[1][0])
+    self.assertNotEqual(signatures[0][0], signatures[2][0])
+    self.assertEqual(
+        signatures[0][1].shape, video.DUPLICATE_THUMBNAIL_SIZE[::-1])
+    self.assertEqual(
+        [digest for digest, _ in signatures],
+        [digest for digest, _ in video.compute_image_signatures(
+            paths, num_workers=1)])
+
+  def testCollapsesRunsAndKeepsLastImage(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, value, "%d.jpg" % i)
+             for i, value in enumerate((10, 10, 200, 200, 200))]
+    pts = [0.0, 0.5, 1.0, 1.5, 2.5]
+    kept_paths, kept_pts = video.collapse_duplicate_images(
+        paths, pts, video.compute_image_signatures(paths, num_workers=1))
+    self.assertEqual(kept_paths, [paths[0], paths[2], paths[4]])
+    self.assertEqual(kept_pts, [0.0, 1.0, 2.5])
+
+  def testNearDuplicatesWithTolerance(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, value, "%d.jpg" % i)
+             for i, value in enumerate((10, 12, 200))]
+    signatures = video.compute_image_signatures(paths, num_workers=1)
+    kept_paths, _ = video.collapse_duplicate_images(
+        paths, [0.0, 1.0, 2.0], signatures)
+    self.assertLen(kept_paths, 3)
+    kept_paths, kept_pts = video.collapse_duplicate_images(
+        paths, [0.0, 1.0, 2.0], signatures, max_mean_abs_diff=5.0)
+    self.assertEqual(kept_paths, [paths[0], paths[2]])
+    self.assertEqual(kept_pts, [0.0, 2.0])
+
+  def testStitchedVideoKeepsTiming(self):
+    paths = [
+        _create_image(self.get_temp_dir(), 64, 48, 0,
+                      "20210903T120000000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 0,
+                      "20210903T120000200-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 250,
+                      "20210903T120001000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 250,
+                      "20210903T120002000-Screenshot.jpg"),
+    ]
+    timezone = "US/Central"
+    start_time_epoch_s = file_naming.parse_epoch_seconds_from_filename(
+        paths[0], timezone)
+    out_mp4_path = os.path.join(self.get_temp_dir(), "stitched.mp4")
+    video.stitch_images_into_mp4(
+        paths, start_time_epoch_s, timezone, out_mp4_path, num_workers=1)
+    video_cap = cv2.VideoCapture(out_mp4_path)
+    timestamps = []
+    brightnesses = []
+    success, image = video_cap.read()
+    while success:
+      timestamps.append(video_cap.get(cv2.CAP_PROP_POS_MSEC) / 1e3)
+      brightnesses.append(np.mean(image))
+      success, image = video_cap.read()
+    timestamps = np.array(timestamps)
+    brightnesses = np.array(brightnesses)
+    self.assertLess(np.max(brightnesses[timestamps < 0.95]), 50)
+    self.assertGreater(np.min(brightnesses[timestamps > 1.05]), 200)
+    self.assertGreaterEqual(timestamps[-1], 1.95)
+
+
+class SegmentedStitchTest(tf.test.TestCase):
+
+  def _readFrames(self, mp4_path):
+    video_cap = cv2.VideoCapture(mp4_path)
+    timestamps = []
+    brightnesses = []
+    success, image = video_cap.read()
+    while success:
+      timestamps.append(video_cap.get(cv2.CAP_PROP_POS_MSEC) / 1e3)
+      brightnesses.append(np.mean(image))
+      success, image = video_cap.read()
+    return np.array(timestamps), np.array(brightnesses)
+
+  def _createScreenshots(self):
+    return [
+        _create_image(self.get_temp_dir(), 64, 48, 0,
+                      "20210903T120000000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 80,
+                      "20210903T120001300-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 160,
+                      "20210903T120002500-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 240,
+                      "20210903T120004100-Screenshot.jpg"),
+    ]
+
+  def testSegmentedVideoMatchesWholeVideo(self):
+    paths = self._createScreenshots()
+    timezone = "US/Central"
+    start_time_epoch_s = file_naming.parse_epoch_seconds_from_filename(
+        paths[0], timezone) - 0.5
+    whole_mp4_path = os.path.join(self.get_temp_dir(), "whole.mp4")
+    video.stitch_images_into_mp4(
+        paths, start_time_epoch_s, timezone, whole_mp4_path, num_workers=1,
+        segment_duration_s=None)
+    segmented_mp4_path = os.path.join(self.get_temp_dir(), "segmented.mp4")
+    video.stitch_images_into_mp4(
+        paths, start_time_epoch_s, timezone, segmented_mp4_path,
+        num_workers=1, segment_duration_s=2.0)
 
-  def _createImage(self, w, h, pixel_value, image_file_name):
-    image_abs_path = os.path.join(self.get_temp_dir(), image_file_name)
-    image = Image.new("RGB", (w, h))
-    pixels = image.load()
-    for i in range(w):
-      for j in range(h):
-        pixels[i, j] = (pixel_value, pixel_value, pixel_value)
-    image.save(image_abs_path)
-    return image_abs_path
+    whole_timestamps, whole_brightnesses = self._readFrames(whole_mp4_path)
+    timestamps, brightnesses = self._readFrames(segmented_mp4_path)
+    # The segments are joined without gaps, up to the last screenshot.
+    self.assertGreaterEqual(timestamps[-1], 4.6 - 1e-3)
+    num_frames = len(timestamps)
+    self.assertAllClose(timestamps, whole_timestamps[:num_frames], atol=1e-3)
+    self.assertAllClose(
+        brightnesses, whole_brightnesses[:num_frames], atol=5.0)
+
+  def testReusesCachedSegments(self):
+    paths = self._createScreenshots()
+    timezone = "US/Central"
+    start_time_epoch_s = file_naming.parse_epoch_seconds_from_filename(
+        paths[0], timezone)
+    out_mp4_path = os.path.join(self.get_temp_dir(), "cached.mp4")
+    cache_dir = os.path.join(self.get_temp_dir(), "segment_cache")
+    video.stitch_images_into_mp4(
+        paths[:3], start_time_epoch_s, timezone, out_mp4_path, num_workers=1,
+        segment_duration_s=2.0, segment_cache_dir=cache_dir)
+    segment_files = set(os.listdir(cache_dir))
+    self.assertLen(segment_files, 2)
+    mtimes = {
+        filename: os.path.getmtime(os.path.join(cache_dir, filename))
+        for filename in segment_files}
+
+    # Adding a screenshot re-encodes only the last segment.
+    video.stitch_images_into_mp4(
+        paths, start_time_epoch_s, timezone, out_mp4_path, num_workers=1,
+        segment_duration_s=2.0, segment_cache_dir=cache_dir)
+    new_segment_files = set(os.listdir(cache_dir))
+    self.assertLen(new_segment_files, 3)
+    kept_files = segment_files & new_segment_files
+    # The segments before it are unchanged.
+    self.assertLen(kept_files, 2)
+    for filename in kept_files:
+      self.assertEqual(
+          os.path.getmtime(os.path.join(cache_dir, filename)),
+          mtimes[filename])
+    timestamps, brightnesses = self._readFrames(out_mp4_path)
+    self.assertGreaterEqual(timestamps[-1], 4.1 - 1e-3)
+    self.assertGreater(brightnesses[-1], 200)
+
+  def testSparseScreenshotsKeepOneFramePerImage(self):
+    paths = [
+        _create_image(self.get_temp_dir(), 64, 48, 0,
+                      "20210903T120000000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 80,
+                      "20210903T120025000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 160,
+                      "20210903T120050000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 240,
+                      "20210903T120110000-Screenshot.jpg"),
+    ]
+    timezone = "US/Central"
+    start_time_epoch_s = file_naming.parse_epoch_seconds_from_filename(
+        paths[0], timezone) - 1.0
+    out_mp4_path = os.path.join(self.get_temp_dir(), "sparse.mp4")
+    video.stitch_images_into_mp4(
+        paths, start_time_epoch_s, timezone, out_mp4_path, num_workers=1,
+        segment_duration_s=30.0)
+    timestamps, brightnesses = self._readFrames(out_mp4_path)
+    # An initial blank frame and one frame per screenshot, rather than 25
+    # frames per second for 71 s.
+    self.assertLen(timestamps, 5)
+    self.assertAllClose(timestamps, [0.0, 1.0, 26.0, 51.0, 71.0], atol=1e-3)
+    self.assertAllClose(
+        brightnesses, [0, 0, 80, 160, 240], atol=5.0)
+
+  def testInvalidSegmentDurationRaisesValueError(self):
+    paths = self._createScreenshots()
+    out_mp4_path = os.path.join(self.get_temp_dir(), "invalid.mp4")
+    with self.assertRaisesRegex(ValueError, "segment_duration_s"):
+      video.stitch_images_into_mp4(
+          paths, 0.0, "US/Central", out_mp4_path, segment_duration_s=0.0)
+
+
+class ValidateImagesTest(tf.test.TestCase):
+
+  def testReturnsSizeOfValidImages(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, 100, "%d.jpg" % i)
+             for i in range(3)]
+    self.assertEqual(video.validate_images(paths, num_workers=2), (64, 48))
+
+  def testReportsTruncatedAndMismatchedImages(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, 100, "%d.jpg" % i)
+             for i in range(4)]
+    with open(paths[1], "rb") as f:
+      data = f.read()
+    with open(paths[1], "wb") as f:
+      f.write(data[:-10])
+    with open(paths[2], "wb") as f:
+      f.write(b"not an image")
+    paths.append(_create_image(self.get_temp_dir(), 32, 48, 100, "4.jpg"))
+    with self.assertRaisesRegex(ValueError, "3 invalid image") as context:
+      video.validate_images(paths, num_workers=2)
+    message = str(context.exception)
+    self.assertIn("%s: missing the JPEG end-of-image marker" % paths[1],
+                  message)
+    self.assertIn("%s: cannot read the image header" % paths[2], message)
+    self.assertIn("%s: size 32x48 differs from 64x48" % paths[4], message)
+    self.assertNotIn(paths[0], message)
+
+  def testStitchFailsBeforeEncodingForCorruptImage(self):
+    paths = [
+        _create_image(self.get_temp_dir(), 64, 48, 100,
+                      "20210903T120000000-Screenshot.jpg"),
+        _create_image(self.get_temp_dir(), 64, 48, 100,
+                      "20210903T120001000-Screenshot.jpg"),
+    ]
+    with open(paths[1], "wb") as f:
+      f.write(b"\xff\xd8\xff")
+    out_mp4_path = os.path.join(self.get_temp_dir(), "corrupt.mp4")
+    timezone = "US/Central"
+    with self.assertRaisesRegex(ValueError, "1 invalid image"):
+      video.stitch_images_into_mp4(
+          paths, file_naming.parse_epoch_seconds_from_filename(
+              paths[0], timezone), timezone, out_mp4_path)
+    self.assertFalse(os.path.exists(out_mp4_path))
+
+  def testStitchRaisesErrorIfAllImagesAreBeforeStartTime(self):
+    paths = [_create_image(self.get_temp_dir(), 64, 48, 100,
+                           "20210903T120000000-Screenshot.jpg")]
+    timezone = "US/Central"
+    out_mp4_path = os.path.join(self.get_temp_dir(), "empty.mp4")
+    with self.assertRaisesRegex(ValueError, "before the start time"):
+      video.stitch_images_into_mp4(
+          paths, file_naming.parse_epoch_seconds_from_filename(
+              paths[0], timezone) + 1.0, timezone, out_mp4_path)
+
+
+class MakeDummyVideoFileTest(tf.test.TestCase):
 
   def testMakeDummyVideoSucceeds(self):
-    image_path = self._createImage(800, 600, 60, "dummy_frame.jpg")
+    image_path = _create_image(self.get_temp_dir(), 800, 600, 60,
+                               "dummy_frame.jpg")
     out_mp4_path = os.path.join(self.get_temp_dir(), "out.mp4")
     video.make_dummy_video_file(10, image_path, out_mp4_path)
 
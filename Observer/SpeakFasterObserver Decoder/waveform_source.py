@@ -0,0 +1,190 @@
+"""Lazily-read waveform sources for long audio recordings."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pathlib
+import subprocess
+
+import ffmpeg
+import numpy as np
+from scipy.io import wavfile
+
+import resample
+
+# Number of samples read from an audio file at a time.
+BLOCK_LENGTH = 1 << 20
+
+
+def _get_wav_sample_rate_and_channels(wav_path):
+  sample_rate, xs = wavfile.read(wav_path, mmap=True)
+  num_channels = 1 if len(xs.shape) == 1 else xs.shape[1]
+  del xs
+  return sample_rate, num_channels
+
+
+def _get_sample_rate_and_channels(audio_path):
+  for stream in ffmpeg.probe(audio_path)["streams"]:
+    if stream["codec_type"] == "audio":
+      return int(stream["sample_rate"]), int(stream["channels"])
+  raise ValueError("Cannot find audio stream in %s" % audio_path)
+
+
+def _is_wav(audio_path):
+  return pathlib.PurePath(audio_path).suffix.lower() == ".wav"
+
+
+def _iter_wav_blocks(wav_path, block_length):
+  """Yields blocks of samples from a memory-mapped WAV file."""
+  _, xs = wavfile.read(wav_path, mmap=True)
+  for i in range(0, len(xs), block_length):
+    yield np.array(xs[i:i + block_length])
+
+
+def _iter_decoded_blocks(audio_path, block_length):
+  """Yields blocks of int16 samples decoded from a (e.g., FLAC) file by ffmpeg.
+  """
+  process = subprocess.Popen(
+      ["ffmpeg", "-v", "error", "-i", audio_path,
+       "-f", "s16le", "-acodec", "pcm_s16le", "-"],
+      stdout=subprocess.PIPE)
+  remainder = b""
+  try:
+    while True:
+      buf = process.stdout.read(block_length * 2)
+      if not buf:
+        break
+      buf = remainder + buf
+      num_bytes = len(buf) - len(buf) % 2
+      remainder = buf[num_bytes:]
+      yield np.frombuffer(buf[:num_bytes], dtype="<i2")
+  finally:
+    process.stdout.close()
+    if process.wait() != 0:
+      raise ValueError("Failed to decode audio file %s" % audio_path)
+
+
+class WaveformSource(object):
+  """A mono waveform read lazily from one or more audio files.
+
+  The files are treated as one logical stream in the given order. WAV files
+  are memory-mapped; other formats (e.g., FLAC) are streamed through ffmpeg
+  as int16 samples. At any time, at most a few blocks of samples are held in
+  memory.
+  """
+
+  def __init__(self,
+               audio_paths,
+               block_length=BLOCK_LENGTH,
+               target_sample_rate=None):
+    """Constructor of WaveformSource.
+
+    Args:
+      audio_paths: A list of paths to audio files, or a single path. All the
+        files must be mono and have the same sample rate.
+      block_length: Number of samples read from a file at a time.
+      target_sample_rate: If not None and different from the sample rate of
+        the files, the waveform is resampled to this rate block by block. The
+        resampled samples are float32, with int16 input scaled to [-1, 1].
+    """
+    if isinstance(audio_paths, str):
+      audio_paths = [audio_paths]
+    if not audio_paths:
+      raise ValueError("Empty audio paths")
+    self._audio_paths = list(audio_paths)
+    self._block_length = block_length
+    self._target_sample_rate = target_sample_rate
+    self._sample_rate = None
+    for audio_path in self._audio_paths:
+      if _is_wav(audio_path):
+        sample_rate, num_channels = _get_wav_sample_rate_and_channels(
+            audio_path)
+      else:
+        sample_rate, num_channels = _get_sample_rate_and_channels(audio_path)
+      if num_channels != 1:
+        raise ValueError("Only mono audio is supported: %s" % audio_path)
+      if self._sample_rate is None:
+        self._sample_rate = sample_rate
+      elif sample_rate != self._sample_rate:
+        raise ValueError(
+            "Mismatch in sample rate: %s has %d Hz; expected %d Hz" %
+            (audio_path, sample_rate, self._sample_rate))
+
+  @property
+  def sample_rate(self):
+    """Sample rate of the yielded samples."""
+    return self._target_sample_rate or self._sample_rate
+
+  @property
+  def original_sample_rate(self):
+    """Sample rate of the audio files."""
+    return self._sample_rate
+
+  @property
+  def audio_paths(self):
+    return self._audio_paths
+
+  def iter_blocks(self):
+    """Yields consecutive blocks of samples of all files as 1D numpy arrays."""
+    if self.sample_rate != self._sample_rate:
+      return resample.iter_resampled(
+          self._iter_original_blocks(), self._sample_rate, self.sample_rate)
+    return self._iter_original_blocks()
+
+  def _iter_original_blocks(self):
+    for audio_path in self._audio_paths:
+      if _is_wav(audio_path):
+        blocks = _iter_wav_blocks(audio_path, self._block_length)
+      else:
+        blocks = _iter_decoded_blocks(audio_path, self._block_length)
+      for block in blocks:
+        yield block
+
+  def iter_frames(self, frame_length, hop_length=None):
+    """Yields fixed-length frames of the waveform.
+
+    Args:
+      frame_length: Length of each frame, in samples.
+      hop_length: Distance between the beginnings of consecutive frames, in
+        samples. Defaults to frame_length (i.e., no overlap). Must not
+        exceed frame_length.
+
+    Yields:
+      Frames as 1D numpy arrays of length frame_length, except for the last
+        frame, which may be shorter. Frames span file boundaries.
+    """
+    if hop_length is None:
+      hop_length = frame_length
+    if hop_length <= 0 or hop_length > frame_length:
+      raise ValueError(
+          "hop_length must be in (0, frame_length]; got %s" % hop_length)
+    buffer = None
+    has_yielded = False
+    for block in self.iter_blocks():
+      buffer = block if buffer is None else np.concatenate([buffer, block])
+      start = 0
+      while start + frame_length <= len(buffer):
+        yield buffer[start:start + frame_length]
+        has_yielded = True
+        start += hop_length
+      buffer = buffer[start:]
+    # Yield the trailing partial frame, unless it is already covered by the
+    # last full frame.
+    if buffer is not None and len(buffer) and not (
+        has_yielded and len(buffer) <= frame_length - hop_length):
+      yield buffer
+
+  def frame_generator(self, frame_sec, hop_sec=None):
+    """Returns a callable that creates a frame generator.
+
+    This is in the format expected by audio_events.extract_audio_events().
+
+    Args:
+      frame_sec: Length of each frame, in seconds.
+      hop_sec: Distance between consecutive frames, in seconds. Defaults to
+        frame_sec.
+    """
+    frame_length = int(round(frame_sec * self.sample_rate))
+    hop_length = (
+        None if hop_sec is None else int(round(hop_sec * self.sample_rate)))
+    return lambda: self.iter_frames(frame_length, hop_length=hop_length)
@@ -0,0 +1,96 @@
+"""Unit tests for the waveform_source module."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+from scipy.io import wavfile
+import tensorflow as tf
+
+import waveform_source
+
+
+class WaveformSourceTest(tf.test.TestCase):
+
+  def _writeWav(self, file_name, xs, fs=16000):
+    wav_path = os.path.join(self.get_temp_dir(), file_name)
+    wavfile.write(wav_path, fs, xs)
+    return wav_path
+
+  def testSingleFileNonOverlappingFrames(self):
+    wav_path = self._writeWav("a.wav", np.arange(25, dtype=np.int16))
+    source = waveform_source.WaveformSource(wav_path, block_length=7)
+    self.assertEqual(source.sample_rate, 16000)
+    frames = list(source.iter_frames(10))
+    self.assertLen(frames, 3)
+    self.assertAllEqual(frames[0], np.arange(10))
+    self.assertAllEqual(frames[1], np.arange(10, 20))
+    self.assertAllEqual(frames[2], np.arange(20, 25))
+
+  def testTwoFilesAsOneStream(self):
+    wav_path_1 = self._writeWav("a.wav", np.arange(15, dtype=np.int16))
+    wav_path_2 = self._writeWav("b.wav", np.arange(15, 30, dtype=np.int16))
+    source = waveform_source.WaveformSource(
+        [wav_path_1, wav_path_2], block_length=4)
+    frames = list(source.iter_frames(10))
+    self.assertLen(frames, 3)
+    self.assertAllEqual(np.concatenate(frames), np.arange(30))
+
+  def testOverlappingFrames(self):
+    wav_path = self._writeWav("a.wav", np.arange(20, dtype=np.int16))
+    source = waveform_source.WaveformSource(wav_path, block_length=3)
+    frames = list(source.iter_frames(10, hop_length=5))
+    self.assertLen(frames, 3)
+    self.assertAllEqual(frames[0], np.arange(10))
+    self.assertAllEqual(frames[1], np.arange(5, 15))
+    self.assertAllEqual(frames[2], np.arange(10, 20))
+
+  def testOverlappingFramesWithPartialTail(self):
+    wav_path = self._writeWav("a.wav", np.arange(22, dtype=np.int16))
+    source = waveform_source.WaveformSource(wav_path)
+    frames = list(source.iter_frames(10, hop_length=5))
+    self.assertLen(frames, 4)
+    self.assertAllEqual(frames[-1], np.arange(15, 22))
+
+  def testFrameGeneratorInSeconds(self):
+    wav_path = self._writeWav(
+        "a.wav", np.zeros(16000 * 2 + 8000, dtype=np.int16))
+    source = waveform_source.WaveformSource(wav_path)
+    frames = list(source.frame_generator(1.0)())
+    self.assertEqual([len(frame) for frame in frames], [16000, 16000, 8000])
+    self.assertEqual(frames[0].dtype, np.int16)
+
+  def testResamplesToTargetSampleRate(self):
+    wav_path = self._writeWav(
+        "a.wav", np.zeros(44100 * 2, dtype=np.int16), fs=44100)
+    source = waveform_source.WaveformSource(
+        wav_path, block_length=10000, target_sample_rate=16000)
+    self.assertEqual(source.sample_rate, 16000)
+    self.assertEqual(source.original_sample_rate, 44100)
+    frames = list(source.frame_generator(1.0)())
+    self.assertEqual([len(frame) for frame in frames], [16000, 16000])
+    self.assertEqual(frames[0].dtype, np.float32)
+
+  def testSampleRateMismatchRaisesValueError(self):
+    wav_path_1 = self._writeWav("a.wav", np.zeros(10, dtype=np.int16))
+    wav_path_2 = self._writeWav(
+        "b.wav", np.zeros(10, dtype=np.int16), fs=44100)
+    with self.assertRaisesRegex(ValueError, r"Mismatch in sample rate"):
+      waveform_source.WaveformSource([wav_path_1, wav_path_2])
+
+  def testStereoRaisesValueError(self):
+    wav_path = self._writeWav("a.wav", np.zeros([10, 2], dtype=np.int16))
+    with self.assertRaisesRegex(ValueError, r"Only mono"):
+      waveform_source.WaveformSource(wav_path)
+
+  def testInvalidHopLengthRaisesValueError(self):
+    wav_path = self._writeWav("a.wav", np.zeros(10, dtype=np.int16))
+    source = waveform_source.WaveformSource(wav_path)
+    with self.assertRaisesRegex(ValueError, r"hop_length"):
+      list(source.iter_frames(5, hop_length=6))
+
+
+if __name__ == "__main__":
+  tf.test.main()